@@ -1,33 +1,53 @@
 #!/usr/bin/python3
-""" alarm_tstat: Python app to alter RadioThermostat settings on alarm arm/disarm. """
+""" alarm_tstat: Python app to alter thermostat settings on alarm arm/disarm. """
 ###########################################################################
 #
-# alarm_tstat.py - Control Radio Thermostat when a switch (i.e., alarm
-# relay) is armed/disarmed
+# alarm_tstat.py - Control thermostat(s) and/or tell the Home Assistant when
+# a switch (i.e., alarm relay) is armed/disarmed
 #
 # Copyright (C) 2019-2023, Wayne Geiser.  All Rights Reserved.
 # email: geiserw@gmail.com
 #
 # You have no rights to any of this code without expressed permission.
 #
+# Each arm/disarm is handed to every configured sink (see wg_sinks.py): the
+# Ecobee, the Radio Thermostat and/or MQTT.  The sinks run at the same time,
+# each on its own thread, with their own time limit, so one slow or broken
+# backend doesn't hold up the others.
+#
+# Each arm/disarm has ACTION_BUDGET seconds for everything it does (status
+# reads, token refresh, retries and the write, see wg_deadline.py); when that
+# runs out the sinks give up and send their failure notification.
+#
+# Every event is traced (see wg_latency.py): the relay hold, time in the queue,
+# each sink and each network call end up in LATENCY_FILE.  Run wg_latency.py
+# for the p50/p95/p99 of each stage.
+#
 ###########################################################################
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import contextvars
+import time
 from time import sleep
 from wg_helper import wg_trace_print
 from wg_helper import wg_error_print
 from wg_helper import wg_init_log
-from wg_ecobee import HOLD_ENABLED
-from wg_ecobee import HOLD_DISABLED
-from wg_ecobee import TMODE_HEAT
-from wg_ecobee import TSTAT_ERROR
-from wg_ecobee import ecobee_get_status
-from wg_ecobee import authorize_app_with_ecobee
-from wg_ecobee import ecobee_get_todays_lowest_setting
-from wg_ecobee import ecobee_set_hold_temp
-from wg_ecobee import ecobee_resume_program
-from wg_ecobee import ecobee_send_alert
-from wg_messagesender import sendtext
-
-__version__ = "v4.1"
+from wg_helper import wg_close_log
+from wg_event_queue import WgEventQueue
+from wg_deadline import wg_deadline_start
+from wg_latency import wg_latency_init
+from wg_latency import wg_latency_start
+from wg_latency import wg_latency_bind
+from wg_latency import wg_latency_span
+from wg_latency import wg_latency_add
+from wg_latency import wg_latency_finish
+from wg_notify import wg_notify_start
+from wg_notify import wg_notify_stop
+from wg_sinks import EcobeeSink
+from wg_sinks import RadthermSink
+from wg_sinks import MqttSink
+
+__version__ = "v6.0"
 APP_NAME = "Alarm T-stat Control"
 TRACE = False
 TEST_MODE = False
@@ -37,7 +57,11 @@ if TEST_MODE :
         active_time = 0
 else :
     from gpiozero import Button
-    
+
+# Which backends to drive (see make_sinks)
+USE_ECOBEE = True
+USE_RADTHERM = False
+USE_MQTT = False
 
 g_Just_Started = True
 
@@ -47,124 +71,161 @@ NO_RELAY_PIN_BCM = 15
 NC_RELAY_PIN_BCM = 17
 DEBOUNCE_SECONDS = 5.0
 
-NUM_RETRIES = 10 # Number of times to retry a failed call
+LATENCY_FILE = "latency.jsonl"
+ACTION_BUDGET = 30.0 # seconds for an arm or disarm, including retries
+
+# The relay callbacks just queue the work.  Arm and disarm are queued under the
+# same key so, if the alarm flaps, only the latest state is left waiting.
+ALARM_EVENT_KEY = "alarm"
+g_events = WgEventQueue("alarm_tstat")
+
+g_sinks = []
+g_executor = None
+
+
+def make_sinks():
+    """ Build the list of sinks from the USE_ settings. """
+    sinks = []
+    if USE_ECOBEE :
+        sinks.append(EcobeeSink(APP_NAME, CELL_PHONE, TRACE))
+    if USE_RADTHERM :
+        sinks.append(RadthermSink(TRACE))
+    if USE_MQTT :
+        # Only import the secrets if we need them
+        from SecretStuff import SECRET_HA_URL
+        from SecretStuff import SECRET_MQTT_USER
+        from SecretStuff import SECRET_MQTT_PASS
+        sinks.append(MqttSink(SECRET_HA_URL, SECRET_MQTT_USER, SECRET_MQTT_PASS, __version__,
+                              coalesced=coalesced_events, trace=TRACE))
+    return sinks
+
+def dispatch(action, button):
+    """ Call action ("arm" or "disarm") on every sink, in parallel. """
+    global g_Just_Started
 
+    futures = []
+    for sink in g_sinks:
+        # copy_context so the sink's spans go in this event's trace
+        futures.append((sink, g_executor.submit(contextvars.copy_context().run, run_sink,
+                                                sink, action, button, g_Just_Started)))
+    start = time.monotonic()
+    for sink, future in futures:
+        try:
+            future.result(timeout=max(0.0, start + sink.timeout - time.monotonic()))
+        except FutureTimeoutError:
+            wg_error_print(action, sink.name + " didn't finish in " + str(sink.timeout) + " seconds")
+        except Exception as err: #pylint: disable=W0703
+            wg_error_print(action, sink.name + " failed: " + str(err))
+    g_Just_Started = False # next time through will be because of a change to the alarm
 
-def setback_tstat(button):
-    """ Set the thermostat to the lowest temp setting on today's prog. """
-    global g_Just_Started
+def run_sink(sink, action, button, just_started):
+    """ Call action on one sink (on an executor thread). """
+    with wg_latency_span(sink.name + "." + action):
+        getattr(sink, action)(button, just_started)
 
+def setback_tstat(button):
+    """ The alarm was armed: tell all the sinks. """
     if not TEST_MODE : # no button to quuery
-        wg_trace_print("Normally open switch held for " +
-                       str(button.active_time) + " seconds", TRACE)
-    tstat_status = ecobee_get_status(TRACE)
-    if 'error' in tstat_status:
-        wg_error_print("setback_tstat",
-                       "Error getting thermostat status.  Skipping...")
-        return  # try again the next time
-    tmode = tstat_status['tmode']   # thermostat mode (heat?)
-    if tstat_status['hold'] == HOLD_ENABLED:
-        wg_trace_print("Hold enabled.  Don't do anything", TRACE)
-        return # don't mess with the settings, someone wants them this way
-    if tmode != TMODE_HEAT:
-        wg_trace_print("We're not in heating mode.  Don't do anything.", TRACE)
-        return # don't mess with the settings, we're not heating
-    i = 0
-    setback_temp = TSTAT_ERROR
-    while i < NUM_RETRIES and setback_temp == TSTAT_ERROR:
-        setback_temp = ecobee_get_todays_lowest_setting(TRACE)        
-        if setback_temp != TSTAT_ERROR:
-            wg_trace_print("Setting target temp to " + str(setback_temp), TRACE)
-            # set the temporary temperature to the value we found, above
-            ret = ecobee_set_hold_temp(setback_temp, TRACE)
-            if ret == TSTAT_ERROR:
-                wg_error_print("setback_tstat", "Error setting t_heat")
-                return
-            # turn the night light off
-            # ret = ecobee_set_intensity(NIGHTLIGHT_OFF, TRACE)
-            # if ret == TSTAT_ERROR:
-            #     wg_error_print("setback_tstat", "Error setting intensity")
-            #    return
-            wg_trace_print("System armed", True)
-        else:
-            i = i + 1
-            t = DEBOUNCE_SECONDS * i
-            wg_trace_print("Error getting today's lowest setting, trying again in " +
-                           str(t) + " seconds", True)
-            sleep(t) # delay a little longer each time in hopes it'll work
-    g_Just_Started = False
-    if setback_temp == TSTAT_ERROR:
-        # Send me a text message to tell me it didn't work
-        sendtext(CELL_PHONE, APP_NAME,
-                 "Unable to set thermostat back.  You'll have to do it via smartphone app.  Sorry.")
+        wg_trace_print("Normally open switch held for %s seconds", TRACE, button.active_time)
+    with wg_latency_span("setback_tstat"), wg_deadline_start(ACTION_BUDGET):
+        dispatch("arm", button)
 
 def run_tstat(button):
-    """ Run the current thermostat prog. """
-    global g_Just_Started
-
+    """ The alarm was disarmed: tell all the sinks. """
     if not TEST_MODE : # no button to query
-        wg_trace_print("Normally closed switch held for " +
-                       str(button.active_time) + " seconds", TRACE)
-    tstat_status = ecobee_get_status(TRACE)
-    if 'error' in tstat_status:
-        wg_error_print("run_tstat",
-                       "Error getting thermostat status.  Skipping...")
-        return  # try again the next time
-    tmode = tstat_status['tmode']   # thermostat mode (heat?)
-    if tmode != TMODE_HEAT:
-        wg_trace_print("We're not in heating mode.  Don't do anything.", TRACE)
-        return # don't mess with the settings, we're not heating
-    if (tstat_status['hold'] == HOLD_ENABLED) and g_Just_Started:
-        # if hold & we just started up, don't mess with the settings
-        wg_trace_print("Hold enabled and we just started, not changing t-stat settings", TRACE)
-        return
-    # disable hold
-    ret = ecobee_resume_program(TRACE)
-    if ret == TSTAT_ERROR:
-        wg_error_print("run_tstat", "Error disabling hold")
-        return
-    # !!! Now should be running current program !!!
-    # turn the night light on
-    # ret = ecobee_set_intensity(NIGHTLIGHT_ON, TRACE)
-    # if ret == TSTAT_ERROR:
-    #     wg_error_print("run_tstat", "Error setting intensity")
-    #     return
-    wg_trace_print("System disarmed", True)
-    g_Just_Started = False # next time through will be because of a change to the alarm
-
-
-def main():
+        wg_trace_print("Normally closed switch held for %s seconds", TRACE, button.active_time)
+    with wg_latency_span("run_tstat"), wg_deadline_start(ACTION_BUDGET):
+        dispatch("disarm", button)
+
+def armed(button):
+    """ gpiozero callback: the alarm was armed. """
+    post_event("armed", setback_tstat, button)
+
+def disarmed(button):
+    """ gpiozero callback: the alarm was disarmed. """
+    post_event("disarmed", run_tstat, button)
+
+def post_event(name, action, button):
+    """ Start the event's trace and queue the action. """
+    trace = wg_latency_start(name)
+    g_events.post(ALARM_EVENT_KEY, wg_latency_bind(trace, traced_event), trace, action, button)
+
+def traced_event(trace, action, button):
+    """ Run a queued action (on the event queue's thread) and finish its trace. """
+    # The relay was held for DEBOUNCE_SECONDS (or so) before gpiozero called us
+    wg_latency_add("relay hold", getattr(button, 'active_time', None) or 0.0)
+    if trace is not None:
+        trace.add("queued", trace.start, time.perf_counter() - trace.start)
+    try:
+        action(button)
+    finally:
+        wg_latency_finish(trace)
+
+def coalesced_events():
+    """ Number of events replaced by a newer one before they ran. """
+    return g_events.stats()['coalesced']
+
+def print_event_stats():
+    """ Print out the event queue statistics. """
+    stats = g_events.stats()
+    print("Queue depth: " + str(stats['depth']) + "  handled: " + str(stats['handled']) +
+          "  coalesced: " + str(stats['coalesced']) + "  dropped: " + str(stats['dropped']))
+
+
+def main(sinks=None):
     """ alarm_tstat main code. """
+    global g_sinks, g_executor
 
-    authorize_app_with_ecobee(TRACE) # We only need to do this at startup because we reboot once a day
-    wg_init_log("err.txt")
+    wg_init_log("err.txt", queued=True) # keep the SD card writes out of the callbacks
+    wg_latency_init(LATENCY_FILE)
+    wg_notify_start() # Mailtrap, then Twilio if Mailtrap isn't working
     wg_trace_print("Alarm/Tstat controller started.  Version: " + __version__, True)
+    if sinks is None :
+        sinks = make_sinks()
+    g_sinks = sinks
+    # Extra threads so a sink that's stuck past its timeout doesn't starve the rest
+    g_executor = ThreadPoolExecutor(max_workers=2 * max(len(g_sinks), 1),
+                                    thread_name_prefix="sink")
+    for sink in g_sinks:
+        sink.start()
+    g_events.start()
     if not TEST_MODE :
         armed_switch = Button(NO_RELAY_PIN_BCM, hold_time=DEBOUNCE_SECONDS)
         disarmed_switch = Button(NC_RELAY_PIN_BCM, hold_time=DEBOUNCE_SECONDS, pull_up=True)
-        armed_switch.when_held = setback_tstat
-        disarmed_switch.when_held = run_tstat
+        armed_switch.when_held = armed
+        disarmed_switch.when_held = disarmed
 
     # Make sure we start out disarmed and the tstat is running it's program
     running = True
     if TEST_MODE :
         b = Button()
-        run_tstat(b)
+        disarmed(b)
     else :
-        run_tstat(disarmed_switch)
+        disarmed(disarmed_switch)
 
     if TEST_MODE :
-        print("1 alarm armed - 2 alarm disarmed")
-    while running:
-        if TEST_MODE:
-            num = int(input())
-            if num == 1 :
-                setback_tstat(0)
-            elif  num == 2 :
-                run_tstat(0)
+        print("1 alarm armed - 2 alarm disarmed - 3 event statistics")
+    try :
+        while running:
+            if TEST_MODE:
+                num = int(input())
+                if num == 1 :
+                    armed(0)
+                elif  num == 2 :
+                    disarmed(0)
+                elif num == 3 :
+                    print_event_stats()
+                else :
+                    wg_error_print("main", "Bad input: expecting either 1 to setback or 2 to resume")
             else :
-                wg_error_print("main", "Bad input: expecting either 1 to setback or 2 to resume")
-        else :
-            sleep(1)
-
-main()
+                sleep(1)
+    finally :
+        g_events.stop()
+        for sink in g_sinks:
+            sink.stop()
+        g_executor.shutdown(wait=False)
+        wg_notify_stop() # send any notifications still queued
+        wg_close_log()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+""" bench_suite: Benchmark wg_ecobee, wg_radio_thermostat and the sinks against local fakes. """
+###########################################################################
+#
+# bench_suite.py - Calls per second and latency of the thermostat code.
+#
+# Copyright (C) 2023, Wayne Geiser.  All Rights Reserved.
+# email: geiserw@gmail.com
+#
+# Runs every public wg_ecobee and wg_radio_thermostat call, the wg_notify
+# hand-off, and full arm/disarm cycles through the sinks, against the
+# stand-in servers in wg_fake_servers.py (so no Ecobee account or thermostat
+# is needed).  Reads are timed both "cold" (cache emptied first) and
+# "cached".  There are also runs with an expired token (status 14) and a
+# dropped connection before each call.
+#
+# The results (calls/second and mean/p50/p95/p99/max in ms) are printed and
+# written as JSON.  Give it an earlier results file with --baseline and it
+# exits with 1 if any p50 got more than --tolerance worse.
+#
+# Usage:
+#   bench_suite.py [--calls 50] [--latency 0.0] [--jitter 0.0] [--error-rate 0.0]
+#                  [--drop-rate 0.0] [--only ecobee] [--output bench_results.json]
+#                  [--baseline old.json] [--tolerance 0.25]
+#
+###########################################################################
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logzero
+from wg_fake_servers import WgFakeEcobee
+from wg_fake_servers import WgFakeRadtherm
+from wg_fake_servers import WgFakeNotify
+from wg_fake_servers import WG_FAKE_DROP
+from wg_fake_servers import wg_fake_use_ecobee
+from wg_fake_servers import wg_fake_use_radtherm
+import wg_ecobee
+import wg_radio_thermostat
+import wg_notify
+from wg_sinks import EcobeeSink
+from wg_sinks import RadthermSink
+
+BENCH_VERSION = "1.0"
+BENCH_CALLS = 50
+BENCH_WARMUP = 2
+BENCH_OUTPUT = "bench_results.json"
+BENCH_TOLERANCE = 0.25  # p50 this much (25%) slower than the baseline is a regression
+
+TRACE = False
+BENCH_PHONE = "5551234" # the sinks' failure texts go to the fake notify server
+
+def percentile(values, pct):
+    """ pct percentile of a sorted list (nearest rank). """
+    rank = max(0, min(len(values) - 1, -(-len(values) * pct // 100) - 1))
+    return values[int(rank)]
+
+def run_bench(func, calls, setup=None, ok=None):
+    """ Time calls to func.  setup (not timed) runs before each one. """
+    times = []
+    errors = 0
+    for num in range(BENCH_WARMUP + calls):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        try:
+            result = func()
+            failed = ok is not None and not ok(result)
+        except Exception: #pylint: disable=W0703
+            failed = True
+        elapsed = time.perf_counter() - start
+        if num >= BENCH_WARMUP:
+            times.append(elapsed)
+            errors += failed
+    total = sum(times)
+    times.sort()
+    return {
+        'calls' : calls,
+        'errors' : errors,
+        'calls_per_sec' : round(calls / total, 1) if total else None,
+        'mean_ms' : round(total / calls * 1000.0, 3),
+        'p50_ms' : round(percentile(times, 50) * 1000.0, 3),
+        'p95_ms' : round(percentile(times, 95) * 1000.0, 3),
+        'p99_ms' : round(percentile(times, 99) * 1000.0, 3),
+        'max_ms' : round(times[-1] * 1000.0, 3),
+    }
+
+###############################################################################
+#
+# The benchmarks: (name, function, setup, ok)
+#
+def ecobee_ok(result):
+    """ The usual wg_ecobee result check. """
+    return result == wg_ecobee.TSTAT_SUCCESS
+
+def ecobee_benchmarks(fake):
+    """ Every public wg_ecobee call. """
+    cold = wg_ecobee.ecobee_invalidate_snapshot
+    ids = [tstat['identifier'] for tstat in fake.thermostats]
+    temps = {ident : 600 + num for num, ident in enumerate(ids)}
+    status_ok = lambda status: 'error' not in status
+    read_ok = lambda data: data.get('status', {}).get('code') == wg_ecobee.ECOBEE_CODE_SUCCESS
+    setting_ok = lambda setting: setting != wg_ecobee.TSTAT_ERROR
+
+    def expire():
+        fake.expire_tokens()
+        cold()
+
+    def drop():
+        fake.fail_next(WG_FAKE_DROP)
+        cold()
+
+    benches = [
+        ("ecobee authorize (refresh)", lambda: wg_ecobee.authorize_app_with_ecobee(TRACE),
+         None, ecobee_ok),
+        ("ecobee get_tstat_data", lambda: wg_ecobee.get_tstat_data(TRACE), None, read_ok),
+        ("ecobee_poll (no change)", lambda: wg_ecobee.ecobee_poll(TRACE), None,
+         lambda sections: sections == []),
+        ("ecobee_poll (runtime changed)", lambda: wg_ecobee.ecobee_poll(TRACE),
+         lambda: fake.set_temperature(ids[0], 700), lambda sections: sections == ['runtime']),
+    ]
+    for name, func, ok in (
+            ("ecobee_get_status", lambda: wg_ecobee.ecobee_get_status(TRACE), status_ok),
+            ("ecobee_get_status_all", lambda: wg_ecobee.ecobee_get_status_all(TRACE),
+             status_ok),
+            ("ecobee_get_todays_lowest_setting",
+             lambda: wg_ecobee.ecobee_get_todays_lowest_setting(TRACE), setting_ok),
+            ("ecobee_get_todays_highest_setting",
+             lambda: wg_ecobee.ecobee_get_todays_highest_setting(TRACE), setting_ok),
+            ("ecobee_get_todays_lowest_settings",
+             lambda: wg_ecobee.ecobee_get_todays_lowest_settings(TRACE), bool),
+            ("ecobee_get_climate_settings",
+             lambda: wg_ecobee.ecobee_get_climate_settings("Sleep", TRACE), bool)):
+        benches.append((name + " (cold)", func, cold, ok))
+        benches.append((name + " (cached)", func, None, ok))
+    benches += [
+        ("ecobee_set_hold_temp", lambda: wg_ecobee.ecobee_set_hold_temp(600, TRACE),
+         None, ecobee_ok),
+        ("ecobee_resume_program", lambda: wg_ecobee.ecobee_resume_program(TRACE),
+         None, ecobee_ok),
+        ("ecobee_send_alert", lambda: wg_ecobee.ecobee_send_alert("Benchmark", TRACE),
+         None, ecobee_ok),
+        ("ecobee_control_fan", lambda: wg_ecobee.ecobee_control_fan(wg_ecobee.FAN_ON, TRACE),
+         None, ecobee_ok),
+        ("ecobee_post_functions (hold+alert)",
+         lambda: wg_ecobee.ecobee_post_functions(
+             [wg_ecobee.ecobee_set_hold_function(600),
+              wg_ecobee.ecobee_send_message_function("Benchmark")], TRACE),
+         None, lambda results: all(ecobee_ok(result) for result in results)),
+        ("ecobee_set_hold_temps", lambda: wg_ecobee.ecobee_set_hold_temps(temps, TRACE),
+         None, lambda results: all(ecobee_ok(result) for result in results.values())),
+        ("ecobee_resume_programs", lambda: wg_ecobee.ecobee_resume_programs(ids, TRACE),
+         None, lambda results: all(ecobee_ok(result) for result in results.values())),
+        ("ecobee_get_status (token expired)", lambda: wg_ecobee.ecobee_get_status(TRACE),
+         expire, status_ok),
+        ("ecobee_get_status (connection dropped)", lambda: wg_ecobee.ecobee_get_status(TRACE),
+         drop, status_ok),
+    ]
+    return benches
+
+def radtherm_benchmarks(fake):
+    """ Every public wg_radio_thermostat call. """
+    cold = wg_radio_thermostat.radtherm_invalidate_snapshot
+    float_ok = lambda value: value != wg_radio_thermostat.RADTHERM_FLOAT_ERROR
+    int_ok = lambda value: value != wg_radio_thermostat.RADTHERM_INT_ERROR
+
+    def drop():
+        fake.fail_next(WG_FAKE_DROP)
+        cold()
+
+    benches = [
+        ("radtherm_status", wg_radio_thermostat.radtherm_status, None,
+         lambda status: status != wg_radio_thermostat.RADTHERM_STATUS_ERROR),
+    ]
+    for name, func, ok in (
+            ("radtherm_get_float temp",
+             lambda: wg_radio_thermostat.radtherm_get_float("temp", TRACE), float_ok),
+            ("radtherm_get_int tmode",
+             lambda: wg_radio_thermostat.radtherm_get_int("tmode", TRACE), int_ok)):
+        benches.append((name + " (cold)", func, cold, ok))
+        benches.append((name + " (cached)", func, None, ok))
+    benches += [
+        ("radtherm_get_float humidity",
+         lambda: wg_radio_thermostat.radtherm_get_float("humidity", TRACE), None, float_ok),
+        ("radtherm_get_int intensity",
+         lambda: wg_radio_thermostat.radtherm_get_int("intensity", TRACE), None, int_ok),
+        ("radtherm_set_float t_heat",
+         lambda: wg_radio_thermostat.radtherm_set_float("t_heat", 60, TRACE), None,
+         lambda value: value == wg_radio_thermostat.RADTHERM_FLOAT_SUCCESS),
+        ("radtherm_set_int hold",
+         lambda: wg_radio_thermostat.radtherm_set_int("hold", 0, TRACE), None,
+         lambda value: value == wg_radio_thermostat.RADTHERM_INT_SUCCESS),
+        ("radtherm_set_str uma_line0",
+         lambda: wg_radio_thermostat.radtherm_set_str("uma_line0", "Bench", TRACE), None,
+         lambda value: value == wg_radio_thermostat.RADTHERM_STR_SUCCESS),
+        ("radtherm_get_todays_lowest_setting",
+         lambda: wg_radio_thermostat.radtherm_get_todays_lowest_setting(TRACE), None, float_ok),
+        ("radtherm_get_todays_highest_setting",
+         lambda: wg_radio_thermostat.radtherm_get_todays_highest_setting(TRACE), None, float_ok),
+        ("radtherm_status (connection dropped)", wg_radio_thermostat.radtherm_status, drop,
+         lambda status: status != wg_radio_thermostat.RADTHERM_STATUS_ERROR),
+    ]
+    return benches
+
+def notify_benchmarks(notifier):
+    """ Handing a notification off to the queue (sending is in the background). """
+    return [("wg_notify_text (handoff)",
+             lambda: notifier.notify(wg_notify.WG_NOTIFY_TEXT, BENCH_PHONE, "Benchmark", "Benchmark"),
+             None, bool)]
+
+def cycle_benchmarks(sinks):
+    """ Full arm + disarm cycles through the sinks. """
+    executor = ThreadPoolExecutor(max_workers=max(len(sinks), 1))
+
+    def cycle(sink):
+        sink.arm(None, False)
+        sink.disarm(None, False)
+
+    def all_sinks():
+        # like alarm_tstat.dispatch: every sink at once
+        for action in ("arm", "disarm"):
+            futures = [executor.submit(getattr(sink, action), None, False) for sink in sinks]
+            for future in futures:
+                future.result()
+
+    benches = [("cycle " + sink.name, lambda sink=sink: cycle(sink), None, None)
+               for sink in sinks]
+    if len(sinks) > 1:
+        benches.append(("cycle all sinks", all_sinks, None, None))
+    return benches
+
+###############################################################################
+#
+# Running it all
+#
+def compare(results, baseline_file, tolerance):
+    """ Names of the benchmarks whose p50 is more than tolerance worse than the baseline. """
+    with open(baseline_file, encoding="utf-8") as file:
+        baseline = json.load(file)['results']
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old and old['p50_ms'] > 0 and result['p50_ms'] > old['p50_ms'] * (1.0 + tolerance):
+            regressions.append(name)
+    return regressions
+
+def main():
+    """ bench_suite main code. """
+    parser = argparse.ArgumentParser(description="Benchmark the thermostat code against fakes")
+    parser.add_argument("--calls", type=int, default=BENCH_CALLS, help="timed calls per benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake server latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failed")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of requests dropped")
+    parser.add_argument("--thermostats", type=int, default=2, help="Ecobee thermostats")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", default=BENCH_OUTPUT, help="JSON results file")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE,
+                        help="allowed p50 slowdown vs. the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+    logzero.loglevel(logging.WARNING) # just the errors, not every "System armed"
+
+    faults = {'latency' : args.latency, 'jitter' : args.jitter, 'error_rate' : args.error_rate,
+              'drop_rate' : args.drop_rate, 'seed' : 1}
+    ecobee = WgFakeEcobee(num_thermostats=args.thermostats, **faults).start()
+    radtherm = WgFakeRadtherm(**faults).start()
+    notify = WgFakeNotify(**faults).start()
+    # The shared notifier, so anything the sinks send goes to the fake too
+    notifier = wg_notify.wg_notify_start([wg_notify.WgHttpProvider(notify.url + "/notify")])
+    token_dir = tempfile.mkdtemp()
+    wg_fake_use_ecobee(ecobee, os.path.join(token_dir, "token_storage.txt"))
+    wg_fake_use_radtherm(radtherm)
+    sinks = [EcobeeSink("Benchmark", BENCH_PHONE, TRACE), RadthermSink(TRACE)]
+    for sink in sinks:
+        sink.start()
+
+    benches = (ecobee_benchmarks(ecobee) + radtherm_benchmarks(radtherm) +
+               notify_benchmarks(notifier) + cycle_benchmarks(sinks))
+    results = {}
+    try:
+        for name, func, setup, ok in benches:
+            if args.only and args.only not in name:
+                continue
+            results[name] = result = run_bench(func, args.calls, setup, ok)
+            print("%-45s %9.1f/s  p50 %8.2f  p95 %8.2f  p99 %8.2f ms  errors %d" %
+                  (name, result['calls_per_sec'] or 0.0, result['p50_ms'], result['p95_ms'],
+                   result['p99_ms'], result['errors']))
+    finally:
+        for sink in sinks:
+            sink.stop()
+        wg_notify.wg_notify_stop()
+        ecobee.stop()
+        radtherm.stop()
+        notify.stop()
+
+    report = {
+        'version' : BENCH_VERSION,
+        'time' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'settings' : dict(faults, calls=args.calls, thermostats=args.thermostats),
+        'requests' : {'ecobee' : ecobee.paths, 'radtherm' : radtherm.paths,
+                      'notify' : notify.paths},
+        'notify' : notifier.get_stats(),
+        'results' : results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=4)
+    print("Results written to " + args.output)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for name in regressions:
+            print("REGRESSION: " + name)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+""" bench_trace: show that tracing costs (almost) nothing when it's turned off. """
+###########################################################################
+#
+# bench_trace.py - Microbenchmark of wg_helper's trace calls with trace=False.
+#
+# Copyright (C) 2023, Wayne Geiser.  All Rights Reserved.
+# email: geiserw@gmail.com
+#
+# Times the old style (format first, then check trace) against the deferred
+# style wg_helper supports now, on a thermostat-sized payload, and counts how
+# many times json.dumps/pprint.pformat actually ran.  With trace off the
+# deferred calls should show zero.
+#
+###########################################################################
+import json
+import pprint
+import timeit
+import wg_helper
+from wg_helper import wg_trace_print
+from wg_helper import wg_trace_pprint
+from wg_helper import wg_trace_json
+
+LOOPS = 20000
+
+# Roughly the size of a getThermostat reply with the status sections
+PAYLOAD = {
+    'status' : {'code' : 0, 'message' : ''},
+    'thermostatList' : [{
+        'identifier' : '3118' + str(n),
+        'name' : 'Thermostat ' + str(n),
+        'runtime' : {'actualTemperature' : 689, 'actualHumidity' : 41,
+                     'desiredHeat' : 680, 'desiredCool' : 750},
+        'settings' : {'hvacMode' : 'heat', 'fanMinOnTime' : 0, 'heatStages' : 2},
+        'events' : [{'type' : 'hold', 'running' : True, 'heatHoldTemp' : 620,
+                     'coolHoldTemp' : 620, 'startTime' : '08:00:00'}] * 4
+    } for n in range(3)]
+}
+
+g_counts = {'json.dumps' : 0, 'pformat' : 0}
+
+def counting(name, func):
+    """ Wrap func so we can count how often it's called. """
+    def wrapper(*args, **kwargs):
+        g_counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+def old_style():
+    """ What the callers used to do. """
+    wg_trace_pprint(json.dumps(PAYLOAD, indent=4), False)
+    wg_trace_print("setback_temp is " + str(PAYLOAD['status']), False)
+
+def new_style():
+    """ Deferred: nothing is formatted unless we're tracing. """
+    wg_trace_json(PAYLOAD, False)
+    wg_trace_print("setback_temp is %s", False, PAYLOAD['status'])
+
+def main():
+    """ Run both and print the results. """
+    json.dumps = counting('json.dumps', json.dumps)
+    wg_helper.pprint.pformat = counting('pformat', pprint.pformat)
+    for name, func in (("old", old_style), ("new", new_style)):
+        for key in g_counts:
+            g_counts[key] = 0
+        secs = timeit.timeit(func, number=LOOPS)
+        print("%-4s %8.2f usec/call   json.dumps: %6d   pformat: %6d" %
+              (name, secs * 1e6 / LOOPS, g_counts['json.dumps'], g_counts['pformat']))
+
+if __name__ == "__main__":
+    main()
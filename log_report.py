@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+""" log_report: Daily error, restart and arm/disarm counts from err.txt and its rotations. """
+###########################################################################
+#
+# log_report.py - Index and report on the alarm_tstat log files.
+#
+# Copyright (C) 2023, Wayne Geiser.  All Rights Reserved.
+# email: geiserw@gmail.com
+#
+# Reads err.txt and the rotations wg_init_log keeps (err.txt.1 - .3) a line
+# at a time and keeps the counts in a small JSON index (err.txt.idx) keyed by
+# date, level and function, e.g.
+#     "231129": {"E": {"run_tstat": 2}, "I": {"-": 40}, "events": {"armed": 3}}
+# Each file is recognized by its first line, so when err.txt rotates to
+# err.txt.1 we know we've already read it, and we only read what's been
+# added since the last run.  Rotated-out files drop off the end, but their
+# counts stay in the index.
+#
+# Usage:
+#   log_report.py [--log err.txt] [--since YYMMDD] [--until YYMMDD] [--functions] [--json]
+#
+###########################################################################
+import argparse
+import hashlib
+import json
+import os
+import re
+
+LOG_FILE = "err.txt"
+LOG_ROTATIONS = 3          # matches wg_init_log's backupCount
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# logzero's format: [I 230914 16:06:15 wg_helper:32] message
+LOG_LINE = re.compile(r'^\[(?P<level>[A-Z]) (?P<date>\d{6}) (?P<time>[\d:]{8}) '
+                      r'(?P<module>[\w.]+):(?P<lineno>\d+)\] (?P<message>.*)$')
+# wg_error_print writes "where: message"
+LOG_FUNCTION = re.compile(r'^(?P<function>\w+): ')
+NO_FUNCTION = "-"
+
+# Messages we count as events
+LOG_EVENTS = (
+    ("restarts", "Alarm/Tstat controller started"),
+    ("armed", "System armed"),
+    ("disarmed", "System disarmed"),
+)
+
+###############################################################################
+#
+# The index
+#
+def load_index(index_file):
+    """ Read the index, or start a new one. """
+    try:
+        with open(index_file, encoding="utf-8") as file:
+            index = json.load(file)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version' : INDEX_VERSION, 'files' : {}, 'days' : {}}
+
+def save_index(index, index_file):
+    """ Write the index (to a temp file first so a crash can't leave half of it). """
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(index, file, separators=(',', ':'))
+    os.replace(tmp_file, index_file)
+
+def file_signature(file_name):
+    """ Identify a log file by its first line (None if it's empty). """
+    with open(file_name, "rb") as file:
+        first = file.readline()
+    if not first.endswith(b"\n"):
+        return None
+    return hashlib.sha1(first).hexdigest()
+
+def log_files(log_file):
+    """ The log file and its rotations, oldest first. """
+    names = [log_file + "." + str(n) for n in range(LOG_ROTATIONS, 0, -1)] + [log_file]
+    return [name for name in names if os.path.exists(name)]
+
+###############################################################################
+#
+# Reading the logs
+#
+def count_line(days, line):
+    """ Add one log line to the counts (continuation lines are skipped). """
+    match = LOG_LINE.match(line)
+    if match is None:
+        return
+    message = match.group('message')
+    day = days.setdefault(match.group('date'), {})
+    function = NO_FUNCTION
+    found = LOG_FUNCTION.match(message)
+    if found is not None:
+        function = found.group('function')
+    level = day.setdefault(match.group('level'), {})
+    level[function] = level.get(function, 0) + 1
+    for event, text in LOG_EVENTS:
+        if message.startswith(text):
+            events = day.setdefault('events', {})
+            events[event] = events.get(event, 0) + 1
+
+def update_index(index, log_file):
+    """ Read whatever's new in the log files into the index. """
+    files = {}
+    for name in log_files(log_file):
+        signature = file_signature(name)
+        if signature is None:
+            continue
+        offset = index['files'].get(signature, 0)
+        with open(name, "rb") as file:
+            file.seek(offset)
+            for raw in file:
+                if not raw.endswith(b"\n"):
+                    break # still being written, get it next time
+                count_line(index['days'], raw.decode("utf-8", errors="replace").rstrip("\r\n"))
+                offset += len(raw)
+        files[signature] = offset
+    index['files'] = files # forget the files that have rotated away
+    return index
+
+###############################################################################
+#
+# The report
+#
+def day_totals(day):
+    """ Summarize one day's counts. """
+    records = sum(sum(functions.values()) for level, functions in day.items() if level != 'events')
+    errors = sum(day.get('E', {}).values())
+    totals = {
+        'records' : records,
+        'errors' : errors,
+        'error_rate' : round(errors / records, 3) if records else 0.0,
+    }
+    for event, _ in LOG_EVENTS:
+        totals[event] = day.get('events', {}).get(event, 0)
+    totals['error_functions'] = dict(sorted(day.get('E', {}).items(),
+                                            key=lambda item: -item[1]))
+    return totals
+
+def report(index, since=None, until=None):
+    """ Per-day totals, oldest first. """
+    result = {}
+    for date in sorted(index['days']):
+        if (since and date < since) or (until and date > until):
+            continue
+        result[date] = day_totals(index['days'][date])
+    return result
+
+def print_report(result, functions):
+    """ Print the report as a table. """
+    print("%-8s %8s %7s %6s %8s %6s %8s" %
+          ("date", "records", "errors", "rate", "restarts", "armed", "disarmed"))
+    for date, totals in result.items():
+        print("%-8s %8d %7d %6.3f %8d %6d %8d" %
+              (date, totals['records'], totals['errors'], totals['error_rate'],
+               totals['restarts'], totals['armed'], totals['disarmed']))
+        if functions:
+            for function, count in totals['error_functions'].items():
+                print("    %-40s %5d" % (function, count))
+
+def main():
+    """ log_report main code. """
+    parser = argparse.ArgumentParser(description="Daily counts from the alarm_tstat log files")
+    parser.add_argument("--log", default=LOG_FILE, help="log file (rotations are found from it)")
+    parser.add_argument("--index", help="index file (default: <log>" + INDEX_SUFFIX + ")")
+    parser.add_argument("--since", help="first day to report, YYMMDD")
+    parser.add_argument("--until", help="last day to report, YYMMDD")
+    parser.add_argument("--functions", action="store_true", help="break errors down by function")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    index_file = args.index or args.log + INDEX_SUFFIX
+    index = update_index(load_index(index_file), args.log)
+    save_index(index, index_file)
+    result = report(index, args.since, args.until)
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        print_report(result, args.functions)
+
+if __name__ == "__main__":
+    main()
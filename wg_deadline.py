@@ -0,0 +1,65 @@
+"""A time budget shared by everything done for one action"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# An arm or disarm gets a budget (e.g. 30 seconds) for the status reads, token
+# refresh, retries and the write.  The deadline is kept in a contextvar, so it
+# follows the action onto other threads when they're started with
+# contextvars.copy_context() (the sink executor and wg_retry both do this).
+#
+#     with wg_deadline_start(30.0):
+#         ...
+#
+# Network calls use wg_deadline_timeout for their timeouts: the usual connect/
+# read timeouts, cut down to what's left of the budget.  Once it's used up it
+# raises WgDeadlineExceeded rather than starting a call we can't wait for.
+# With no deadline set, calls just get the usual timeouts.
+import contextlib
+import contextvars
+import time
+
+WG_DEADLINE_VERSION = "1.0"
+
+g_deadline = contextvars.ContextVar("wg_deadline", default=None) # time.monotonic() value
+
+class WgDeadlineExceeded(TimeoutError):
+    """The action's time budget is used up"""
+
+@contextlib.contextmanager
+def wg_deadline_start(seconds):
+    """Give the code in the with block (and what it starts) seconds to finish"""
+    deadline = time.monotonic() + seconds
+    current = g_deadline.get()
+    if current is not None and current < deadline:
+        deadline = current # can't extend the budget we're already running under
+    token = g_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        g_deadline.reset(token)
+
+def wg_deadline_get():
+    """The current deadline (a time.monotonic() value) or None"""
+    return g_deadline.get()
+
+def wg_deadline_remaining():
+    """Seconds left in the budget (None if there's no deadline)"""
+    deadline = g_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def wg_deadline_expired():
+    """True if the budget is used up"""
+    remaining = wg_deadline_remaining()
+    return remaining is not None and remaining <= 0
+
+def wg_deadline_timeout(connect, read):
+    """(connect, read) timeouts for a call, cut down to fit the budget"""
+    remaining = wg_deadline_remaining()
+    if remaining is None:
+        return connect, read
+    if remaining <= 0:
+        raise WgDeadlineExceeded("Time budget used up")
+    return min(connect, remaining), min(read, remaining)
@@ -9,13 +9,22 @@
 import os
 import datetime
 import json
+import threading
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import traceback
-from time import sleep
-from urllib3 import PoolManager
+from urllib.parse import urlparse
 from wg_helper import wg_error_print
 from wg_helper import wg_trace_print
-from wg_helper import wg_trace_pprint
+from wg_helper import wg_trace_json
+from wg_latency import wg_latency_span
+from wg_deadline import wg_deadline_timeout
+from wg_retry import WG_RETRY_DONE
+from wg_retry import WG_RETRY_AGAIN
+from wg_retry import WG_RETRY_REFRESH
+from wg_retry import WG_RETRY_FAIL
 
 WG_ECOBEE_THERMOSTAT_VERSION = "1.0"
 
@@ -28,10 +37,14 @@ if APP_ALARMPI :
     ECOBEE_KEY = "syzVJMlDoZLh6HoLaSE0LF1JZTLInd24"
 if APP_WEATHERPI :
     ECOBEE_KEY = "ZfuqdNHcDemn9Y88h39eoZUOLXYOcDIF"
-ECOBEE_URL = 'https://api.ecobee.com/1/thermostat'
+ECOBEE_API_ROOT = 'https://api.ecobee.com'
+ECOBEE_URL = ECOBEE_API_ROOT + '/1/thermostat'
+ECOBEE_TOKEN_URL = ECOBEE_API_ROOT + '/token'
+ECOBEE_SUMMARY_URL = ECOBEE_API_ROOT + '/1/thermostatSummary'
 
-# Turn this on if you want checking code to be run
-DEBUGGING = False
+# Which thermostats to read and control.  Empty means all the ones registered
+# to the account; otherwise a list of thermostat identifiers.
+ECOBEE_THERMOSTAT_IDS = []
 
 # fmode = fan mode
 FAN_AUTO = 0
@@ -49,7 +62,68 @@ HOLD_ENABLED = 1
 TSTAT_ERROR = -999
 TSTAT_SUCCESS = 999
 
-NUM_TRIES = 5
+# Ecobee status codes we care about
+ECOBEE_CODE_SUCCESS = 0
+ECOBEE_CODE_PROCESSING_ERROR = 3 # something went wrong on their end
+ECOBEE_CODE_TOKEN_EXPIRED = 14
+ECOBEE_CODE_NO_REPLY = 999       # ours, not Ecobee's: the call itself failed
+
+###############################################################################
+#
+# Connection pool shared by every call to the Ecobee API.
+#
+# Each arm/disarm event makes several calls to api.ecobee.com.  Using one
+# keep-alive session means we only pay for the TCP+TLS handshake once instead
+# of on every call (which, on the Pi, is most of the time it takes).
+#
+ECOBEE_POOL_SIZE = 2        # Max connections kept open to api.ecobee.com
+ECOBEE_POOL_RECONNECTS = 1  # Times to reconnect if a pooled connection has gone stale
+ECOBEE_CONNECT_TIMEOUT = 5.0 # seconds to connect to api.ecobee.com
+ECOBEE_READ_TIMEOUT = 15.0   # seconds to wait for (each part of) the reply
+
+g_session = None
+g_session_lock = threading.Lock()
+
+def ecobee_get_session() :
+    """Return the shared Ecobee session, creating it if needed"""
+    global g_session
+    with g_session_lock :
+        if g_session is None :
+            g_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=ECOBEE_POOL_SIZE)
+            g_session.mount('https://', adapter)
+            g_session.mount('http://', adapter)
+        return g_session
+
+def ecobee_close_session() :
+    """Close the shared Ecobee session"""
+    global g_session
+    with g_session_lock :
+        if g_session is not None :
+            g_session.close()
+            g_session = None
+
+def ecobee_request(method, url, **kwargs) :
+    """Make a request to the Ecobee API over the shared session"""
+    # If the server dropped one of our idle connections, try again.  urllib3
+    # has already thrown the dead connection away, so the retry gets a fresh
+    # one.  The session itself is shared with the other threads (the poller,
+    # the sinks, the token refresh), so it's never closed here.
+    #
+    # Every call has a connect and read timeout, cut down to what's left of
+    # the action's time budget (see wg_deadline).  Once the budget is used up
+    # this raises WgDeadlineExceeded instead of making the call.
+    tries = 0
+    with wg_latency_span("ecobee " + method + " " + urlparse(url).path) :
+        while True :
+            kwargs['timeout'] = wg_deadline_timeout(ECOBEE_CONNECT_TIMEOUT, ECOBEE_READ_TIMEOUT)
+            try :
+                return ecobee_get_session().request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError :
+                if tries >= ECOBEE_POOL_RECONNECTS :
+                    raise
+                tries += 1
 
 ###############################################################################
 #
@@ -65,33 +139,94 @@ if APP_WEATHERPI :
 
 tok_file_name = "token_storage.txt"
 
+#
+# The tokens are read from tok_file_name once and then kept in memory.  When we
+# get new tokens we remember when the access token expires and refresh it (on a
+# background timer) ECOBEE_TOKEN_REFRESH_MARGIN seconds before that happens.
+#
+ECOBEE_TOKEN_REFRESH_MARGIN = 300 # seconds
+ECOBEE_TOKEN_RETRY_DELAY = 60     # seconds to wait before retrying a failed refresh
+
+g_acctoken = None
+g_reftoken = None
+g_token_lock = threading.Lock()
+g_refresh_timer = None
+
 def ecobee_get_saved_tokens(trace) :
     """Get the saved access and refresh tokens"""
     # Obtain access token and refresh token
     # Read the tokens from a temporary storage file
     # The file should contain an accesstoken on the first line and a refresh token on the
     # second line
-    acctoken = ' '
-    reftoken = ' '
-    if os.path.isfile(tok_file_name) :
-        # we have stored tokens
-        tok_file = open(tok_file_name, "r")
-        acctoken = tok_file.readline().replace('\n', '')
-        reftoken = tok_file.readline().replace('\n', '')
-    return acctoken, reftoken
-    
+    global g_acctoken, g_reftoken
+    with g_token_lock :
+        if g_acctoken is None :
+            g_acctoken = ' '
+            g_reftoken = ' '
+            if os.path.isfile(tok_file_name) :
+                # we have stored tokens
+                with wg_latency_span("ecobee token file"), open(tok_file_name, "r") as tok_file :
+                    g_acctoken = tok_file.readline().replace('\n', '')
+                    g_reftoken = tok_file.readline().replace('\n', '')
+        return g_acctoken, g_reftoken
+
+def ecobee_save_tokens(acctoken, reftoken, expires_in, trace) :
+    """Remember new tokens, store them in the token file and schedule their refresh"""
+    global g_acctoken, g_reftoken
+    with g_token_lock :
+        g_acctoken = acctoken
+        g_reftoken = reftoken
+        # Write to a temporary file and rename it so a crash can't leave us
+        # with a half written token file
+        tmp_name = tok_file_name + ".tmp"
+        with open(tmp_name, "w") as tok_file :
+            tok_file.write(acctoken)
+            tok_file.write('\n')
+            tok_file.write(reftoken)
+            tok_file.write('\n')
+            tok_file.flush()
+            os.fsync(tok_file.fileno())
+        os.replace(tmp_name, tok_file_name)
+    if expires_in is not None :
+        ecobee_schedule_token_refresh(max(expires_in - ECOBEE_TOKEN_REFRESH_MARGIN, 0), trace)
+
+def ecobee_refresh_tokens(trace) :
+    """Refresh the tokens (runs on the refresh timer)"""
+    if authorize_app_with_ecobee(trace) != TSTAT_SUCCESS :
+        wg_error_print("ecobee_refresh_tokens", "Unable to refresh tokens, will try again")
+        ecobee_schedule_token_refresh(ECOBEE_TOKEN_RETRY_DELAY, trace)
+
+def ecobee_schedule_token_refresh(delay, trace) :
+    """Refresh the tokens in delay seconds"""
+    global g_refresh_timer
+    with g_token_lock :
+        if g_refresh_timer is not None :
+            g_refresh_timer.cancel()
+        g_refresh_timer = threading.Timer(delay, ecobee_refresh_tokens, args=(trace,))
+        g_refresh_timer.daemon = True
+        g_refresh_timer.start()
+
+def ecobee_stop_token_refresh() :
+    """Cancel any scheduled token refresh"""
+    global g_refresh_timer
+    with g_token_lock :
+        if g_refresh_timer is not None :
+            g_refresh_timer.cancel()
+            g_refresh_timer = None
+
 def authorize_app_with_ecobee(trace) :
     """Authorize the application"""
     try :
         acctoken, reftoken = ecobee_get_saved_tokens(trace)
         if reftoken == " " :
             # First time through, we don't have a refresh token yet
-            url = ('https://api.ecobee.com/token?grant_type=ecobeePin&code=' + authcode +
-                   '&client_id=' + ECOBEE_KEY)
-            pman = PoolManager()
-            ret = pman.request_encode_url('POST', url)
-            retval = json.loads(ret.data.decode('utf-8'))
-            wg_trace_pprint(json.dumps(retval, indent=4), trace)
+            params = {
+                'grant_type': 'ecobeePin',
+                'code': authcode,
+                'client_id': ECOBEE_KEY
+            }
+            retval = ecobee_request('POST', ECOBEE_TOKEN_URL, params=params).json()
+            wg_trace_json(retval, trace)
             if retval.get('error_description') != None  :
                 wg_error_print("authorize_app_with_ecobee",
                                "Error with access_token call")
@@ -102,13 +237,12 @@ def authorize_app_with_ecobee(trace) :
             reftoken = retval['refresh_token']       
         else :
             # We have a refresh token, refresh the authorization
-            url = "https://api.ecobee.com/token"
             data = {
                 'grant_type': 'refresh_token',
                 'code': reftoken,
                 'client_id': ECOBEE_KEY
             }
-            retval = requests.post(url, data=data).json()
+            retval = ecobee_request('POST', ECOBEE_TOKEN_URL, data=data).json()
             if retval.get('error_description') != None  :
                 wg_error_print("authorize_app_with_ecobee",
                                "Error with refresh_token call")
@@ -117,72 +251,578 @@ def authorize_app_with_ecobee(trace) :
                 return TSTAT_ERROR
             acctoken = retval['access_token']
             reftoken = retval['refresh_token']
-        # Write the two tokens to the temporary storage file
-        tok_file = open(tok_file_name, "w")
-        tok_file.write(acctoken)
-        tok_file.write('\n')
-        tok_file.write(reftoken)
-        tok_file.write('\n')
+        # Keep the two tokens and write them to the temporary storage file
+        ecobee_save_tokens(acctoken, reftoken, retval.get('expires_in'), trace)
         return TSTAT_SUCCESS
     except Exception as e:
         wg_error_print("authorize_app_with_ecobee", str(e))
         print(traceback.format_tb(e.__traceback__))
         return TSTAT_ERROR
+
+def ecobee_shutdown() :
+    """Stop the poller and token refresh and close the connections (call at shutdown)"""
+    ecobee_stop_poller()
+    ecobee_stop_token_refresh()
+    ecobee_close_session()
         
-def get_tstat_data(trace, count) :
+###############################################################################
+#
+# Selections.
+#
+# The Ecobee only sends back the sections of the thermostat object that are
+# asked for, so each caller says which sections it needs and nothing else is
+# downloaded (or parsed).
+#
+ECOBEE_SECTIONS = {
+    'runtime'  : 'includeRuntime',
+    'settings' : 'includeSettings',
+    'program'  : 'includeProgram',
+    'events'   : 'includeEvents'
+}
+ECOBEE_ALL_SECTIONS = ('runtime', 'settings', 'program', 'events')
+ECOBEE_STATUS_SECTIONS = ('runtime', 'settings', 'events') # used by ecobee_get_status
+ECOBEE_PROGRAM_SECTIONS = ('program',)                     # used by the climate helpers
+
+def ecobee_selection(sections, ids=None) :
+    """Build a selection for our thermostats including only the given sections"""
+    #
+    # ids is a list of thermostat identifiers.  If it isn't given,
+    # ECOBEE_THERMOSTAT_IDS is used.
+    #
+    if ids is None :
+        ids = ECOBEE_THERMOSTAT_IDS
+    if ids :
+        selection = {
+            'selectionType'  : 'thermostats',
+            'selectionMatch' : ','.join(ids)
+        }
+    else :
+        selection = {
+            'selectionType'  : 'registered',
+            'selectionMatch' : ''
+        }
+    for section in sections :
+        selection[ECOBEE_SECTIONS[section]] = True
+    return selection
+
+###############################################################################
+#
+# Decide what to do about a reply from the Ecobee.  Expired tokens can be
+# refreshed, server errors (5xx), timeouts and failed calls are worth trying
+# again, anything else (4xx, bad selection, ...) won't get better by retrying.
+# The HTTP status of each reply is kept in its status as 'http'.
+#
+def ecobee_parse_reply(text, http) :
+    """Turn the body of an API reply into the reply dict, noting the HTTP status"""
+    try :
+        retval = json.loads(text)
+    except ValueError :
+        retval = None
+    if not isinstance(retval, dict) or not isinstance(retval.get('status'), dict) :
+        # e.g. an error page from a proxy
+        retval = {'status' : {'code' : ECOBEE_CODE_NO_REPLY,
+                              'message' : "Unexpected reply (HTTP " + str(http) + ")"}}
+    retval['status']['http'] = http
+    return retval
+
+def ecobee_classify(retval) :
+    """Return the WG_RETRY_ value that goes with an Ecobee reply"""
+    code = retval.get('status').get('code')
+    http = retval.get('status').get('http') # None if the call itself failed
+    if code == ECOBEE_CODE_SUCCESS :
+        return WG_RETRY_DONE
+    if code == ECOBEE_CODE_TOKEN_EXPIRED :
+        return WG_RETRY_REFRESH
+    if http is not None and http >= 500 :
+        return WG_RETRY_AGAIN
+    if http is not None and http >= 400 :
+        return WG_RETRY_FAIL
+    if code in (ECOBEE_CODE_PROCESSING_ERROR, ECOBEE_CODE_NO_REPLY) :
+        return WG_RETRY_AGAIN
+    return WG_RETRY_FAIL
+
+def ecobee_headers(method, trace) :
+    """Headers for a call to the thermostat API"""
+    acctoken, reftoken = ecobee_get_saved_tokens(trace)
+    if method == 'GET' :
+        content_type = 'text/json'
+    else :
+        content_type = 'application/json;charset=UTF-8'
+    headers = {
+        'Content-Type'  : content_type,
+        'Authorization' : 'Bearer ' + acctoken
+    }
+    return headers
+
+def ecobee_api_call(method, data, trace, url=None) :
+    """Call the thermostat API, refreshing the tokens once if they have expired"""
+    if url is None :
+        url = ECOBEE_URL
+    refreshed = False
+    while True :
+        headers = ecobee_headers(method, trace)
+        try :
+            reply = ecobee_request(method, url, params=data, headers=headers)
+            retval = ecobee_parse_reply(reply.text, reply.status_code)
+        except Exception as e:
+            wg_error_print("ecobee_api_call", str(e))
+            return {'status' : {'code' : ECOBEE_CODE_NO_REPLY, 'message' : str(e)}}
+        if ecobee_classify(retval) != WG_RETRY_REFRESH or refreshed :
+            return retval
+        wg_trace_print("Ecobee tokens are expired.  Refreshing them.", True)
+        authorize_app_with_ecobee(trace)
+        refreshed = True
+
+def ecobee_read_request(sections) :
+    """Request to read the given sections of the thermostats"""
+    data = {
+        "format" : "json",
+        "body"   : json.dumps({'selection' : ecobee_selection(sections)},
+                              separators=(',', ':'))
+    }
+    return data
+
+def get_tstat_data(trace, sections=ECOBEE_ALL_SECTIONS) :
     """ Get current thermostat runtimes"""
-    try: 
-        if count <= NUM_TRIES :
-            acctoken, reftoken = ecobee_get_saved_tokens(trace)
-            headers = {
-                'Content-Type'  : 'text/json',
-                'Authorization' : 'Bearer ' + acctoken
-            }
-            data = {
-                "format" : "json",
-                "body"   : ('{' +
-                                '"selection" : {' +
-                                    '"selectionType"   : "registered",' + 
-                                    '"selectionMatch"  : "",' +
-                                    '"includeRuntime"  : true,' +
-                                    '"includeSettings" : true,' +
-                                    '"includeProgram"  : true,' +
-                                    '"includeEvents"   : true'
-                                '}' +
-                             '}')
-            }
-            retval = requests.request('GET', ECOBEE_URL, params=data, headers=headers).json()
-            if retval.get('status').get('code') == 0 :
-                return retval
-            elif retval.get('status').get('code') == 14 : # token expired refresh
-                wg_trace_print("Ecobee tokens are expired.  Refreshing them.", True)
-                authorize_app_with_ecobee(trace)
-                return get_tstat_data(trace, count + 1)
-            else :
-                wg_trace_print("Uunable to get tstat data, trying again in 5 seconds.", trace)
-                wg_trace_pprint(json.dumps(retval, indent=4), True)
-            sleep(5)
-        return retval # all we can do is pass along the error
-    except Exception as e:
-        wg_error_print("get_tstat_data", str(e))
-        print(traceback.format_tb(e.__traceback__))
-        retval = {'status' : {'code' : 999}}
-        return retval
-  
-def ecobee_get_status(trace) :
+    retval = ecobee_api_call('GET', ecobee_read_request(sections), trace)
+    if retval.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        wg_trace_print("Unable to get tstat data.", trace)
+        wg_trace_json(retval, True)
+    return retval # on error, all we can do is pass it along
+
+###############################################################################
+#
+# Snapshot cache.
+#
+# ecobee_get_status and the lowest/highest setting helpers all need thermostat
+# data.  Rather than each one doing its own GET, the sections we've read are
+# kept for ECOBEE_CACHE_TTL seconds and shared between them.  Only the sections
+# that are missing or too old are fetched, and they are merged into the cached
+# snapshot.  Anything that changes the thermostat throws the sections it can
+# change away.  None of the functions we send change the program, and it
+# rarely changes otherwise, so it's kept longer.
+#
+ECOBEE_CACHE_TTL = 30.0          # seconds
+ECOBEE_PROGRAM_CACHE_TTL = 900.0 # seconds
+ECOBEE_SECTION_TTLS = {'program' : ECOBEE_PROGRAM_CACHE_TTL} # others get ECOBEE_CACHE_TTL
+
+g_cache = None
+g_cache_times = {}  # section -> time.monotonic() when it was last read
+g_cache_hits = 0
+g_cache_misses = 0
+g_cache_lock = threading.Lock()
+
+def ecobee_merge_snapshot(snapshot, tstat_data) :
+    """Merge the sections in tstat_data into snapshot and return the result"""
+    if snapshot is None :
+        return tstat_data
+    cached = {}
+    for tstat in snapshot.get('thermostatList') :
+        cached[tstat.get('identifier')] = tstat
+    tstat_list = []
+    for tstat in tstat_data.get('thermostatList') :
+        old = cached.get(tstat.get('identifier'))
+        if old is None :
+            # A thermostat we haven't seen, the old snapshot is no good
+            return tstat_data
+        # Copy rather than update so anyone holding the old snapshot isn't affected
+        new = dict(old)
+        new.update(tstat)
+        tstat_list.append(new)
+    merged = dict(tstat_data)
+    merged['thermostatList'] = tstat_list
+    return merged
+
+def ecobee_check_snapshot(sections) :
+    """Return the cached snapshot and the list of sections that need to be (re)read"""
+    global g_cache_hits, g_cache_misses
+    with g_cache_lock :
+        now = time.monotonic()
+        missing = []
+        for section in sections :
+            ttl = ECOBEE_SECTION_TTLS.get(section, ECOBEE_CACHE_TTL)
+            if g_poll_interval is not None :
+                # The poller vouches for the sections it has checked
+                ttl = max(ttl, g_poll_interval + ECOBEE_POLL_SLACK)
+            if g_cache is None or section not in g_cache_times or now - g_cache_times[section] > ttl :
+                missing.append(section)
+        if missing :
+            g_cache_misses += 1
+        else :
+            g_cache_hits += 1
+        return g_cache, missing
+
+def ecobee_store_snapshot(tstat_status, sections, started=None) :
+    """Merge a good reply covering sections into the cache and return the new snapshot"""
+    #
+    # started is the time.monotonic() value from before the read.  If it's
+    # given, the read is also used to verify the writes made before then.
+    #
+    global g_cache
+    if tstat_status.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        return tstat_status
+    with g_cache_lock :
+        merged = ecobee_merge_snapshot(g_cache, tstat_status)
+        if merged is tstat_status :
+            g_cache_times.clear()
+        g_cache = merged
+        now = time.monotonic()
+        for section in sections :
+            g_cache_times[section] = now
+    if started is not None :
+        ecobee_verify_snapshot(merged, sections, started)
+    return merged
+
+def ecobee_get_snapshot(trace, sections=ECOBEE_ALL_SECTIONS) :
+    """Get the thermostat data for the given sections, from the cache if fresh enough"""
+    snapshot, missing = ecobee_check_snapshot(sections)
+    if snapshot is not None and not missing :
+        return snapshot
+    started = time.monotonic()
+    return ecobee_store_snapshot(get_tstat_data(trace, missing), missing, started)
+
+def ecobee_invalidate_snapshot(sections=None) :
+    """Throw away the cached thermostat data (just the given sections, if any)"""
+    global g_cache
+    with g_cache_lock :
+        if sections is None :
+            g_cache = None
+            g_cache_times.clear()
+        else :
+            for section in sections :
+                g_cache_times.pop(section, None)
+
+def ecobee_thermostats_written(functions=(), ids=None, trace=False, tries=0) :
+    """Call after a write that changed the thermostats (functions is what was
+    sent, if the Ecobee accepted it)"""
+    # What we have of the changed sections is out of date, and the poller
+    # (if it's running) should pick up the new revisions soon
+    ecobee_invalidate_snapshot(ECOBEE_STATUS_SECTIONS)
+    ecobee_expect(functions, ids, trace, tries)
+    ecobee_poll_soon()
+
+def ecobee_cache_stats() :
+    """Return the cache hit/miss counts and the age of each cached section"""
+    with g_cache_lock :
+        now = time.monotonic()
+        stats = {
+            'hits'   : g_cache_hits,
+            'misses' : g_cache_misses,
+            'age'    : {}
+        }
+        for section, when in g_cache_times.items() :
+            stats['age'][section] = now - when
+    return stats
+
+###############################################################################
+#
+# Revision poller.
+#
+# thermostatSummary returns a short revision string for each thermostat:
+#     identifier:name:connected:thermostatRev:alertsRev:runtimeRev:intervalRev
+# thermostatRev changes when the settings, program or holds (events) change
+# and runtimeRev when the temperatures and equipment status do.  ecobee_poll
+# asks for these (a tiny request), re-reads only the sections whose revision
+# changed and merges them into the snapshot cache.  The cached sections that
+# didn't change are marked fresh again, so while the poller is running readers
+# use the cache rather than doing their own fetches.
+#
+ECOBEE_POLL_INTERVAL = 180.0 # seconds (Ecobee asks for no more than every 3 minutes)
+ECOBEE_POLL_SLACK = 30.0     # how late a poll can be before the cache is no longer trusted
+ECOBEE_POLL_WRITE_DELAY = 2.0 # after a write, poll this soon (give the Ecobee time to apply it)
+ECOBEE_REVISION_SECTIONS = {
+    # position in the revision string -> the sections it covers
+    3 : ('settings', 'program', 'events'), # thermostatRev
+    5 : ('runtime',)                       # runtimeRev
+}
+
+g_revisions = None      # identifier -> revision fields from the last good poll
+g_poll_interval = None  # set while the poller is running
+g_poll_thread = None
+g_poll_stop = threading.Event()
+g_poll_wake = threading.Event()
+g_poll_stats = {'polls' : 0, 'changes' : 0, 'errors' : 0}
+g_poll_lock = threading.Lock()
+
+def ecobee_summary_request() :
+    """Request for the revisions of the thermostats"""
+    data = {
+        "format" : "json",
+        "body"   : json.dumps({'selection' : ecobee_selection(())}, separators=(',', ':'))
+    }
+    return data
+
+def ecobee_get_revisions(trace) :
+    """Return {identifier: revision fields} for our thermostats (None on error)"""
+    retval = ecobee_api_call('GET', ecobee_summary_request(), trace, ECOBEE_SUMMARY_URL)
+    if retval.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        wg_trace_print("Unable to get thermostat revisions.", trace)
+        wg_trace_json(retval, True)
+        return None
+    revisions = {}
+    for revision in retval.get('revisionList', []) :
+        fields = revision.split(':')
+        revisions[fields[0]] = fields
+    wg_trace_json(revisions, trace)
+    return revisions
+
+def ecobee_changed_sections(old, new) :
+    """The sections to re-read going from the old revisions to the new ones"""
+    if old is None or set(old) != set(new) :
+        return set(ECOBEE_ALL_SECTIONS) # first poll or the thermostats changed
+    changed = set()
+    for identifier, fields in new.items() :
+        for position, sections in ECOBEE_REVISION_SECTIONS.items() :
+            if fields[position] != old[identifier][position] :
+                changed.update(sections)
+    return changed
+
+def ecobee_poll(trace) :
+    """Check the revisions and re-read what changed.  Returns the sections read
+    (None on error)"""
+    global g_revisions
+    started = time.monotonic()
+    revisions = ecobee_get_revisions(trace)
+    with g_poll_lock :
+        g_poll_stats['polls'] += 1
+        if revisions is None :
+            g_poll_stats['errors'] += 1
+            return None
+        old = g_revisions
+    changed = ecobee_changed_sections(old, revisions)
+    with g_cache_lock :
+        if g_cache is None :
+            changed = set(ECOBEE_ALL_SECTIONS)
+        # A write throws away what it changes, and its revision may not have
+        # moved yet, so re-read those too
+        changed.update(section for section in ECOBEE_ALL_SECTIONS
+                       if section not in g_cache_times)
+        # The sections we have that didn't change are good for another interval
+        now = time.monotonic()
+        for section in g_cache_times :
+            if section not in changed :
+                g_cache_times[section] = now
+    sections = [section for section in ECOBEE_ALL_SECTIONS if section in changed]
+    if sections :
+        tstat_data = ecobee_store_snapshot(get_tstat_data(trace, sections), sections)
+        if tstat_data.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+            with g_poll_lock :
+                g_poll_stats['errors'] += 1
+            return None # keep the old revisions so the next poll tries again
+        wg_trace_print("Ecobee revisions changed, re-read %s", trace, sections)
+    with g_poll_lock :
+        g_revisions = revisions
+        if sections :
+            g_poll_stats['changes'] += 1
+    # Only what was just read can confirm a write, the rest stays pending
+    with g_cache_lock :
+        snapshot = g_cache
+    ecobee_verify_snapshot(snapshot, sections, started)
+    ecobee_update_shadow(started)
+    return sections
+
+def ecobee_poller(interval, on_change, trace) :
+    """Poll every interval seconds until ecobee_stop_poller (the poller thread)"""
+    while True :
+        if g_poll_wake.wait(interval) :
+            g_poll_wake.clear()
+            g_poll_stop.wait(ECOBEE_POLL_WRITE_DELAY)
+        if g_poll_stop.is_set() :
+            return
+        try :
+            sections = ecobee_poll(trace)
+            if sections and on_change is not None :
+                on_change(sections)
+        except Exception as e:
+            wg_error_print("ecobee_poller", str(e))
+
+def ecobee_start_poller(trace, interval=ECOBEE_POLL_INTERVAL, on_change=None) :
+    """Start polling the revisions in the background"""
+    #
+    # on_change(sections) is called (on the poller thread) after a poll that
+    # re-read something.
+    #
+    global g_poll_thread, g_poll_interval
+    ecobee_stop_poller()
+    ecobee_poll(trace) # start out with fresh data and revisions
+    with g_poll_lock :
+        g_poll_stop.clear()
+        g_poll_wake.clear()
+        g_poll_interval = interval
+        g_poll_thread = threading.Thread(target=ecobee_poller, name="ecobee_poller",
+                                         args=(interval, on_change, trace), daemon=True)
+        g_poll_thread.start()
+
+def ecobee_stop_poller() :
+    """Stop the background poller (if it's running)"""
+    global g_poll_thread, g_poll_interval, g_revisions
+    with g_poll_lock :
+        thread = g_poll_thread
+        g_poll_thread = None
+        g_poll_interval = None
+        g_revisions = None
+        g_poll_stop.set()
+        g_poll_wake.set()
+    if thread is not None and thread is not threading.current_thread() :
+        thread.join()
+
+def ecobee_poll_soon() :
+    """Have the poller (if it's running) check the revisions shortly"""
+    if g_poll_thread is not None :
+        g_poll_wake.set()
+
+def ecobee_poll_stats() :
+    """Return the poll counts and the revisions last seen"""
+    with g_poll_lock :
+        stats = dict(g_poll_stats)
+        stats['running'] = g_poll_thread is not None
+        stats['revisions'] = dict(g_revisions or {})
+    stats['shadow_age'] = ecobee_shadow_age()
+    return stats
+
+###############################################################################
+#
+# Shadow.
+#
+# What the arm/disarm code needs to decide what to do (tmode, hold, t_heat and
+# the program) for each thermostat, kept up to date by the poller (each good
+# poll confirms it, even when nothing changed) so the decision doesn't have to
+# wait on a cloud read.  Only the write goes to the network.
+#
+# The shadow knows how old it is.  If it's older than ECOBEE_SHADOW_MAX_AGE
+# (the poller has stopped or the Ecobee isn't answering), the policy says what
+# ecobee_get_shadow does:
+#     ECOBEE_SHADOW_READ - read the thermostats now (what we did before there
+#                          was a shadow) and fail if that doesn't work
+#     ECOBEE_SHADOW_ACT  - use what we have anyway (but fail if there's nothing)
+#     ECOBEE_SHADOW_FAIL - fail, the caller has to try again later
+#
+ECOBEE_SHADOW_MAX_AGE = 2 * ECOBEE_POLL_INTERVAL + ECOBEE_POLL_SLACK # seconds
+ECOBEE_SHADOW_READ = "read"
+ECOBEE_SHADOW_ACT = "act"
+ECOBEE_SHADOW_FAIL = "fail"
+ECOBEE_SHADOW_POLICY = ECOBEE_SHADOW_READ
+
+g_shadow = {}         # identifier -> {'tmode', 'hold', 't_heat', 'fmode', 'schedule'}
+g_shadow_time = None  # time.monotonic() when the shadow was last confirmed
+g_shadow_lock = threading.Lock()
+
+def ecobee_update_shadow(started) :
+    """Rebuild the shadow from the snapshot cache (after a good poll that
+    started at started)"""
+    global g_shadow, g_shadow_time
+    with g_cache_lock :
+        snapshot = g_cache
+    if snapshot is None :
+        return
+    shadow = {}
+    for tstat in snapshot.get('thermostatList') :
+        if tstat.get('settings') is None or tstat.get('runtime') is None :
+            return # someone else's partial read, the next poll will fill it in
+        status = ecobee_parse_thermostat(tstat)
+        shadow[tstat.get('identifier')] = {
+            'tmode'    : status.get('tmode'),
+            'hold'     : status.get('hold'),
+            't_heat'   : status.get('t_heat'),
+            'fmode'    : status.get('fmode'),
+            'schedule' : ecobee_schedule_index(tstat)
+        }
+    # Writes made after the poll started aren't in what it read yet
+    with g_verify_lock :
+        for ident, pending in g_expected.items() :
+            if ident in shadow and pending['written'] > started :
+                shadow[ident] = ecobee_shadow_apply(shadow[ident], pending['values'])
+    with g_shadow_lock :
+        g_shadow = shadow
+        g_shadow_time = time.monotonic()
+
+def ecobee_shadow_apply(entry, values) :
+    """A shadow entry with the values a write should have set"""
+    entry = dict(entry, **values)
+    if values.get('hold') == HOLD_DISABLED and entry['schedule'] is not None :
+        # Back on the program, so back to its setting for right now
+        day, minute = ecobee_today()
+        entry['t_heat'] = entry['schedule'].heat[EcobeeScheduleIndex.slot(day, minute)]
+    return entry
+
+def ecobee_shadow_age() :
+    """Seconds since the shadow was last confirmed (None if there isn't one)"""
+    with g_shadow_lock :
+        if g_shadow_time is None :
+            return None
+        return time.monotonic() - g_shadow_time
+
+def ecobee_get_shadow(trace, max_age=None, policy=None) :
+    """Return the shadow of our thermostats, by thermostat identifier"""
+    #
+    # Each entry is a copy, with its 'age' in seconds.  On failure the only
+    # entry is 'error'.
+    #
+    if max_age is None :
+        max_age = ECOBEE_SHADOW_MAX_AGE
+    if policy is None :
+        policy = ECOBEE_SHADOW_POLICY
+    age = ecobee_shadow_age()
+    if age is None or age > max_age :
+        if policy == ECOBEE_SHADOW_READ :
+            wg_trace_print("Ecobee shadow is %s seconds old, reading the thermostats", trace, age)
+            if ecobee_poll(trace) is None :
+                return {'error' : "Unable to refresh the thermostat shadow"}
+        elif policy == ECOBEE_SHADOW_FAIL or age is None :
+            return {'error' : "Thermostat shadow is too old"}
+        else :
+            wg_trace_print("Using a %d second old Ecobee shadow", True, age)
+    with g_shadow_lock :
+        if g_shadow_time is None :
+            # The read worked but didn't give us a whole shadow (a partial entry)
+            return {'error' : "No thermostat shadow"}
+        age = time.monotonic() - g_shadow_time
+        retval = {}
+        for ident, entry in g_shadow.items() :
+            retval[ident] = dict(entry, age=age)
+    return retval
+
+def ecobee_get_status(trace, prefetch=()) :
     """Get the status of the thermostat"""
-    retval = {} # This will have all the values we will return
+    #
+    # prefetch is any other sections (e.g. ECOBEE_PROGRAM_SECTIONS) the caller is
+    # about to need.  They are read in the same request and cached.
+    #
+    tstat_status = ecobee_get_snapshot(trace, ECOBEE_STATUS_SECTIONS + tuple(prefetch))
+    return ecobee_parse_status(tstat_status, trace)
+
+def ecobee_get_status_all(trace, prefetch=()) :
+    """Get the status of all our thermostats, by thermostat identifier"""
+    #
+    # All the thermostats are read in one request.  If it fails, the only
+    # entry is 'error'.
+    #
+    tstat_status = ecobee_get_snapshot(trace, ECOBEE_STATUS_SECTIONS + tuple(prefetch))
+    wg_trace_json(tstat_status, trace)
+    if tstat_status.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        return {'error' : "get_tstat_data failed!"}
+    retval = {}
+    for tstat in tstat_status.get('thermostatList') :
+        retval[tstat.get('identifier')] = ecobee_parse_thermostat(tstat)
+    wg_trace_json(retval, trace)
+    return retval
 
-    tstat_status = get_tstat_data(trace, 1)
-    wg_trace_pprint(json.dumps(tstat_status, indent=4), trace)
+def ecobee_parse_status(tstat_status, trace) :
+    """Turn the (first) thermostat's data into the status values we return"""
+    wg_trace_json(tstat_status, trace)
     if not tstat_status.get('status').get('code') == 0 :
         # error.  Try to get out gracefully
-        retval['error'] = "get_tstat_data failed!"
-        wg_trace_pprint(json.dumps(tstat_status, indent=4), True)
-        return retval
+        wg_trace_json(tstat_status, True)
+        return {'error' : "get_tstat_data failed!"}
+
+    retval = ecobee_parse_thermostat(tstat_status.get('thermostatList')[0])
+    wg_trace_json(retval, trace)
+    return retval
+
+def ecobee_parse_thermostat(tstat) :
+    """Turn one thermostat's data into the status values we return"""
+    retval = {} # This will have all the values we will return
 
-    tstat = tstat_status.get('thermostatList')[0]
-    
     # tmode - Current thermostat mode setting
     status_str = tstat.get('settings').get('hvacMode')
     if status_str == "auto" :
@@ -225,112 +865,432 @@ def ecobee_get_status(trace) :
                 retval['hold'] = HOLD_ENABLED
                 break
     
-    wg_trace_pprint(json.dumps(retval, indent=4), trace)
-    
     return retval
 
-def ecobee_get_todays_highest_setting(trace) :
-    """Get the setting for when we are here"""
-    retval = TSTAT_ERROR
-    tstat_status = get_tstat_data(trace, 1)
-    wg_trace_pprint(json.dumps(tstat_status, indent=4), trace)
+def ecobee_get_climate_settings(climate_name, trace) :
+    """Get the heat setting for the named climate on each thermostat, by identifier"""
+    retval = {}
+    tstat_status = ecobee_get_snapshot(trace, ECOBEE_PROGRAM_SECTIONS)
+    wg_trace_json(tstat_status, trace)
+    if tstat_status.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        return retval
     
-    # Current thermostat mode setting
-    climates = tstat_status.get('thermostatList')[0].get('program').get('climates')
-    for climate in climates :
-        if climate.get('name') == "Home" :
-            retval = int(climate.get('heatTemp'))
+    for tstat in tstat_status.get('thermostatList') :
+        retval[tstat.get('identifier')] = TSTAT_ERROR
+        climates = tstat.get('program').get('climates')
+        for climate in climates :
+            if climate.get('name') == climate_name :
+                retval[tstat.get('identifier')] = int(climate.get('heatTemp'))
     return retval
 
-def ecobee_get_todays_lowest_setting(trace) :
-    """Get the setting for when we are away"""
-    retval = TSTAT_ERROR
-    tstat_status = get_tstat_data(trace, 1)
-    wg_trace_pprint(json.dumps(tstat_status, indent=4), trace)
-    
-    # Current thermostat mode setting
-    climates = tstat_status.get('thermostatList')[0].get('program').get('climates')
-    for climate in climates :
-        if climate.get('name') == "Away" :
-            retval = int(climate.get('heatTemp'))
+def ecobee_get_first_setting(settings) :
+    """The setting for the first thermostat, TSTAT_ERROR if there isn't one"""
+    for setting in settings.values() :
+        return setting
+    return TSTAT_ERROR
+
+###############################################################################
+#
+# Write verification.
+#
+# A write that the Ecobee accepts is assumed to have worked: the shadow is
+# updated right away and what the write should have done (e.g. hold enabled
+# at 62.0) is remembered.  It's checked against the next read that covers it
+# (the poll the write sets off, or anyone's status read), so there's no extra
+# request per write.  If the thermostat disagrees the write is sent again
+# (ECOBEE_VERIFY_RETRIES times) and then it's logged as an error.
+#
+ECOBEE_VERIFY_RETRIES = 1
+ECOBEE_VERIFY_MAX_AGE = 900.0 # seconds, give up on a check no read has covered by then
+ECOBEE_VERIFY_FUNCTIONS = ('setHold', 'resumeProgram') # what's re-sent (not the alerts)
+ECOBEE_VERIFY_SECTIONS = {
+    # status value -> the section it comes from
+    'hold'   : 'events',
+    't_heat' : 'runtime',
+    'fmode'  : 'runtime'
+}
+
+g_expected = {}  # identifier -> {'values', 'functions', 'written', 'tries', 'trace'}
+g_verify_stats = {'expected' : 0, 'verified' : 0, 'mismatches' : 0, 'retries' : 0,
+                  'failed' : 0, 'expired' : 0}
+g_verify_lock = threading.Lock()
+
+def ecobee_function_expects(functions) :
+    """The status values a list of functions should leave the thermostat with"""
+    expected = {}
+    for function in functions :
+        params = function.get('params', {})
+        if function.get('type') == 'setHold' :
+            expected['hold'] = HOLD_ENABLED
+            if 'heatHoldTemp' in params :
+                expected['t_heat'] = int(params['heatHoldTemp'])
+            if params.get('fan') == 'on' :
+                expected['fmode'] = FAN_ON
+        elif function.get('type') == 'resumeProgram' :
+            expected = {'hold' : HOLD_DISABLED} # the program decides the rest
+    return expected
+
+def ecobee_selected_ids(ids) :
+    """The identifiers of the thermostats a write went to (as far as we know them)"""
+    if ids :
+        return list(ids)
+    if ECOBEE_THERMOSTAT_IDS :
+        return list(ECOBEE_THERMOSTAT_IDS)
+    with g_shadow_lock :
+        if g_shadow :
+            return list(g_shadow)
+    with g_cache_lock :
+        if g_cache is None :
+            return []
+        return [tstat.get('identifier') for tstat in g_cache.get('thermostatList')]
+
+def ecobee_expect(functions, ids, trace, tries=0) :
+    """Remember what a write should have done and update the shadow to match"""
+    values = ecobee_function_expects(functions)
+    if not values :
+        return
+    idents = ecobee_selected_ids(ids)
+    now = time.monotonic()
+    with g_verify_lock :
+        for ident in idents :
+            # A newer write replaces any check still pending for this thermostat
+            g_expected[ident] = {'values' : dict(values),
+                                 'functions' : [function for function in functions
+                                                if function.get('type') in ECOBEE_VERIFY_FUNCTIONS],
+                                 'written' : now, 'tries' : tries, 'trace' : trace}
+            g_verify_stats['expected'] += 1
+    with g_shadow_lock :
+        for ident in idents :
+            if ident in g_shadow :
+                g_shadow[ident] = ecobee_shadow_apply(g_shadow[ident], values)
+
+def ecobee_verify_snapshot(snapshot, sections, started) :
+    """Check the pending writes against thermostat data read (starting at started)
+    after they were made"""
+    if snapshot is None or not g_expected :
+        return
+    if snapshot.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        return
+    resend = []
+    with g_verify_lock :
+        for tstat in snapshot.get('thermostatList') :
+            ident = tstat.get('identifier')
+            pending = g_expected.get(ident)
+            if pending is None or pending['written'] > started :
+                continue # nothing to check, or the read doesn't cover the write
+            if started - pending['written'] > ECOBEE_VERIFY_MAX_AGE :
+                del g_expected[ident]
+                g_verify_stats['expired'] += 1
+                continue
+            try :
+                status = ecobee_parse_thermostat(tstat)
+            except (AttributeError, TypeError, ValueError) :
+                continue # the cache doesn't have the sections yet
+            wrong = {}
+            for field, value in list(pending['values'].items()) :
+                if ECOBEE_VERIFY_SECTIONS[field] not in sections :
+                    continue
+                if status.get(field) == value :
+                    del pending['values'][field]
+                else :
+                    wrong[field] = (value, status.get(field))
+            if wrong :
+                del g_expected[ident]
+                g_verify_stats['mismatches'] += 1
+                resend.append((ident, pending, wrong))
+            elif not pending['values'] :
+                del g_expected[ident]
+                g_verify_stats['verified'] += 1
+                wg_trace_print("%s: write verified", pending['trace'], ident)
+    for ident, pending, wrong in resend :
+        if pending['tries'] < ECOBEE_VERIFY_RETRIES :
+            wg_error_print("ecobee_verify_snapshot",
+                           "%s: thermostat doesn't match the write (wanted, got) %s, sending it again",
+                           ident, wrong)
+            with g_verify_lock :
+                g_verify_stats['retries'] += 1
+            # Not on the reader's thread, it may be holding up an alarm event
+            threading.Thread(target=ecobee_post_functions, name="ecobee_verify",
+                             args=(pending['functions'], pending['trace'], [ident],
+                                   pending['tries'] + 1), daemon=True).start()
+        else :
+            wg_error_print("ecobee_verify_snapshot",
+                           "%s: thermostat doesn't match the write (wanted, got) %s",
+                           ident, wrong)
+            with g_verify_lock :
+                g_verify_stats['failed'] += 1
+
+def ecobee_verify_stats() :
+    """Return the verification counts and the number of checks still pending"""
+    with g_verify_lock :
+        stats = dict(g_verify_stats)
+        stats['pending'] = len(g_expected)
+    return stats
+
+###############################################################################
+#
+# Schedule index.  The program's schedule is 7 days (Monday first) of 48
+# half-hour slots, each naming the climate (by climateRef) that runs then.
+# The index lays that out as one list of 336 slots with the heat setting of
+# each, the lowest and highest heat setting scheduled each day and, for
+# every slot, the slot where the climate next changes.  After that, all the
+# lookups are just list indexing.
+#
+# An index is built per thermostat and only rebuilt when its program changes.
+#
+ECOBEE_SLOTS_PER_DAY = 48
+ECOBEE_SLOT_MINUTES = 30
+
+class EcobeeScheduleIndex() :
+    """Constant time lookups into a thermostat's program"""
+
+    def __init__(self, program) :
+        climates = {}
+        for climate in program.get('climates') :
+            climates[climate.get('climateRef')] = climate
+        self.climates = []  # climate of each slot
+        for day in program.get('schedule') :
+            if len(day) != ECOBEE_SLOTS_PER_DAY :
+                raise ValueError("Schedule day has " + str(len(day)) + " slots")
+            self.climates.extend(climates[ref] for ref in day)
+        if len(self.climates) != 7 * ECOBEE_SLOTS_PER_DAY :
+            raise ValueError("Schedule doesn't cover a week")
+        self.heat = [int(climate.get('heatTemp')) for climate in self.climates]
+        self.lowest_heat = []
+        self.highest_heat = []
+        for day in range(7) :
+            temps = self.heat[day * ECOBEE_SLOTS_PER_DAY : (day + 1) * ECOBEE_SLOTS_PER_DAY]
+            self.lowest_heat.append(min(temps))
+            self.highest_heat.append(max(temps))
+        # Go round the week backwards twice so the slots at the end of Sunday
+        # see the changes early Monday
+        slots = len(self.climates)
+        self.next_change = [None] * slots
+        change = None
+        for num in range(2 * slots - 1, -1, -1) :
+            slot = num % slots
+            after = (slot + 1) % slots
+            if self.climates[after] is not self.climates[slot] :
+                change = after
+            self.next_change[slot] = change
+
+    @staticmethod
+    def slot(day, minute) :
+        """The slot for a weekday (0 is Monday) and minutes past midnight"""
+        return day * ECOBEE_SLOTS_PER_DAY + minute // ECOBEE_SLOT_MINUTES
+
+    def lowest(self, day) :
+        """Lowest heat setting scheduled on a weekday"""
+        return self.lowest_heat[day]
+
+    def highest(self, day) :
+        """Highest heat setting scheduled on a weekday"""
+        return self.highest_heat[day]
+
+    def climate_at(self, day, minute) :
+        """The climate (dict from the program) scheduled at a time"""
+        return self.climates[self.slot(day, minute)]
+
+    def next_transition(self, day, minute) :
+        """(weekday, minute, climate) of the next change after a time, None if there isn't one"""
+        change = self.next_change[self.slot(day, minute)]
+        if change is None :
+            return None
+        return (change // ECOBEE_SLOTS_PER_DAY,
+                (change % ECOBEE_SLOTS_PER_DAY) * ECOBEE_SLOT_MINUTES,
+                self.climates[change])
+
+g_schedules = {}    # identifier -> (program, signature, EcobeeScheduleIndex)
+g_schedules_lock = threading.Lock()
+
+def ecobee_program_signature(program) :
+    """Something that changes when the schedule or climates do"""
+    return json.dumps([program.get('schedule'), program.get('climates')], sort_keys=True)
+
+def ecobee_schedule_index(tstat) :
+    """The schedule index for a thermostat's data, None if there's no usable program"""
+    ident = tstat.get('identifier')
+    program = tstat.get('program')
+    if program is None :
+        return None
+    with g_schedules_lock :
+        cached = g_schedules.get(ident)
+        if cached is not None and cached[0] is program :
+            return cached[2]   # the same data we built it from
+        signature = ecobee_program_signature(program)
+        if cached is not None and cached[1] == signature :
+            g_schedules[ident] = (program, signature, cached[2]) # re-read, but not changed
+            return cached[2]
+        try :
+            index = EcobeeScheduleIndex(program)
+        except (KeyError, TypeError, ValueError) as e :
+            wg_error_print("ecobee_schedule_index", "%s: Bad program: %s", ident, e)
+            index = None
+        g_schedules[ident] = (program, signature, index)
+        return index
+
+def ecobee_get_schedules(trace) :
+    """The schedule index for each thermostat, by identifier"""
+    retval = {}
+    tstat_status = ecobee_get_snapshot(trace, ECOBEE_PROGRAM_SECTIONS)
+    if tstat_status.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        return retval
+    for tstat in tstat_status.get('thermostatList') :
+        retval[tstat.get('identifier')] = ecobee_schedule_index(tstat)
     return retval
 
-def ecobee_control_fan(mode, trace) :
-    """Set thermostat hold and temp"""
-    acctoken, reftoken = ecobee_get_saved_tokens(trace)
-    headers = {
-        'Content-Type'  : 'application/json;charset=UTF-8',
-        'Authorization' : 'Bearer ' + acctoken
+def ecobee_today() :
+    """(weekday, minutes past midnight) for right now"""
+    now = datetime.datetime.now()
+    return now.weekday(), now.hour * 60 + now.minute
+
+def ecobee_get_todays_settings(trace, which) :
+    """Today's lowest or highest heat setting for each thermostat, by identifier"""
+    day, _ = ecobee_today()
+    retval = {}
+    for ident, index in ecobee_get_schedules(trace).items() :
+        if index is None :
+            retval[ident] = TSTAT_ERROR
+        elif which == 'lowest' :
+            retval[ident] = index.lowest(day)
+        else :
+            retval[ident] = index.highest(day)
+    return retval
+
+def ecobee_get_todays_highest_settings(trace) :
+    """Get the highest setting in today's schedule, for each thermostat"""
+    return ecobee_get_todays_settings(trace, 'highest')
+
+def ecobee_get_todays_lowest_settings(trace) :
+    """Get the lowest setting in today's schedule (our setback temp), for each thermostat"""
+    return ecobee_get_todays_settings(trace, 'lowest')
+
+def ecobee_get_todays_highest_setting(trace) :
+    """Get the highest setting in today's schedule"""
+    return ecobee_get_first_setting(ecobee_get_todays_highest_settings(trace))
+
+def ecobee_get_todays_lowest_setting(trace) :
+    """Get the lowest setting in today's schedule"""
+    return ecobee_get_first_setting(ecobee_get_todays_lowest_settings(trace))
+
+###############################################################################
+#
+# Function calls.
+#
+# Everything that changes the thermostat is an Ecobee "function".  The Ecobee
+# takes a list of them in one POST, so related changes (e.g. setHold and
+# sendMessage) can be sent together with ecobee_post_functions.  The request
+# body is built with json.dumps so, for example, a quote in a message can't
+# break it.
+#
+def ecobee_function(func_type, params) :
+    """One function call"""
+    return {'type' : func_type, 'params' : params}
+
+def ecobee_set_hold_function(setback_temp) :
+    """Function to hold the thermostat at setback_temp"""
+    return ecobee_function('setHold', {
+        'holdtype'     : 'indefinite',
+        'heatHoldTemp' : int(setback_temp),
+        'coolHoldTemp' : int(setback_temp)
+    })
+
+def ecobee_fan_on_function() :
+    """Function to turn the fan on"""
+    return ecobee_function('setHold', {'fan' : 'on'})
+
+def ecobee_resume_program_function() :
+    """Function to resume the thermostat's program"""
+    return ecobee_function('resumeProgram', {'resumeAll' : True})
+
+def ecobee_send_message_function(msg) :
+    """Function to send an alert to the thermostat"""
+    return ecobee_function('sendMessage', {'text' : msg})
+
+###############################################################################
+#
+# The requests sent by the functions below.  These are separate so the asyncio
+# versions (wg_ecobee_async) send exactly the same thing.
+#
+# ids is the list of thermostats to change (see ecobee_selection).
+#
+def ecobee_functions_request(functions, ids=None) :
+    """Request to run a list of functions"""
+    data = {
+        "format" : "json",
+        "body"   : json.dumps({
+            'selection' : ecobee_selection((), ids),
+            'functions' : functions
+        }, separators=(',', ':'))
     }
+    return data
+
+def ecobee_set_hold_request(setback_temp, ids=None) :
+    """Request to hold the thermostat at setback_temp"""
+    return ecobee_functions_request([ecobee_set_hold_function(setback_temp)], ids)
+
+def ecobee_send_alert_request(msg, ids=None) :
+    """Request to send an alert to the thermostat"""
+    return ecobee_functions_request([ecobee_send_message_function(msg)], ids)
+
+def ecobee_resume_program_request(ids=None) :
+    """Request to resume the thermostat's program"""
+    return ecobee_functions_request([ecobee_resume_program_function()], ids)
+
+def ecobee_functions_changed(functions) :
+    """True if any of the functions change the thermostat (not just send a message)"""
+    for function in functions :
+        if function['type'] != 'sendMessage' :
+            return True
+    return False
+
+def ecobee_post_functions(functions, trace, ids=None, tries=0, replies=None) :
+    """Run a list of functions in one request, return a result for each one"""
+    #
+    # The Ecobee runs the whole list or none of it, so every function gets the
+    # same result (TSTAT_SUCCESS or TSTAT_ERROR).  What they should have done
+    # is checked by a later read (see ecobee_verify_snapshot); tries is the
+    # number of times this write has already been re-sent by that check.
+    #
+    # If replies (a dict) is given, the Ecobee's reply is put in it for each
+    # thermostat, so the caller can ecobee_classify a failure.
+    #
+    data = ecobee_functions_request(functions, ids)
+    wg_trace_json(data, trace)
+    retval = ecobee_api_call('POST', data, trace)
+    wg_trace_json(retval, trace)
+    if replies is not None :
+        for ident in ecobee_selected_ids(ids) :
+            replies[ident] = retval
+    if retval.get('status').get('code') == ECOBEE_CODE_SUCCESS :
+        result = TSTAT_SUCCESS
+    else :
+        result = TSTAT_ERROR
+    if ecobee_functions_changed(functions) :
+        ecobee_thermostats_written(functions if result == TSTAT_SUCCESS else (),
+                                   ids, trace, tries)
+    return [result] * len(functions)
+
+def ecobee_control_fan(mode, trace, ids=None) :
+    """Set thermostat hold and temp"""
     if mode == FAN_ON :
-        data = {
-                "format" : "json",
-                "body"   : ('{' +
-                    '"selection" : {' +
-                        '"selectionType"  : "registered",' +
-                        '"selectionMatch" : ""' +
-                    '},' +
-                    '"functions" : [{' +
-                        '"type"   : "setHold",' +
-                        '"params" : {' +
-                            '"fan"    : "on"' +
-                        '}' +
-                    '}]' +
-                '}')
-        }
-        wg_trace_pprint(json.dumps(data, indent=4), trace)
-        retval = requests.request('POST', ECOBEE_URL, params=data, headers=headers).json()
-        wg_trace_pprint(json.dumps(retval, indent=4), trace)
-        if DEBUGGING :
-            # Check to make sure it actually did items
-            stat = ecobee_get_status(trace)
-        if retval.get('status').get('code') == 0 :
-            return TSTAT_SUCCESS
-        else:
-            return TSTAT_ERROR
+        return ecobee_post_functions([ecobee_fan_on_function()], trace, ids)[0]
     else :
         # set back to auto by resuming the hold state
-        return ecobee_resume_program(trace)
+        return ecobee_resume_program(trace, ids)
 
-def ecobee_set_hold_temp(setback_temp, trace) :
+def ecobee_set_hold_temp(setback_temp, trace, ids=None, extra_functions=(), replies=None) :
     """Set thermostat hold and temp"""
-    wg_trace_print("setback_temp is " + str(setback_temp), trace)
-    acctoken, reftoken = ecobee_get_saved_tokens(trace)
-    headers = {
-        'Content-Type'  : 'application/json;charset=UTF-8',
-        'Authorization' : 'Bearer ' + acctoken
-    }
-    data = {
-            "format" : "json",
-            "body"   : ('{' +
-                '"selection" : {' +
-                    '"selectionType"  : "registered",' +
-                    '"selectionMatch" : ""' +
-                '},' +
-                '"functions" : [{' +
-                    '"type"   : "setHold",' +
-                    '"params" : {' +
-                        '"holdtype"    : "indefinite",' +
-                        '"heatHoldTemp" : ' + str(int(setback_temp)) + ',' +
-                        '"coolHoldTemp" : ' + str(int(setback_temp)) +
-                    '}' +
-                '}]' +
-            '}')
-    }
-    wg_trace_pprint(json.dumps(data, indent=4), trace)
-    retval = requests.request('POST', ECOBEE_URL, params=data, headers=headers).json()
-    wg_trace_pprint(json.dumps(retval, indent=4), trace)
-    if DEBUGGING :
-        # Check to make sure it actually did items
-        stat = ecobee_get_status(trace)
-        if not stat['hold'] == HOLD_ENABLED :
-            wg_error_print("ecobee_set_hold_temp", "Hold did not get set!")
-    if retval.get('status').get('code') == 0 :
-        return TSTAT_SUCCESS
-    else:
-        return TSTAT_ERROR
+    #
+    # extra_functions (e.g. ecobee_send_message_function) are sent in the same
+    # request.  replies is as for ecobee_post_functions.
+    #
+    wg_trace_print("setback_temp is %s", trace, setback_temp)
+    functions = [ecobee_set_hold_function(setback_temp)] + list(extra_functions)
+    # Whether the hold really got set is checked by the next read
+    return ecobee_post_functions(functions, trace, ids, replies=replies)[0]
 
-def ecobee_send_alert(msg, trace) :
+def ecobee_send_alert(msg, trace, ids=None) :
     """Send an alert message to the tstat"""
     
     #
@@ -338,67 +1298,50 @@ def ecobee_send_alert(msg, trace) :
     # It sends an alert that must be acknowledged, either in the app or on the tstat screen
     #
     
-    acctoken, reftoken = ecobee_get_saved_tokens(trace)
-    headers = {
-        'Content-Type'  : 'application/json;charset=UTF-8',
-        'Authorization' : 'Bearer ' + acctoken
-    }
-    headers = {
-        'Content-Type'  : 'application/json;charset=UTF-8',
-        'Authorization' : 'Bearer ' + acctoken
-    }
-    data = {
-            "format" : "json",
-            "body"   : ('{' +
-                '"selection" : {' +
-                    '"selectionType"  : "registered",' +
-                    '"selectionMatch" : ""' +
-                '},' +
-                '"functions" : [{' +
-                    '"type" : "sendMessage",' +
-                    '"params" : {' +
-                        '"text" : "' + msg + '"'
-                    '}' +
-                '}]' +
-            '}')
-    }
-    retval = requests.request('POST', ECOBEE_URL, params=data, headers=headers).json()
-    wg_trace_pprint(json.dumps(retval, indent=4), trace)
-    if retval.get('status').get('code') == 0 :
-        return TSTAT_SUCCESS
-    else:
-        return TSTAT_ERROR
+    return ecobee_post_functions([ecobee_send_message_function(msg)], trace, ids)[0]
 
-def ecobee_resume_program(trace) :
+def ecobee_resume_program(trace, ids=None, extra_functions=()) :
     """Run the tstat's program"""
     #
     # Note that this code fails if there isn't a hold
     #
-    acctoken, reftoken = ecobee_get_saved_tokens(trace)
-    headers = {
-        'Content-Type'  : 'application/json;charset=UTF-8',
-        'Authorization' : 'Bearer ' + acctoken
-    }
-    data = {
-            "format" : "json",
-            "body"   : ('{' +
-                '"selection" : {' +
-                    '"selectionType"  : "registered",' +
-                    '"selectionMatch" : ""' +
-                '},' +
-                '"functions" : [{' +
-                    '"type" : "resumeProgram",' +
-                    '"params" : {' +
-                        '"resumeAll" : true' +
-                    '}' +
-                '}]' +
-            '}')
-    }
-    wg_trace_pprint(json.dumps(data, indent=4), trace)
-    retval = requests.request('POST', ECOBEE_URL, params=data, headers=headers).json()
-    wg_trace_pprint(json.dumps(retval, indent=4), trace)
-    if retval.get('status').get('code') == 0 :
-        return TSTAT_SUCCESS
-    else:
-        return TSTAT_ERROR
+    functions = [ecobee_resume_program_function()] + list(extra_functions)
+    return ecobee_post_functions(functions, trace, ids)[0]
+
+###############################################################################
+#
+# Multiple thermostats.
+#
+# A function call covers every thermostat in its selection, so all the
+# thermostats that get the same change share one request.  Thermostats that
+# need different changes (e.g. different setback temperatures) get their own
+# requests, sent at the same time.  Results are by thermostat identifier.
+#
+def ecobee_set_hold_temps(setback_temps, trace, extra_functions=(), replies=None) :
+    """Hold each thermostat (identifier -> temp) at its setback temp"""
+    # replies (a dict) gets the Ecobee's reply for each thermostat
+    groups = {} # temp -> thermostats that get set to it
+    for ident, setback_temp in setback_temps.items() :
+        groups.setdefault(int(setback_temp), []).append(ident)
+    if len(groups) <= 1 :
+        results = [ecobee_set_hold_temp(temp, trace, ids, extra_functions, replies)
+                   for temp, ids in groups.items()]
+    else :
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor :
+            # copy_context so the calls keep the caller's deadline
+            futures = [executor.submit(contextvars.copy_context().run, ecobee_set_hold_temp,
+                                       temp, trace, ids, extra_functions, replies)
+                       for temp, ids in groups.items()]
+            results = [future.result() for future in futures]
+    retval = {}
+    for ids, result in zip(groups.values(), results) :
+        for ident in ids :
+            retval[ident] = result
+    return retval
 
+def ecobee_resume_programs(ids, trace, extra_functions=()) :
+    """Resume the program on each of the given thermostats"""
+    if not ids :
+        return {}
+    result = ecobee_resume_program(trace, list(ids), extra_functions)
+    return dict.fromkeys(ids, result)
@@ -0,0 +1,242 @@
+"""Asyncio versions of the routines to query and control an Ecobee thermostat"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Coroutine versions of the main wg_ecobee calls, so a status read can overlap
+# with, for example, a token refresh or sending a notification.  They send the
+# same requests, return the same values (TSTAT_SUCCESS/TSTAT_ERROR, the status
+# dict) and share wg_ecobee's tokens and snapshot cache.
+#
+# Code that isn't async yet can call the _sync versions, which run the
+# coroutine on a background event loop and wait for the result.
+#
+# Requirements:
+#   aiohttp library
+import asyncio
+import contextvars
+import threading
+import time
+import aiohttp
+import wg_ecobee
+from wg_helper import wg_error_print
+from wg_helper import wg_trace_print
+from wg_helper import wg_trace_json
+from wg_latency import wg_latency_span
+from wg_deadline import wg_deadline_timeout
+from wg_retry import WG_RETRY_REFRESH
+from wg_ecobee import TSTAT_SUCCESS
+from wg_ecobee import TSTAT_ERROR
+from wg_ecobee import ECOBEE_CODE_SUCCESS
+from wg_ecobee import ECOBEE_CODE_NO_REPLY
+from wg_ecobee import ECOBEE_CONNECT_TIMEOUT
+from wg_ecobee import ECOBEE_READ_TIMEOUT
+from wg_ecobee import ECOBEE_ALL_SECTIONS
+from wg_ecobee import ECOBEE_STATUS_SECTIONS
+from wg_ecobee import authorize_app_with_ecobee
+from wg_ecobee import ecobee_classify
+from wg_ecobee import ecobee_parse_reply
+from wg_ecobee import ecobee_headers
+from wg_ecobee import ecobee_read_request
+from wg_ecobee import ecobee_check_snapshot
+from wg_ecobee import ecobee_store_snapshot
+from wg_ecobee import ecobee_thermostats_written
+from wg_ecobee import ecobee_parse_status
+from wg_ecobee import ecobee_set_hold_request
+from wg_ecobee import ecobee_send_alert_request
+from wg_ecobee import ecobee_resume_program_request
+from wg_ecobee import ecobee_functions_request
+from wg_ecobee import ecobee_set_hold_function
+from wg_ecobee import ecobee_resume_program_function
+from wg_ecobee import ecobee_functions_changed
+
+WG_ECOBEE_ASYNC_VERSION = "1.0"
+
+ECOBEE_ASYNC_POOL_SIZE = 4 # Max connections kept open to api.ecobee.com
+
+###############################################################################
+#
+# Connection pool shared by all the coroutines.  (An aiohttp session belongs
+# to the event loop it was made on, so there is one per loop.)
+#
+g_sessions = {}
+
+async def ecobee_async_get_session() :
+    """Return the shared aiohttp session for the running event loop"""
+    loop = asyncio.get_running_loop()
+    session = g_sessions.get(loop)
+    if session is None or session.closed :
+        connector = aiohttp.TCPConnector(limit=ECOBEE_ASYNC_POOL_SIZE)
+        session = aiohttp.ClientSession(connector=connector)
+        g_sessions[loop] = session
+    return session
+
+async def ecobee_async_close_session() :
+    """Close the shared aiohttp session for the running event loop"""
+    session = g_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None :
+        await session.close()
+
+async def ecobee_async_headers(method, trace) :
+    """Headers for a call to the thermostat API, without blocking the event loop"""
+    # Once wg_ecobee has the tokens in memory, build the headers here.  Until
+    # then (or while they're being refreshed) ecobee_headers may read the token
+    # file or wait on the token lock, so it runs on the loop's executor.
+    if wg_ecobee.g_acctoken is not None and not wg_ecobee.g_token_lock.locked() :
+        return ecobee_headers(method, trace)
+    return await asyncio.get_running_loop().run_in_executor(None, ecobee_headers, method, trace)
+
+async def ecobee_async_api_call(method, data, trace) :
+    """Call the thermostat API, refreshing the tokens once if they have expired"""
+    refreshed = False
+    while True :
+        headers = await ecobee_async_headers(method, trace)
+        try :
+            connect, read = wg_deadline_timeout(ECOBEE_CONNECT_TIMEOUT, ECOBEE_READ_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=connect + read, sock_connect=connect,
+                                            sock_read=read)
+            session = await ecobee_async_get_session()
+            # Use wg_ecobee's URL at call time so it can be pointed at a stand-in server
+            with wg_latency_span("ecobee async " + method) :
+                async with session.request(method, wg_ecobee.ECOBEE_URL,
+                                           params=data, headers=headers,
+                                           timeout=timeout) as resp :
+                    retval = ecobee_parse_reply(await resp.text(), resp.status)
+        except Exception as e:
+            wg_error_print("ecobee_async_api_call", str(e))
+            return {'status' : {'code' : ECOBEE_CODE_NO_REPLY, 'message' : str(e)}}
+        if ecobee_classify(retval) != WG_RETRY_REFRESH or refreshed :
+            return retval
+        wg_trace_print("Ecobee tokens are expired.  Refreshing them.", True)
+        # copy_context so the refresh keeps our deadline and trace
+        await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run,
+                                                         authorize_app_with_ecobee, trace)
+        refreshed = True
+
+def ecobee_async_result(retval, trace) :
+    """TSTAT_SUCCESS if the Ecobee accepted the request, TSTAT_ERROR if not"""
+    wg_trace_json(retval, trace)
+    if retval.get('status').get('code') == ECOBEE_CODE_SUCCESS :
+        return TSTAT_SUCCESS
+    return TSTAT_ERROR
+
+###############################################################################
+#
+# The coroutines
+#
+async def get_tstat_data_async(trace, sections=ECOBEE_ALL_SECTIONS) :
+    """Get current thermostat data"""
+    retval = await ecobee_async_api_call('GET', ecobee_read_request(sections), trace)
+    if retval.get('status').get('code') != ECOBEE_CODE_SUCCESS :
+        wg_trace_print("Unable to get tstat data.", trace)
+        wg_trace_json(retval, True)
+    return retval
+
+async def ecobee_get_snapshot_async(trace, sections=ECOBEE_ALL_SECTIONS) :
+    """Get the thermostat data for the given sections, from the cache if fresh enough"""
+    snapshot, missing = ecobee_check_snapshot(sections)
+    if snapshot is not None and not missing :
+        return snapshot
+    started = time.monotonic()
+    return ecobee_store_snapshot(await get_tstat_data_async(trace, missing), missing, started)
+
+async def ecobee_get_status_async(trace, prefetch=()) :
+    """Get the status of the thermostat"""
+    tstat_status = await ecobee_get_snapshot_async(trace,
+                                                   ECOBEE_STATUS_SECTIONS + tuple(prefetch))
+    return ecobee_parse_status(tstat_status, trace)
+
+async def ecobee_set_hold_temp_async(setback_temp, trace, ids=None) :
+    """Set thermostat hold and temp"""
+    wg_trace_print("setback_temp is %s", trace, setback_temp)
+    retval = await ecobee_async_api_call('POST', ecobee_set_hold_request(setback_temp, ids), trace)
+    result = ecobee_async_result(retval, trace)
+    ecobee_async_written([ecobee_set_hold_function(setback_temp)], result, ids, trace)
+    return result
+
+async def ecobee_resume_program_async(trace, ids=None) :
+    """Run the tstat's program"""
+    retval = await ecobee_async_api_call('POST', ecobee_resume_program_request(ids), trace)
+    result = ecobee_async_result(retval, trace)
+    ecobee_async_written([ecobee_resume_program_function()], result, ids, trace)
+    return result
+
+async def ecobee_post_functions_async(functions, trace, ids=None) :
+    """Run a list of functions in one request, return a result for each one"""
+    retval = await ecobee_async_api_call('POST', ecobee_functions_request(functions, ids), trace)
+    result = ecobee_async_result(retval, trace)
+    if ecobee_functions_changed(functions) :
+        ecobee_async_written(functions, result, ids, trace)
+    return [result] * len(functions)
+
+async def ecobee_send_alert_async(msg, trace, ids=None) :
+    """Send an alert message to the tstat"""
+    retval = await ecobee_async_api_call('POST', ecobee_send_alert_request(msg, ids), trace)
+    return ecobee_async_result(retval, trace)
+
+def ecobee_async_written(functions, result, ids, trace) :
+    """Tell wg_ecobee about a write (so it's checked by the next read)"""
+    ecobee_thermostats_written(functions if result == TSTAT_SUCCESS else (), ids, trace)
+
+###############################################################################
+#
+# Blocking wrappers.  These run the coroutines on a background event loop so
+# synchronous code (e.g. alarm_tstat.py) can move over one call at a time.
+#
+g_loop = None
+g_loop_lock = threading.Lock()
+
+def ecobee_async_loop() :
+    """Return the background event loop, starting it if needed"""
+    global g_loop
+    with g_loop_lock :
+        if g_loop is None :
+            g_loop = asyncio.new_event_loop()
+            threading.Thread(target=g_loop.run_forever, name="wg_ecobee_async",
+                             daemon=True).start()
+        return g_loop
+
+async def ecobee_async_in_context(context, coro) :
+    """Run a coroutine as a task in the given context"""
+    # A task gets a copy of the context it's created in, so the coroutine sees
+    # the caller's wg_deadline budget and wg_latency trace rather than the loop's
+    return await context.run(asyncio.ensure_future, coro)
+
+def ecobee_async_run(coro) :
+    """Run a coroutine on the background event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(
+        ecobee_async_in_context(contextvars.copy_context(), coro), ecobee_async_loop()).result()
+
+def ecobee_async_shutdown() :
+    """Close the background loop's connections and stop it (call at shutdown)"""
+    global g_loop
+    with g_loop_lock :
+        loop = g_loop
+        g_loop = None
+    if loop is not None :
+        asyncio.run_coroutine_threadsafe(ecobee_async_close_session(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+def get_tstat_data_sync(trace, sections=ECOBEE_ALL_SECTIONS) :
+    """Blocking get_tstat_data_async"""
+    return ecobee_async_run(get_tstat_data_async(trace, sections))
+
+def ecobee_get_status_sync(trace, prefetch=()) :
+    """Blocking ecobee_get_status_async"""
+    return ecobee_async_run(ecobee_get_status_async(trace, prefetch))
+
+def ecobee_set_hold_temp_sync(setback_temp, trace, ids=None) :
+    """Blocking ecobee_set_hold_temp_async"""
+    return ecobee_async_run(ecobee_set_hold_temp_async(setback_temp, trace, ids))
+
+def ecobee_resume_program_sync(trace, ids=None) :
+    """Blocking ecobee_resume_program_async"""
+    return ecobee_async_run(ecobee_resume_program_async(trace, ids))
+
+def ecobee_post_functions_sync(functions, trace, ids=None) :
+    """Blocking ecobee_post_functions_async"""
+    return ecobee_async_run(ecobee_post_functions_async(functions, trace, ids))
+
+def ecobee_send_alert_sync(msg, trace, ids=None) :
+    """Blocking ecobee_send_alert_async"""
+    return ecobee_async_run(ecobee_send_alert_async(msg, trace, ids))
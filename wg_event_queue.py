@@ -0,0 +1,94 @@
+"""A small work queue where newer events replace older ones that haven't run yet"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Helper functions and definitions to move slow work (e.g. calls to cloud
+# services) out of callbacks such as gpiozero's when_held.
+#
+# The callback posts an event and returns right away.  A worker thread runs
+# the events one at a time.  Each event is posted under a key and only the
+# newest event for a key is kept, so if the alarm relay flaps while an event
+# is running there is at most one more (the latest state) waiting behind it.
+import collections
+import threading
+from wg_helper import wg_error_print
+
+WG_EVENT_QUEUE_VERSION = "1.0"
+
+WG_EVENT_QUEUE_MAXSIZE = 8 # Most events (i.e., different keys) that can be waiting
+
+class WgEventQueue():
+    """Run posted events on a worker thread, newest event per key wins"""
+    def __init__(self, name, maxsize=WG_EVENT_QUEUE_MAXSIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self._pending = collections.OrderedDict() # key -> (func, args)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._busy = False
+        self._posted = 0
+        self._handled = 0
+        self._coalesced = 0
+        self._dropped = 0
+
+    def start(self):
+        """Start the worker thread"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """Stop the worker thread once the event it is running (if any) is done"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def post(self, key, func, *args):
+        """Queue func(*args) to be run, replacing anything still waiting under key"""
+        with self._cond:
+            self._posted += 1
+            if key in self._pending:
+                self._coalesced += 1
+                del self._pending[key] # the newer event goes to the back of the line
+            elif len(self._pending) >= self.maxsize:
+                self._dropped += 1
+                self._pending.popitem(last=False) # make room by dropping the oldest
+            self._pending[key] = (func, args)
+            self._cond.notify()
+
+    def stats(self):
+        """Return queue depth and counts of events posted, handled, coalesced and dropped"""
+        with self._cond:
+            return {
+                'depth'     : len(self._pending),
+                'busy'      : self._busy,
+                'posted'    : self._posted,
+                'handled'   : self._handled,
+                'coalesced' : self._coalesced,
+                'dropped'   : self._dropped
+            }
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                key, (func, args) = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                func(*args)
+            except Exception as err: #pylint: disable=W0703
+                wg_error_print(self.name, "Event " + str(key) + " failed: " + str(err))
+            with self._cond:
+                self._busy = False
+                self._handled += 1
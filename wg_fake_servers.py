@@ -0,0 +1,471 @@
+"""Local stand-ins for the Ecobee API and a Radio Thermostat, for benchmarks and testing"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Small HTTP servers (on 127.0.0.1, any free port) that answer like the real
+# things, well enough for wg_ecobee and wg_radio_thermostat:
+#
+#   WgFakeEcobee   - /1/thermostat (GET and the POST functions setHold,
+#                    resumeProgram and sendMessage), /1/thermostatSummary and
+#                    /token.  Only the current access token is accepted;
+#                    expire_tokens() makes the next call get status 14.
+#   WgFakeRadtherm - /tstat, /tstat/<value> and /tstat/program/heat/<day>.
+#   WgFakeNotify   - POST /notify, for wg_notify's WgHttpProvider.  The
+#                    messages it gets are kept in messages.
+#
+# Both can be made slow (latency + random jitter), fail some of the time
+# (error_rate), drop the connection without answering (drop_rate), or fail
+# the next few calls with a given code (fail_next).
+#
+# wg_fake_use_ecobee/wg_fake_use_radtherm point the modules at a fake server.
+#
+# Usage (to poke at them by hand):
+#   wg_fake_servers.py
+import datetime
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+WG_FAKE_SERVERS_VERSION = "1.0"
+
+WG_FAKE_DROP = "drop"  # fail_next code: drop the connection without answering
+
+ECOBEE_FAKE_PROCESSING_ERROR = 3
+ECOBEE_FAKE_TOKEN_EXPIRED = 14
+
+###############################################################################
+#
+# The common part: the HTTP server, faults and counts.
+#
+class WgFakeHandler(BaseHTTPRequestHandler):
+    """Hands each request to the fake server it belongs to"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # else the headers and body wait on delayed ACKs
+
+    def log_message(self, format, *args): #pylint: disable=W0622
+        pass
+
+    def do_GET(self): #pylint: disable=C0103
+        self.server.fake.handle(self, 'GET')
+
+    def do_POST(self): #pylint: disable=C0103
+        self.server.fake.handle(self, 'POST')
+
+class WgFakeServer():
+    """Base class for the fake servers"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency       # seconds added to every reply
+        self.jitter = jitter         # up to this many more seconds, at random
+        self.error_rate = error_rate # fraction of requests that get an error
+        self.drop_rate = drop_rate   # fraction of requests whose connection is dropped
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.failures = []           # codes to fail the next requests with (see fail_next)
+        self.stats = {'requests' : 0, 'errors' : 0, 'dropped' : 0}
+        self.paths = {}              # requests by "METHOD /path"
+        self.server = None
+
+    def start(self):
+        """Start answering requests (on a background thread)"""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WgFakeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop the server"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def address(self):
+        """host:port of the server"""
+        return '127.0.0.1:' + str(self.server.server_port)
+
+    @property
+    def url(self):
+        """Base URL of the server"""
+        return 'http://' + self.address
+
+    def fail_next(self, code, count=1):
+        """Fail the next count requests with code (or drop them, WG_FAKE_DROP)"""
+        with self.lock:
+            self.failures.extend([code] * count)
+
+    def handle(self, request, method):
+        """Count the request, apply the faults, then answer it"""
+        parsed = urllib.parse.urlparse(request.path)
+        length = int(request.headers.get('Content-Length', 0) or 0)
+        body = request.rfile.read(length) if length else b''
+        with self.lock:
+            self.stats['requests'] += 1
+            key = method + ' ' + parsed.path
+            self.paths[key] = self.paths.get(key, 0) + 1
+            drop = self.random.random() < self.drop_rate
+            failure = self.failures.pop(0) if self.failures else None
+            if failure == WG_FAKE_DROP:
+                drop, failure = True, None
+            if failure is None and self.random.random() < self.error_rate:
+                failure = self.error_code()
+            delay = self.latency + self.random.uniform(0.0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if drop:
+            with self.lock:
+                self.stats['dropped'] += 1
+            request.close_connection = True
+            try:
+                request.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        if failure is not None:
+            with self.lock:
+                self.stats['errors'] += 1
+            self.send(request, self.error_reply(failure))
+            return
+        query = urllib.parse.parse_qs(parsed.query)
+        self.send(request, self.reply(method, parsed.path, query, body, request.headers))
+
+    def send(self, request, reply):
+        """Send a JSON reply"""
+        data = json.dumps(reply).encode('utf-8')
+        try:
+            request.send_response(200)
+            request.send_header('Content-Type', 'application/json')
+            request.send_header('Content-Length', str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            request.close_connection = True # the client timed out and went away
+
+    def error_code(self):
+        """The code to fail with for error_rate"""
+        raise NotImplementedError
+
+    def error_reply(self, code):
+        """The reply for a failed request"""
+        raise NotImplementedError
+
+    def reply(self, method, path, query, body, headers):
+        """The reply for a request"""
+        raise NotImplementedError
+
+###############################################################################
+#
+# The Ecobee.  Thermostats are identified as "100001", "100002", ...
+#
+class WgFakeEcobee(WgFakeServer):
+    """Stand-in for api.ecobee.com"""
+
+    def __init__(self, num_thermostats=1, **kwargs):
+        WgFakeServer.__init__(self, **kwargs)
+        self.token_count = 0
+        self.access_token = None   # nothing is accepted until /token is called
+        self.refresh_token = None
+        self.revision = 0
+        self.messages = []         # (identifier, text) from sendMessage
+        self.thermostats = [self.make_thermostat(n) for n in range(num_thermostats)]
+
+    def next_revision(self):
+        """A new revision string (the real ones look like a timestamp)"""
+        self.revision += 1
+        return '%012d' % self.revision
+
+    def make_thermostat(self, num):
+        """A heating thermostat running a Home/Away/Sleep program"""
+        # 7 days (Monday first) of 48 half hours: sleep to 6:00, home to 8:00,
+        # away to 17:00, home to 22:00, then sleep
+        day = ['sleep'] * 12 + ['home'] * 4 + ['away'] * 18 + ['home'] * 10 + ['sleep'] * 4
+        return {
+            'identifier' : str(100001 + num),
+            'name' : 'Thermostat ' + str(num + 1),
+            'thermostatRev' : self.next_revision(),
+            'alertsRev' : self.next_revision(),
+            'runtimeRev' : self.next_revision(),
+            'intervalRev' : self.next_revision(),
+            'settings' : {'hvacMode' : 'heat', 'heatStages' : 1, 'coolStages' : 1},
+            'runtime' : {'connected' : True, 'actualTemperature' : 685, 'actualHumidity' : 41,
+                         'desiredHeat' : 690, 'desiredCool' : 750, 'desiredFanMode' : 'auto'},
+            'events' : [],
+            'program' : {
+                'schedule' : [list(day) for _ in range(7)],
+                'climates' : [
+                    {'name' : 'Home', 'climateRef' : 'home', 'heatTemp' : 690, 'coolTemp' : 750},
+                    {'name' : 'Away', 'climateRef' : 'away', 'heatTemp' : 600, 'coolTemp' : 800},
+                    {'name' : 'Sleep', 'climateRef' : 'sleep', 'heatTemp' : 620,
+                     'coolTemp' : 780},
+                ],
+                'currentClimateRef' : 'home',
+            },
+        }
+
+    def thermostat(self, identifier):
+        """The fake's data for a thermostat"""
+        for tstat in self.thermostats:
+            if tstat['identifier'] == identifier:
+                return tstat
+        return None
+
+    def expire_tokens(self):
+        """The current access token stops working (the refresh token still works)"""
+        with self.lock:
+            self.access_token = 'expired'
+
+    def set_temperature(self, identifier, temp):
+        """Change a thermostat's temperature (in tenths of a degree), as if the room changed"""
+        with self.lock:
+            tstat = self.thermostat(identifier)
+            tstat['runtime']['actualTemperature'] = temp
+            tstat['runtimeRev'] = self.next_revision()
+
+    def set_program(self, identifier, climate_name, heat_temp):
+        """Change one of a thermostat's climates, as if it was done from the app"""
+        with self.lock:
+            tstat = self.thermostat(identifier)
+            for climate in tstat['program']['climates']:
+                if climate['name'] == climate_name:
+                    climate['heatTemp'] = heat_temp
+            tstat['thermostatRev'] = self.next_revision()
+
+    def error_code(self):
+        return ECOBEE_FAKE_PROCESSING_ERROR
+
+    def error_reply(self, code):
+        return {'status' : {'code' : code, 'message' : 'Fake error ' + str(code)}}
+
+    def reply(self, method, path, query, body, headers):
+        if path == '/token':
+            return self.token_reply(query, body)
+        if headers.get('Authorization') != 'Bearer ' + str(self.access_token):
+            return self.error_reply(ECOBEE_FAKE_TOKEN_EXPIRED)
+        request = json.loads((query.get('body') or query.get('json') or ['{}'])[0])
+        with self.lock:
+            if path == '/1/thermostat' and method == 'GET':
+                return self.thermostat_reply(request.get('selection', {}))
+            if path == '/1/thermostat' and method == 'POST':
+                return self.functions_reply(request.get('selection', {}),
+                                            request.get('functions', []))
+            if path == '/1/thermostatSummary':
+                return self.summary_reply(request.get('selection', {}))
+        return {'status' : {'code' : 4, 'message' : 'Unknown request ' + path}}
+
+    def token_reply(self, query, body):
+        """New tokens for a PIN or refresh token"""
+        form = urllib.parse.parse_qs(body.decode('utf-8'))
+        grant = (query.get('grant_type') or form.get('grant_type') or [''])[0]
+        code = (query.get('code') or form.get('code') or [''])[0]
+        with self.lock:
+            if grant == 'refresh_token' and code != self.refresh_token:
+                return {'error' : 'invalid_grant', 'error_description' : 'Bad refresh token'}
+            self.token_count += 1
+            self.access_token = 'access-' + str(self.token_count)
+            self.refresh_token = 'refresh-' + str(self.token_count)
+            return {'access_token' : self.access_token, 'refresh_token' : self.refresh_token,
+                    'token_type' : 'Bearer', 'expires_in' : 3599, 'scope' : 'smartWrite'}
+
+    def selected(self, selection):
+        """The thermostats a selection is for"""
+        if selection.get('selectionType') == 'thermostats':
+            ids = selection.get('selectionMatch', '').split(',')
+            return [tstat for tstat in self.thermostats if tstat['identifier'] in ids]
+        return self.thermostats
+
+    def thermostat_reply(self, selection):
+        """getThermostat: just the sections asked for"""
+        tstats = []
+        for tstat in self.selected(selection):
+            reply = {key : tstat[key] for key in ('identifier', 'name', 'thermostatRev')}
+            for section, flag in (('runtime', 'includeRuntime'), ('settings', 'includeSettings'),
+                                  ('events', 'includeEvents'), ('program', 'includeProgram')):
+                if selection.get(flag):
+                    reply[section] = json.loads(json.dumps(tstat[section]))
+            tstats.append(reply)
+        return {'status' : {'code' : 0, 'message' : ''}, 'thermostatList' : tstats,
+                'page' : {'page' : 1, 'totalPages' : 1, 'pageSize' : len(tstats),
+                          'total' : len(tstats)}}
+
+    def functions_reply(self, selection, functions):
+        """Run the functions on the selected thermostats"""
+        for tstat in self.selected(selection):
+            for function in functions:
+                self.run_function(tstat, function['type'], function.get('params', {}))
+        return {'status' : {'code' : 0, 'message' : ''}}
+
+    def run_function(self, tstat, func_type, params):
+        """Run one function on one thermostat"""
+        runtime = tstat['runtime']
+        if func_type == 'setHold':
+            heat = params.get('heatHoldTemp', runtime['desiredHeat'])
+            tstat['events'] = [{'type' : 'hold', 'running' : True, 'heatHoldTemp' : heat,
+                                'coolHoldTemp' : params.get('coolHoldTemp', heat),
+                                'fan' : params.get('fan', 'auto')}]
+            runtime['desiredHeat'] = heat
+            runtime['desiredFanMode'] = params.get('fan', runtime['desiredFanMode'])
+        elif func_type == 'resumeProgram':
+            tstat['events'] = []
+            runtime['desiredHeat'] = self.program_heat(tstat)
+            runtime['desiredFanMode'] = 'auto'
+        elif func_type == 'sendMessage':
+            self.messages.append((tstat['identifier'], params.get('text')))
+            tstat['alertsRev'] = self.next_revision()
+            return
+        tstat['thermostatRev'] = self.next_revision()
+        tstat['runtimeRev'] = self.next_revision()
+
+    def program_heat(self, tstat):
+        """The heat setting the program calls for right now"""
+        now = datetime.datetime.now()
+        ref = tstat['program']['schedule'][now.weekday()][now.hour * 2 + now.minute // 30]
+        for climate in tstat['program']['climates']:
+            if climate['climateRef'] == ref:
+                return climate['heatTemp']
+        return tstat['runtime']['desiredHeat']
+
+    def summary_reply(self, selection):
+        """thermostatSummary: the revisions of each thermostat"""
+        revisions = [':'.join((tstat['identifier'], tstat['name'], 'true', tstat['thermostatRev'],
+                               tstat['alertsRev'], tstat['runtimeRev'], tstat['intervalRev']))
+                     for tstat in self.selected(selection)]
+        return {'status' : {'code' : 0, 'message' : ''}, 'thermostatCount' : len(revisions),
+                'revisionList' : revisions}
+
+###############################################################################
+#
+# The Radio Thermostat (CT50/CT80 style API)
+#
+RADTHERM_FAKE_VALUES = {
+    # /tstat/<resource> -> the value it returns
+    'temp' : 'temp', 'humidity' : 'humidity', 'tmode' : 'tmode', 'fmode' : 'fmode',
+    'hold' : 'hold', 'save_energy' : 'mode', 'night_light' : 'intensity',
+}
+
+class WgFakeRadtherm(WgFakeServer):
+    """Stand-in for a Radio Thermostat on the LAN"""
+
+    def __init__(self, **kwargs):
+        WgFakeServer.__init__(self, **kwargs)
+        self.status = {'temp' : 68.5, 'tmode' : 1, 'fmode' : 0, 'override' : 0, 'hold' : 0,
+                       't_heat' : 69.0, 'tstate' : 0, 'fstate' : 0,
+                       'time' : {'day' : 0, 'hour' : 0, 'minute' : 0}}
+        self.values = {'humidity' : 41, 'mode' : 0, 'intensity' : 0}
+        self.uma = ['', '']
+        # Monday first: minutes past midnight, temp, ... (4 periods a day)
+        self.program = [[360, 69, 480, 60, 1020, 69, 1320, 62] for _ in range(7)]
+
+    def error_code(self):
+        return -1
+
+    def error_reply(self, code):
+        return {'error' : code}
+
+    def reply(self, method, path, query, body, headers):
+        resource = path[len('/tstat'):].strip('/') if path.startswith('/tstat') else None
+        data = json.loads(body.decode('utf-8')) if body else {}
+        with self.lock:
+            if resource is None:
+                return self.error_reply(-1)
+            if method == 'GET':
+                return self.get_reply(resource)
+            return self.post_reply(resource, data)
+
+    def get_reply(self, resource):
+        """Read the status, a value or a day's program"""
+        now = datetime.datetime.now()
+        if resource == '':
+            self.status['time'] = {'day' : now.weekday(), 'hour' : now.hour,
+                                   'minute' : now.minute}
+            return json.loads(json.dumps(self.status))
+        if resource in RADTHERM_FAKE_VALUES:
+            what = RADTHERM_FAKE_VALUES[resource]
+            return {what : self.status.get(what, self.values.get(what))}
+        if resource.startswith('program/heat/'):
+            days = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+            day = resource[len('program/heat/'):]
+            if day in days:
+                return {str(days.index(day)) : list(self.program[days.index(day)])}
+        return self.error_reply(-1)
+
+    def post_reply(self, resource, data):
+        """Change the status or a value"""
+        if resource == '':
+            for what, value in data.items():
+                self.status[what] = value
+            return {'success' : 0}
+        if resource in ('save_energy', 'night_light'):
+            self.values.update(data)
+            return {'success' : 0}
+        if resource == 'uma':
+            self.uma[int(data.get('line', 0))] = data.get('message', '')
+            return {'success' : 0}
+        return self.error_reply(-1)
+
+###############################################################################
+#
+# Notifications (what wg_notify.WgHttpProvider sends)
+#
+class WgFakeNotify(WgFakeServer):
+    """Stand-in for a text/email provider"""
+
+    def __init__(self, **kwargs):
+        WgFakeServer.__init__(self, **kwargs)
+        self.messages = []  # the notifications received (dicts)
+
+    def error_code(self):
+        return 503
+
+    def error_reply(self, code):
+        return {'error' : code}
+
+    def reply(self, method, path, query, body, headers):
+        if method != 'POST' or path != '/notify':
+            return self.error_reply(404)
+        notification = json.loads(body.decode('utf-8'))
+        with self.lock:
+            self.messages.append(notification)
+        return {'id' : len(self.messages)}
+
+###############################################################################
+#
+# Point the modules at the fakes.
+#
+def wg_fake_use_ecobee(fake, token_file):
+    """Make wg_ecobee talk to fake (keeping its tokens in token_file)"""
+    import wg_ecobee
+    wg_ecobee.ecobee_shutdown()
+    wg_ecobee.ECOBEE_API_ROOT = fake.url
+    wg_ecobee.ECOBEE_URL = fake.url + '/1/thermostat'
+    wg_ecobee.ECOBEE_TOKEN_URL = fake.url + '/token'
+    wg_ecobee.ECOBEE_SUMMARY_URL = fake.url + '/1/thermostatSummary'
+    wg_ecobee.tok_file_name = token_file
+    wg_ecobee.g_acctoken = None # re-read the tokens (from token_file)
+    wg_ecobee.g_reftoken = None
+    wg_ecobee.ecobee_invalidate_snapshot()
+
+def wg_fake_use_radtherm(fake):
+    """Make wg_radio_thermostat talk to fake"""
+    import wg_radio_thermostat
+    wg_radio_thermostat.TSTAT_IP = fake.address
+    wg_radio_thermostat.radtherm_invalidate_snapshot()
+
+if __name__ == "__main__":
+    ECOBEE = WgFakeEcobee(num_thermostats=2).start()
+    RADTHERM = WgFakeRadtherm().start()
+    print("Ecobee:           " + ECOBEE.url + "/1/thermostat")
+    print("Radio Thermostat: " + RADTHERM.url + "/tstat")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -7,44 +7,211 @@
 #
 # All functions, variables, etc. should start with "WG" so as not to interfere with other
 # packages.
+import atexit
 import datetime
+import json
+import logging
 import pprint
+import queue
+import threading
+import time
+from logging.handlers import RotatingFileHandler
 from logzero import logger, logfile
 
-WG_HELPER_VERSION = "2.02"
+WG_HELPER_VERSION = "2.04"
+
+# Queued logging (see wg_init_log)
+WG_LOG_QUEUE_SIZE = 1000      # records waiting to be written before we start dropping them
+WG_LOG_BATCH_SIZE = 50        # write as soon as this many records are waiting
+WG_LOG_FLUSH_INTERVAL = 5.0   # seconds, write at least this often
 
 ###############################################################################
 #
 # Initialize logging
 #
-def wg_init_log(file):
+# With queued=True the log file isn't written by the caller.  Records go on a
+# queue and a background thread writes them in batches: when WG_LOG_BATCH_SIZE
+# are waiting, every WG_LOG_FLUSH_INTERVAL seconds, right away for an error
+# and at shutdown (wg_close_log).  That keeps the SD card writes out of the
+# GPIO callbacks and turns a burst of messages into one write.  If the queue
+# fills up, records are dropped (and counted) rather than blocking the caller.
+#
+def wg_init_log(file, queued=False):
     """ Initialize the logfile.  Only 1MB file size. 3 rotations. """
     # always do this, even if not 'Trace'ing so we get errors
+    wg_close_log()
     logfile(file, maxBytes=1e6, backupCount=3)
+    if queued:
+        for handler in list(logger.handlers):
+            if isinstance(handler, RotatingFileHandler):
+                logger.removeHandler(handler)
+                logger.addHandler(WgQueueHandler(handler))
+
+class WgQueueHandler(logging.Handler):
+    """ Log handler that hands records to a background thread to write in batches. """
+
+    def __init__(self, target):
+        logging.Handler.__init__(self, target.level)
+        self.target = target # the (logzero) RotatingFileHandler that does the writing
+        self.queue = queue.Queue(maxsize=WG_LOG_QUEUE_SIZE)
+        self.stats = {'queued' : 0, 'written' : 0, 'writes' : 0, 'dropped' : 0}
+        self.dropped = 0     # dropped since we last logged about it
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="wg_log", daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.stats['queued'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+            self.dropped += 1
+
+    def run(self):
+        """ Background thread: collect records and write them out in batches. """
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                if deadline is None:
+                    deadline = time.monotonic() + WG_LOG_FLUSH_INTERVAL
+                batch.append(record)
+            if (record is None or len(batch) >= WG_LOG_BATCH_SIZE or
+                    record.levelno >= logging.ERROR or self.stopping):
+                self.write(batch)
+                batch = []
+                deadline = None
+            if self.stopping and self.queue.empty():
+                return
+
+    def write(self, records):
+        """ Write a batch of records to the log file in one go. """
+        if self.dropped:
+            count, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord({
+                'name' : logger.name, 'levelno' : logging.WARNING, 'levelname' : 'WARNING',
+                'module' : 'wg_helper', 'lineno' : 0,
+                'msg' : "Log queue full, %d records dropped" % count}))
+        if not records:
+            return
+        target = self.target
+        lines = []
+        target.acquire()
+        try:
+            size = target.stream.tell() if target.stream else 0
+            for record in records:
+                msg = target.format(record) + target.terminator
+                if target.maxBytes > 0 and size + len(msg) >= target.maxBytes and (lines or size):
+                    self.write_lines(lines)
+                    target.doRollover()
+                    lines = []
+                    size = 0
+                lines.append(msg)
+                size += len(msg)
+            self.write_lines(lines)
+            self.stats['written'] += len(records)
+        except Exception: #pylint: disable=W0703
+            target.handleError(records[-1])
+        finally:
+            target.release()
+
+    def write_lines(self, lines):
+        """ Write (and flush) lines to the log file (target's lock must be held). """
+        if lines:
+            if self.target.stream is None:
+                self.target.stream = self.target._open() #pylint: disable=W0212
+            self.target.stream.write("".join(lines))
+            self.target.stream.flush()
+            self.stats['writes'] += 1
+
+    def close(self):
+        """ Write out everything that's waiting and stop the thread. """
+        self.stopping = True
+        try:
+            self.queue.put(None, timeout=1.0) # wake the thread up
+        except queue.Full:
+            pass
+        self.thread.join(timeout=10.0)
+        self.target.close()
+        logging.Handler.close(self)
+
+def wg_close_log():
+    """ Flush and close a queued log (call at shutdown, safe to call any time). """
+    for handler in list(logger.handlers):
+        if isinstance(handler, WgQueueHandler):
+            logger.removeHandler(handler)
+            handler.close()
+
+def wg_log_stats():
+    """ Return the queued log's counts (queued, written, writes, dropped, depth). """
+    for handler in logger.handlers:
+        if isinstance(handler, WgQueueHandler):
+            stats = dict(handler.stats)
+            stats['depth'] = handler.queue.qsize()
+            return stats
+    return {}
+
+atexit.register(wg_close_log)
+
+###############################################################################
+#
+# Tracing is off most of the time, so nothing is formatted until we know the
+# message will be logged.  The message can be:
+#   - a string, used as is,
+#   - a format string plus args, e.g. wg_trace_print("%s is %s", trace, what, val),
+#   - a callable (e.g. a lambda) that returns the message.
+#
+def wg_format_message(message, args):
+    """ Build a deferred message (only call this once we know it'll be logged). """
+    if callable(message):
+        message = message()
+    if args:
+        message = message % args
+    return message
 
 ###############################################################################
 #
 # Print out a trace message and flush the buffers.
 #
-def wg_trace_print(message, trace):
+def wg_trace_print(message, trace, *args):
     """ Print out a tracing message."""
     if trace:
-        logger.info(message)
+        logger.info(wg_format_message(message, args))
 
 ###############################################################################
 #
 # Print out an error message and flush the buffers.
 #
-def wg_error_print(where, message):
+def wg_error_print(where, message, *args):
     """Print out an error message."""
-    logger.error(where + ": " + message)
+    logger.error(where + ": " + wg_format_message(message, args))
 
 ###############################################################################
 #
-# Print out a structure if we're tracing
+# Print out a structure if we're tracing.  struct can also be a callable that
+# returns the structure.
 #
 def wg_trace_pprint(struct, trace):
     """Nicely print out a structure if we're tracing"""
     if trace:
-        pprt = pprint.PrettyPrinter(indent=4)
-        logger.info(pprt.pformat(struct))
+        if callable(struct):
+            struct = struct()
+        logger.info(pprint.pformat(struct, indent=4))
+
+###############################################################################
+#
+# Print out a structure as (indented) JSON if we're tracing.  Use this rather
+# than wg_trace_pprint(json.dumps(...)) so the dump is only done when needed.
+#
+def wg_trace_json(struct, trace):
+    """Print out a structure as JSON if we're tracing"""
+    if trace:
+        if callable(struct):
+            struct = struct()
+        logger.info(json.dumps(struct, indent=4))
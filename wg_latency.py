@@ -0,0 +1,190 @@
+"""Per-event latency traces: how long each stage took from relay to thermostat"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Each alarm event gets a trace (with an ID).  Code wraps the interesting
+# stages in spans, e.g.
+#     with wg_latency_span("ecobee GET /1/thermostat"):
+#         ...
+# and the span's duration is added to whatever trace is current.  The current
+# trace is kept in a contextvar, so it follows the event onto the sink threads
+# (see wg_latency_bind).  With no trace (or before wg_latency_init) a span
+# does nothing.
+#
+# Finished traces are appended, one JSON object per line, to a log file that
+# rolls over at WG_LATENCY_MAX_BYTES.  wg_latency_summary (or running this
+# file) gives p50/p95/p99 for each stage.  Only events slower than
+# WG_LATENCY_SLOW_MS (or all of them, with wg_latency_init's trace) are also
+# noted in the error log.
+#
+# Usage:
+#   wg_latency.py [latency.jsonl]
+import contextlib
+import contextvars
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from wg_helper import wg_error_print
+from wg_helper import wg_trace_print
+
+WG_LATENCY_VERSION = "1.0"
+
+WG_LATENCY_FILE = "latency.jsonl"
+WG_LATENCY_MAX_BYTES = 1000000  # roll latency.jsonl over to latency.jsonl.1 at this size
+WG_LATENCY_TOTAL = "total"      # the stage name for the whole event
+WG_LATENCY_SLOW_MS = 10000.0    # events slower than this are also noted in the log
+
+g_latency_file = None           # None until wg_latency_init, then traces are kept
+g_latency_trace = False         # note every event in the log, not just the slow ones
+g_latency_lock = threading.Lock()
+g_current = contextvars.ContextVar("wg_latency_trace", default=None)
+
+class WgLatencyTrace():
+    """The spans of one event"""
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def add(self, stage, start, duration, ok=True):
+        """Record a span (start is a perf_counter value)"""
+        with self.lock:
+            if not self.finished: # a sink that ran past its timeout
+                self.spans.append({'stage' : stage, 'at' : round(start - self.start, 6),
+                                   'ms' : round(duration * 1000.0, 3), 'ok' : ok})
+
+    def record(self):
+        """The trace as a dict (to write out)"""
+        with self.lock:
+            return {'id' : self.trace_id, 'event' : self.name, 'time' : round(self.wall, 3),
+                    'ms' : round((time.perf_counter() - self.start) * 1000.0, 3),
+                    'spans' : list(self.spans)}
+
+###############################################################################
+#
+# Starting, passing along and finishing traces.
+#
+def wg_latency_init(file_name=WG_LATENCY_FILE, trace=False):
+    """Start keeping traces (in file_name)"""
+    global g_latency_file, g_latency_trace
+    g_latency_file = file_name
+    g_latency_trace = trace
+
+def wg_latency_start(name):
+    """Start a trace for an event (None if we're not keeping traces)"""
+    if g_latency_file is None:
+        return None
+    return WgLatencyTrace(name)
+
+def wg_latency_current():
+    """The trace for the event being handled (or None)"""
+    return g_current.get()
+
+def wg_latency_bind(trace, func):
+    """Return a callable that runs func with trace as the current trace"""
+    def run(*args, **kwargs):
+        token = g_current.set(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g_current.reset(token)
+    return run
+
+@contextlib.contextmanager
+def wg_latency_span(stage):
+    """Time the code in the with block as a stage of the current trace"""
+    trace = g_current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        trace.add(stage, start, time.perf_counter() - start, ok)
+
+def wg_latency_add(stage, seconds):
+    """Record a stage, that ended when the trace started, whose time we measured
+    some other way (e.g. the relay hold)"""
+    trace = g_current.get()
+    if trace is not None:
+        trace.add(stage, trace.start - seconds, seconds)
+
+def wg_latency_finish(trace):
+    """Write out a finished trace"""
+    if trace is None:
+        return
+    record = trace.record()
+    with trace.lock:
+        trace.finished = True
+    # The record is in the latency file; the log only gets the slow ones
+    wg_trace_print("Trace %s: %s took %.1f ms", g_latency_trace or record['ms'] > WG_LATENCY_SLOW_MS,
+                   record['id'], record['event'], record['ms'])
+    line = json.dumps(record, separators=(',', ':')) + "\n"
+    with g_latency_lock:
+        try:
+            if (os.path.exists(g_latency_file) and
+                    os.path.getsize(g_latency_file) + len(line) > WG_LATENCY_MAX_BYTES):
+                os.replace(g_latency_file, g_latency_file + ".1")
+            with open(g_latency_file, "a", encoding="utf-8") as file:
+                file.write(line)
+        except OSError as err:
+            wg_error_print("wg_latency_finish", str(err))
+
+###############################################################################
+#
+# Summary: percentiles for each stage over the traces in the file (and its
+# rollover).
+#
+def wg_latency_percentile(values, pct):
+    """pct percentile of a sorted list (nearest rank)"""
+    rank = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[rank]
+
+def wg_latency_summary(file_name=WG_LATENCY_FILE):
+    """Return {stage: {'count', 'p50', 'p95', 'p99', 'max'}} in ms"""
+    stages = {}
+    for name in (file_name + ".1", file_name):
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                total = record['event'] + " " + WG_LATENCY_TOTAL
+                stages.setdefault(total, []).append(record['ms'])
+                for span in record['spans']:
+                    stages.setdefault(span['stage'], []).append(span['ms'])
+    summary = {}
+    for stage, values in stages.items():
+        values.sort()
+        summary[stage] = {'count' : len(values),
+                          'p50' : wg_latency_percentile(values, 50),
+                          'p95' : wg_latency_percentile(values, 95),
+                          'p99' : wg_latency_percentile(values, 99),
+                          'max' : values[-1]}
+    return summary
+
+def wg_latency_print_summary(file_name=WG_LATENCY_FILE):
+    """Print the summary as a table"""
+    print("%-40s %6s %10s %10s %10s %10s" % ("stage (ms)", "count", "p50", "p95", "p99", "max"))
+    for stage, stats in sorted(wg_latency_summary(file_name).items()):
+        print("%-40s %6d %10.1f %10.1f %10.1f %10.1f" %
+              (stage, stats['count'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+
+if __name__ == "__main__":
+    wg_latency_print_summary(sys.argv[1] if len(sys.argv) > 1 else WG_LATENCY_FILE)
@@ -9,6 +9,7 @@
 # Note, sending either a text message or an email message requires a MailTrap account
 # (SMS messages are sent as email to the carrier gateway)
 """Interface to a email and text (SMS)"""
+import threading
 import mailtrap as mt
 
 # CARRIERDOMAIN = "mailmymobile.net" # This stopped working for Consumer Cellular, noticed 2023-Nov
@@ -17,6 +18,22 @@ FROMEMAILADDR = "pythonapps@geiserweb.com"
 FROMEMAILNAME = "WG Python app"
 MAILTRAPTOKEN = "9865f60bf9b7987b7bbf3d8f2d4c35a7"
 
+# One client for all the messages we send
+g_client = None
+g_client_lock = threading.Lock()
+
+####################################################################
+#
+# Get the (shared) Mailtrap client
+#
+def get_client():
+    """Return the Mailtrap client, creating it the first time"""
+    global g_client
+    with g_client_lock:
+        if g_client is None:
+            g_client = mt.MailtrapClient(token=MAILTRAPTOKEN)
+        return g_client
+
 ####################################################################
 #
 # Send an email message
@@ -29,9 +46,8 @@ def sendemail(toaddress, app, message):
         subject="Notification from " + app,
         text=message)
 
-    # create client and send
-    client = mt.MailtrapClient(token=MAILTRAPTOKEN)
-    client.send(mail)
+    # send it with the shared client
+    get_client().send(mail)
 
 ####################################################################
 #
@@ -0,0 +1,153 @@
+"""A long-lived MQTT connection with reconnect, offline buffering and an availability topic"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Helper functions and definitions to publish to an MQTT broker (e.g., the one
+# in Home Assistant).
+#
+# One connection is opened at startup and kept open; paho's network loop runs
+# in a background thread and reconnects (with backoff) if the broker goes
+# away.  Anything published while we're disconnected is kept and sent when
+# the connection comes back.  The availability topic is set to "online" when
+# we connect and, through the broker's Last Will, to "offline" if we drop off.
+#
+# Requirements:
+#   paho-mqtt library
+import collections
+import threading
+import time
+import paho.mqtt.client as mqtt
+from wg_helper import wg_error_print
+from wg_helper import wg_trace_print
+
+WG_MQTT_VERSION = "1.0"
+
+WG_MQTT_PORT = 1883
+WG_MQTT_QOS = 1                # at least once
+WG_MQTT_KEEPALIVE = 60         # seconds
+WG_MQTT_RECONNECT_MIN = 1      # seconds, first reconnect delay
+WG_MQTT_RECONNECT_MAX = 120    # seconds, reconnect delay doubles up to this
+WG_MQTT_BUFFER_SIZE = 100      # messages kept while the broker is unreachable
+WG_MQTT_STOP_TIMEOUT = 5       # seconds to wait for the "offline" message at shutdown
+WG_MQTT_STOP_POLL = 0.1        # seconds between checks on it (paho-mqtt before 1.6)
+
+WG_MQTT_ONLINE = "online"
+WG_MQTT_OFFLINE = "offline"
+
+g_client = None
+g_connected = False
+g_availability_topic = None
+g_qos = WG_MQTT_QOS
+g_buffer = collections.deque()
+g_lock = threading.Lock()
+g_stats = {'published' : 0, 'buffered' : 0, 'dropped' : 0, 'connects' : 0, 'disconnects' : 0}
+
+###############################################################################
+#
+# Connect to the broker and start the background network loop.
+#
+def wg_mqtt_start(hostname, username, password, availability_topic,
+                  port=WG_MQTT_PORT, qos=WG_MQTT_QOS, client_id=""):
+    """Connect to the MQTT broker and keep the connection up"""
+    global g_client, g_availability_topic, g_qos
+    g_availability_topic = availability_topic
+    g_qos = qos
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+    except AttributeError: # paho-mqtt 1.x
+        client = mqtt.Client(client_id=client_id)
+    client.username_pw_set(username, password)
+    client.will_set(availability_topic, WG_MQTT_OFFLINE, qos=qos, retain=True)
+    client.reconnect_delay_set(min_delay=WG_MQTT_RECONNECT_MIN, max_delay=WG_MQTT_RECONNECT_MAX)
+    client.on_connect = wg_mqtt_on_connect
+    client.on_disconnect = wg_mqtt_on_disconnect
+    g_client = client
+    # connect_async doesn't fail if the broker is down, the loop keeps trying
+    client.connect_async(hostname, port, keepalive=WG_MQTT_KEEPALIVE)
+    client.loop_start()
+
+###############################################################################
+#
+# Publish a message.  If we're not connected, it is buffered (only the last
+# retained message for a topic is kept, it's the only one the broker would
+# keep anyway).
+#
+def wg_mqtt_publish(topic, payload, retain=False, qos=None):
+    """Publish a message, or hold onto it until we're connected"""
+    if qos is None:
+        qos = g_qos
+    with g_lock:
+        if g_connected and g_client is not None:
+            info = g_client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                g_stats['published'] += 1
+                return
+        wg_mqtt_buffer(topic, payload, retain, qos)
+
+def wg_mqtt_buffer(topic, payload, retain, qos):
+    """Keep a message to send once we're connected (g_lock must be held)"""
+    if retain:
+        for msg in list(g_buffer):
+            if msg[0] == topic and msg[2]:
+                g_buffer.remove(msg)
+    if len(g_buffer) >= WG_MQTT_BUFFER_SIZE:
+        g_buffer.popleft()
+        g_stats['dropped'] += 1
+    g_buffer.append((topic, payload, retain, qos))
+    g_stats['buffered'] += 1
+
+def wg_mqtt_on_connect(client, userdata, flags, rc):
+    """paho callback: (re)connected to the broker"""
+    global g_connected
+    if rc != 0:
+        wg_error_print("wg_mqtt_on_connect", "Connection refused: " + mqtt.connack_string(rc))
+        return
+    wg_trace_print("Connected to MQTT broker", True)
+    with g_lock:
+        g_connected = True
+        g_stats['connects'] += 1
+        client.publish(g_availability_topic, WG_MQTT_ONLINE, qos=g_qos, retain=True)
+        while g_buffer:
+            topic, payload, retain, qos = g_buffer.popleft()
+            client.publish(topic, payload, qos=qos, retain=retain)
+            g_stats['published'] += 1
+
+def wg_mqtt_on_disconnect(client, userdata, rc):
+    """paho callback: lost (or closed) the connection to the broker"""
+    global g_connected
+    with g_lock:
+        g_connected = False
+        g_stats['disconnects'] += 1
+    if rc != 0:
+        wg_error_print("wg_mqtt_on_disconnect", "Lost connection to MQTT broker, reconnecting")
+
+###############################################################################
+#
+# Say we're going offline and close the connection.
+#
+def wg_mqtt_stop():
+    """Mark us offline and disconnect (call at shutdown)"""
+    global g_client
+    client = g_client
+    if client is None:
+        return
+    if g_connected:
+        info = client.publish(g_availability_topic, WG_MQTT_OFFLINE, qos=g_qos, retain=True)
+        try:
+            info.wait_for_publish(WG_MQTT_STOP_TIMEOUT)
+        except TypeError: # paho-mqtt before 1.6 has no timeout, so watch it ourselves
+            deadline = time.monotonic() + WG_MQTT_STOP_TIMEOUT
+            while not info.is_published() and time.monotonic() < deadline:
+                time.sleep(WG_MQTT_STOP_POLL)
+    client.disconnect()
+    client.loop_stop()
+    g_client = None
+
+def wg_mqtt_stats():
+    """Return connection state and publish/buffer counts"""
+    with g_lock:
+        stats = dict(g_stats)
+        stats['connected'] = g_connected
+        stats['pending'] = len(g_buffer)
+    return stats
@@ -0,0 +1,345 @@
+"""Send notifications (texts and emails) from a background queue, with failover"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# The alarm/thermostat code shouldn't have to wait on Mailtrap or Twilio to
+# tell me something went wrong.  wg_notify_text just queues the message (a few
+# microseconds) and a background thread sends it.  Each provider is tried a
+# few times, backing off between tries, before failing over to the next one:
+#
+#     wg_notify_start([WgMailtrapProvider(), WgTwilioProvider()])
+#     wg_notify_text(cell_phone, app_name, "Unable to set thermostat back")
+#     ...
+#     wg_notify_stop()  # sends what's still queued (for a while) and stops
+#
+# The providers keep their clients (and connections) from one message to the
+# next.  WgSmtpProvider and WgHttpProvider send to a local stand-in, e.g. a
+# debugging SMTP server or wg_fake_servers.WgFakeNotify, for testing.
+#
+# wg_notify_stats gives the delivery counts (per provider) and how long
+# messages took from being queued to being sent.
+import collections
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+import requests
+from wg_helper import wg_error_print
+from wg_helper import wg_trace_print
+from wg_retry import wg_backoff_delay
+from wg_latency import wg_latency_percentile
+
+WG_NOTIFY_VERSION = "1.0"
+
+WG_NOTIFY_TEXT = "text"
+WG_NOTIFY_EMAIL = "email"
+
+WG_NOTIFY_QUEUE_SIZE = 100     # messages waiting to be sent; more than this are dropped
+WG_NOTIFY_TRIES = 3            # tries with each provider before failing over to the next
+WG_NOTIFY_BASE = 2.0           # seconds, first backoff is up to this long
+WG_NOTIFY_CAP = 30.0           # seconds, no backoff is longer than this
+WG_NOTIFY_MAX_AGE = 900.0      # seconds, don't bother sending a message older than this
+WG_NOTIFY_TIMEOUT = 10.0       # seconds, for the stand-in transports
+WG_NOTIFY_FLUSH_TIMEOUT = 15.0 # seconds wg_notify_stop waits for the queue to be sent
+WG_NOTIFY_LATENCIES = 100      # delivery times kept for the stats
+
+class WgNotification():
+    """One message to send"""
+
+    def __init__(self, kind, to, app, message):
+        self.kind = kind        # WG_NOTIFY_TEXT or WG_NOTIFY_EMAIL
+        self.to = to            # phone number or email address
+        self.app = app
+        self.message = message
+        self.queued = time.monotonic()
+
+    @property
+    def subject(self):
+        """Subject line for the message"""
+        return "Notification from " + self.app
+
+###############################################################################
+#
+# Providers.  send() raises an exception if the message wasn't sent.
+#
+class WgNotifyProvider():
+    """Base class: a way of sending notifications"""
+    name = "provider"
+    kinds = (WG_NOTIFY_TEXT, WG_NOTIFY_EMAIL)  # what it can send
+
+    def send(self, notification):
+        """Send the notification"""
+        raise NotImplementedError
+
+    def close(self):
+        """Let go of any connections"""
+
+class WgMailtrapProvider(WgNotifyProvider):
+    """Email, and texts through the carrier's email to SMS gateway, via Mailtrap"""
+    name = "mailtrap"
+
+    def send(self, notification):
+        import wg_messagesender # only needed if this provider is used
+        if notification.kind == WG_NOTIFY_TEXT:
+            wg_messagesender.sendtext(notification.to, notification.app, notification.message)
+        else:
+            wg_messagesender.sendemail(notification.to, notification.app, notification.message)
+
+class WgTwilioProvider(WgNotifyProvider):
+    """Texts via Twilio (always to the cell phone in the Twilio account settings)"""
+    name = "twilio"
+    kinds = (WG_NOTIFY_TEXT,)
+
+    def send(self, notification):
+        import wg_twilio # only needed (along with its account settings) if this provider is used
+        wg_twilio.sendtext(notification.app + ": " + notification.message)
+
+class WgSmtpProvider(WgNotifyProvider):
+    """Send through an SMTP server (e.g. a local debugging server), keeping the
+    connection open"""
+    name = "smtp"
+
+    def __init__(self, host="localhost", port=1025, sender="pythonapps@localhost",
+                 text_domain="sms.localhost", timeout=WG_NOTIFY_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.text_domain = text_domain # texts go to <phone number>@text_domain
+        self.timeout = timeout
+        self.smtp = None
+
+    def send(self, notification):
+        mail = EmailMessage()
+        mail['From'] = self.sender
+        if notification.kind == WG_NOTIFY_TEXT:
+            mail['To'] = notification.to + '@' + self.text_domain
+        else:
+            mail['To'] = notification.to
+        mail['Subject'] = notification.subject
+        mail.set_content(notification.message)
+        if self.smtp is not None:
+            try:
+                self.smtp.send_message(mail)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None # it timed out the idle connection, open a new one
+        self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        self.smtp.send_message(mail)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+class WgHttpProvider(WgNotifyProvider):
+    """POST the notification as JSON (e.g. to wg_fake_servers.WgFakeNotify)"""
+    name = "http"
+
+    def __init__(self, url, timeout=WG_NOTIFY_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, notification):
+        reply = self.session.post(self.url, timeout=self.timeout,
+                                  json={'kind' : notification.kind, 'to' : notification.to,
+                                        'subject' : notification.subject,
+                                        'text' : notification.message})
+        reply.raise_for_status()
+        error = reply.json().get('error')
+        if error is not None:
+            raise RuntimeError("Notification refused: " + str(error))
+
+    def close(self):
+        self.session.close()
+
+###############################################################################
+#
+# The dispatcher: a queue and the thread that empties it.
+#
+class WgNotifier():
+    """Send notifications in the background, trying the providers in order"""
+
+    def __init__(self, providers, queue_size=WG_NOTIFY_QUEUE_SIZE, tries=WG_NOTIFY_TRIES,
+                 base=WG_NOTIFY_BASE, cap=WG_NOTIFY_CAP, max_age=WG_NOTIFY_MAX_AGE):
+        self.providers = list(providers)
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+        self.max_age = max_age
+        self.queue = queue.Queue(queue_size)
+        self.stopping = threading.Event() # once set, don't wait between tries
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {'queued' : 0, 'sent' : 0, 'dropped' : 0, 'failovers' : 0,
+                      'undeliverable' : 0, 'expired' : 0}
+        self.provider_stats = {}
+        self.names = [] # each provider's name in the stats (numbered if there are two)
+        for provider in self.providers:
+            name = provider.name
+            if name in self.provider_stats:
+                name += "-" + str(len(self.names) + 1)
+            self.names.append(name)
+            self.provider_stats[name] = {'sent' : 0, 'failed' : 0, 'last_error' : None}
+        self.latencies = collections.deque(maxlen=WG_NOTIFY_LATENCIES) # seconds, queued to sent
+
+    def start(self):
+        """Start the sending thread"""
+        self.thread = threading.Thread(target=self.run, name="wg_notify", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=WG_NOTIFY_FLUSH_TIMEOUT):
+        """Send what's queued (giving up after timeout seconds) and stop"""
+        self.stopping.set()
+        deadline = time.monotonic() + timeout # for the whole stop, not each step
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        if self.thread is not None:
+            self.thread.join(max(deadline - time.monotonic(), 0.0))
+        for provider in self.providers:
+            provider.close()
+
+    def notify(self, kind, to, app, message):
+        """Queue a notification.  Returns False if it had to be dropped."""
+        try:
+            self.queue.put_nowait(WgNotification(kind, to, app, message))
+        except queue.Full:
+            with self.lock:
+                self.stats['dropped'] += 1
+            wg_error_print("wg_notify", "Queue full, dropped: %s", message)
+            return False
+        with self.lock:
+            self.stats['queued'] += 1
+        return True
+
+    def run(self):
+        """Send the queued notifications (the sending thread)"""
+        while True:
+            notification = self.queue.get()
+            if notification is None:
+                return
+            try:
+                self.deliver(notification)
+            except Exception as e:
+                wg_error_print("wg_notify", str(e))
+
+    def deliver(self, notification):
+        """Send one notification, failing over from provider to provider"""
+        if time.monotonic() - notification.queued > self.max_age:
+            with self.lock:
+                self.stats['expired'] += 1
+            wg_error_print("wg_notify", "Too old to send: %s", notification.message)
+            return False
+        providers = [num for num, provider in enumerate(self.providers)
+                     if notification.kind in provider.kinds]
+        for num in providers:
+            if self.send(num, notification):
+                return True
+            if num != providers[-1]:
+                wg_trace_print("wg_notify: %s failed, trying the next provider", True,
+                               self.names[num])
+                with self.lock:
+                    self.stats['failovers'] += 1
+        with self.lock:
+            self.stats['undeliverable'] += 1
+        wg_error_print("wg_notify", "Unable to send: %s", notification.message)
+        return False
+
+    def send(self, num, notification):
+        """Try provider num (tries times).  Returns True if it worked."""
+        provider = self.providers[num]
+        name = self.names[num]
+        for attempt in range(self.tries):
+            if attempt > 0:
+                self.stopping.wait(wg_backoff_delay(attempt - 1, self.base, self.cap))
+            try:
+                provider.send(notification)
+            except Exception as e:
+                with self.lock:
+                    self.provider_stats[name]['failed'] += 1
+                    self.provider_stats[name]['last_error'] = str(e)
+                wg_error_print("wg_notify", "%s: %s", name, str(e))
+                continue
+            with self.lock:
+                self.stats['sent'] += 1
+                self.provider_stats[name]['sent'] += 1
+                self.latencies.append(time.monotonic() - notification.queued)
+            return True
+        return False
+
+    def get_stats(self):
+        """The delivery counts, per provider counts and delivery times (ms)"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['waiting'] = self.queue.qsize()
+            stats['providers'] = {name : dict(counts)
+                                  for name, counts in self.provider_stats.items()}
+            latencies = sorted(self.latencies)
+        if latencies:
+            stats['p50_ms'] = wg_latency_percentile(latencies, 50) * 1000.0
+            stats['p95_ms'] = wg_latency_percentile(latencies, 95) * 1000.0
+            stats['max_ms'] = latencies[-1] * 1000.0
+        return stats
+
+###############################################################################
+#
+# The notifier everything shares.  If nobody calls wg_notify_start, the first
+# notification starts one with the default providers.
+#
+g_notifier = None
+g_notifier_lock = threading.Lock()
+
+def wg_notify_default_providers():
+    """Mailtrap (SMS gateway) first, then Twilio"""
+    return [WgMailtrapProvider(), WgTwilioProvider()]
+
+def wg_notify_start(providers=None, **kwargs):
+    """Start the shared notifier (kwargs are passed on to WgNotifier)"""
+    global g_notifier
+    wg_notify_stop()
+    if providers is None:
+        providers = wg_notify_default_providers()
+    with g_notifier_lock:
+        g_notifier = WgNotifier(providers, **kwargs).start()
+        return g_notifier
+
+def wg_notify_stop(timeout=WG_NOTIFY_FLUSH_TIMEOUT):
+    """Send what's queued and stop the shared notifier"""
+    global g_notifier
+    with g_notifier_lock:
+        notifier = g_notifier
+        g_notifier = None
+    if notifier is not None:
+        notifier.stop(timeout)
+
+def wg_notify_get():
+    """The shared notifier (started with the default providers if need be)"""
+    global g_notifier
+    with g_notifier_lock:
+        if g_notifier is None:
+            g_notifier = WgNotifier(wg_notify_default_providers()).start()
+        return g_notifier
+
+def wg_notify_text(phonenumber, app, message):
+    """Queue a text message.  Returns False if it had to be dropped."""
+    return wg_notify_get().notify(WG_NOTIFY_TEXT, phonenumber, app, message)
+
+def wg_notify_email(toaddress, app, message):
+    """Queue an email.  Returns False if it had to be dropped."""
+    return wg_notify_get().notify(WG_NOTIFY_EMAIL, toaddress, app, message)
+
+def wg_notify_stats():
+    """The shared notifier's stats (None if it isn't running)"""
+    with g_notifier_lock:
+        notifier = g_notifier
+    if notifier is None:
+        return None
+    return notifier.get_stats()
@@ -11,13 +11,20 @@
 #   - It appears that getting the night light value always returns 4.
 
 import datetime
-import pprint
 import json
+import threading
+import time
 from urllib3 import PoolManager
+from urllib3 import Timeout
 from wg_helper import wg_error_print
 from wg_helper import wg_trace_print
+from wg_helper import wg_trace_pprint
+from wg_latency import wg_latency_span
+from wg_deadline import wg_deadline_timeout
+from wg_deadline import wg_deadline_remaining
+from wg_retry import wg_backoff_delay
 
-WG_RADIO_THERMOSTAT_VERSION = "2.1"
+WG_RADIO_THERMOSTAT_VERSION = "2.2"
 
 # The name (URL) of your Radio Thermostat
 TSTAT_IP = "thermostat-76-8C-C9"
@@ -49,6 +56,44 @@ RADTHERM_STR_SUCCESS = "SUCCESS"
 RADTHERM_STATUS_ERROR = {"error" : -1}
 RADTHERM_STATUS_SUCCESS = {"success" : 0}
 
+# How long (seconds) a /tstat snapshot may be used to answer the per-field getters
+RADTHERM_SNAPSHOT_MAX_AGE = 5.0
+# Fields that come back in the /tstat status (everything else needs its own GET)
+RADTHERM_SNAPSHOT_FIELDS = ("temp", "tmode", "fmode", "override", "hold", "t_heat",
+                            "t_cool", "program_mode", "tstate", "fstate", "time")
+
+###############################################################################
+#
+# The thermostat only handles one request at a time, so all calls share a
+# single persistent connection.  (block=True makes callers wait their turn
+# rather than opening a second connection the thermostat won't answer.)
+#
+RADTHERM_CONNECT_TIMEOUT = 3.0 # seconds, it's on the LAN
+RADTHERM_READ_TIMEOUT = 10.0   # seconds, it can be slow to answer
+RADTHERM_RETRIES = 1           # urllib3 retries (e.g. a stale pooled connection), not 3
+
+g_pman = PoolManager(maxsize=1, block=True)
+
+def radtherm_request(method, resource, body=None):
+    """Send a request to the thermostat and return the decoded JSON reply"""
+    url = 'http://' + TSTAT_IP + '/tstat' + resource
+    # Raises WgDeadlineExceeded if the action's time budget is used up (see wg_deadline)
+    connect, read = wg_deadline_timeout(RADTHERM_CONNECT_TIMEOUT, RADTHERM_READ_TIMEOUT)
+    timeout = Timeout(connect=connect, read=read)
+    with wg_latency_span("radtherm " + method + " /tstat" + resource):
+        if body is None:
+            ret = g_pman.request(method, url, timeout=timeout, retries=RADTHERM_RETRIES)
+        else:
+            ret = g_pman.request_encode_url(method, url,
+                                            headers={'Content-Type': 'application/json'},
+                                            body=json.dumps(body), timeout=timeout,
+                                            retries=RADTHERM_RETRIES)
+        return json.loads(ret.data.decode('utf-8'))
+
+g_snapshot = None
+g_snapshot_time = 0.0
+g_snapshot_lock = threading.Lock()
+
 ###############################################################################
 #
 # Get the status of the thermostat.  This includes:
@@ -66,20 +111,50 @@ RADTHERM_STATUS_SUCCESS = {"success" : 0}
 #
 def radtherm_status():
     """Return the status of the thermostat"""
+    global g_snapshot, g_snapshot_time
     try:
-        pman = PoolManager()
-        url = 'http://' + TSTAT_IP +'/tstat'
-        ret = pman.request('GET', url)
-        retval = json.loads(ret.data.decode('utf-8'))
+        retval = radtherm_request('GET', '')
         if 'error' in retval:
             wg_error_print("radtherm_status", " Unsuccessful status request (error)")
             return RADTHERM_STATUS_ERROR
+        with g_snapshot_lock:
+            g_snapshot = retval
+            g_snapshot_time = time.monotonic()
+        radtherm_check_program(retval)
         return retval
     except Exception: #pylint: disable=W0703
         wg_error_print("radtherm_status", " Unsuccessful status request (exception)")
         return RADTHERM_STATUS_ERROR
 
 
+###############################################################################
+#
+# Get a snapshot of the thermostat status.  If the last /tstat read is less than
+# max_age seconds old (default RADTHERM_SNAPSHOT_MAX_AGE), it is returned without
+# going back to the thermostat.  Otherwise, a new status is read.
+#
+def radtherm_get_snapshot(trace, max_age=None):
+    """Return a recent status of the thermostat, reading it only if needed"""
+    if max_age is None:
+        max_age = RADTHERM_SNAPSHOT_MAX_AGE
+    with g_snapshot_lock:
+        if g_snapshot is not None and time.monotonic() - g_snapshot_time <= max_age:
+            wg_trace_print("Using thermostat snapshot", trace)
+            return g_snapshot
+    return radtherm_status()
+
+
+###############################################################################
+#
+# Forget the current snapshot (e.g., because we just changed a setting)
+#
+def radtherm_invalidate_snapshot():
+    """Throw away the current status snapshot"""
+    global g_snapshot
+    with g_snapshot_lock:
+        g_snapshot = None
+
+
 ###############################################################################
 #
 # Make a call to the thermostat to get a floating point data value.
@@ -100,14 +175,12 @@ def radtherm_get_float(what, trace):
         else:
             wg_error_print("radtherm_get_float", " Invalid 'what' argument " + what)
             return RADTHERM_FLOAT_ERROR
-        pman = PoolManager()
-        url = 'http://' + TSTAT_IP +'/tstat/' + resource
-        ret = pman.request('GET', url)
-        retval = json.loads(ret.data.decode('utf-8'))
-        if trace:
-            pprt = pprint.PrettyPrinter(indent=4)
-            pprt.pprint(retval)
-            wg_trace_print(what + " is " + str(retval[what]), trace)
+        if what in RADTHERM_SNAPSHOT_FIELDS:
+            retval = radtherm_get_snapshot(trace)
+        else:
+            retval = radtherm_request('GET', '/' + resource)
+        wg_trace_pprint(retval, trace)
+        wg_trace_print("%s is %s", trace, what, retval[what])
         return retval[what]
     except Exception: #pylint: disable=W0703
         wg_error_print("radtherm_get_float", " Unsuccessful GET request (exception) of " + what)
@@ -138,14 +211,12 @@ def radtherm_get_int(what, trace):
         else:
             wg_error_print("radtherm_get_int", " Invalid 'what' argument " + what)
             return RADTHERM_INT_ERROR
-        pman = PoolManager()
-        url = 'http://' + TSTAT_IP +'/tstat/' + resource
-        ret = pman.request('GET', url)
-        retval = json.loads(ret.data.decode('utf-8'))
-        if trace:
-            pprt = pprint.PrettyPrinter(indent=4)
-            pprt.pprint(retval)
-            wg_trace_print(what + " is " + str(retval[what]), trace)
+        if what in RADTHERM_SNAPSHOT_FIELDS:
+            retval = radtherm_get_snapshot(trace)
+        else:
+            retval = radtherm_request('GET', '/' + resource)
+        wg_trace_pprint(retval, trace)
+        wg_trace_print("%s is %s", trace, what, retval[what])
         return retval[what]
     except Exception: #pylint: disable=W0703
         wg_error_print("radtherm_get_int", " Unsuccessful GET request (exception) of " + what)
@@ -167,12 +238,8 @@ def radtherm_set_float(what, value, trace):
         if what != "t_heat":
             wg_error_print("radtherm_set_float", " Invalid 'what' argument " + what)
             return RADTHERM_FLOAT_ERROR
-        pman = PoolManager()
-        encoded_body = json.dumps({what: value})
-        ret = pman.request_encode_url('POST', 'http://' + TSTAT_IP +'/tstat',
-                                      headers={'Content-Type': 'application/json'},
-                                      body=encoded_body)
-        retval = json.loads(ret.data.decode('utf-8'))
+        radtherm_invalidate_snapshot()
+        retval = radtherm_request('POST', '', {what: value})
         if 'success' not in retval:
             wg_error_print("radtherm_set_float", " Unsuccessful POST request (error) of " + what)
             return RADTHERM_FLOAT_ERROR
@@ -206,12 +273,8 @@ def radtherm_set_int(what, value, trace):
         else:
             wg_error_print("radtherm_set_int", " Invalid 'what' argument " + what)
             return RADTHERM_INT_ERROR
-        pman = PoolManager()
-        encoded_body = json.dumps({what: value})
-        ret = pman.request_encode_url('POST', 'http://' + TSTAT_IP + '/tstat/' + resource,
-                                      headers={'Content-Type': 'application/json'},
-                                      body=encoded_body)
-        retval = json.loads(ret.data.decode('utf-8'))
+        radtherm_invalidate_snapshot()
+        retval = radtherm_request('POST', '/' + resource, {what: value})
         if 'success' not in retval:
             wg_error_print("radtherm_set_int", " Unsuccessful POST request (error) of " + what)
             return RADTHERM_INT_ERROR
@@ -243,12 +306,7 @@ def radtherm_set_str(what, value, trace):
         else:
             wg_error_print("radtherm_set_str", " Invalid 'what' argument " + what)
             return RADTHERM_STR_ERROR
-        pman = PoolManager()
-        encoded_body = json.dumps({"line": line, "message": value})
-        ret = pman.request_encode_url('POST', 'http://' + TSTAT_IP + '/tstat' + resource,
-                                      headers={'Content-Type': 'application/json'},
-                                      body=encoded_body)
-        retval = json.loads(ret.data.decode('utf-8'))
+        retval = radtherm_request('POST', resource, {"line": line, "message": value})
         if 'success' not in retval:
             wg_error_print("radtherm_set_str", " Unsuccessful POST request (error) of " + what)
             return RADTHERM_STR_ERROR
@@ -258,6 +316,147 @@ def radtherm_set_str(what, value, trace):
     return RADTHERM_STR_SUCCESS
 
 
+###############################################################################
+#
+# The heating program, cached.  The program rarely changes, so each day's
+# /tstat/program/heat/<day> is read once (when first needed, or all seven by
+# radtherm_load_program) and kept, parsed into (minute, temp) setpoints with
+# the day's lowest and highest temp worked out.  A day is read again after
+# RADTHERM_PROGRAM_MAX_AGE seconds, or sooner if the thermostat's status shows
+# the program changed (see radtherm_check_program).
+#
+# A failed read is tried again after a short backoff (rather than right
+# away, the thermostat only handles one request at a time) while there's
+# time left in the action's budget.
+#
+RADTHERM_DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"] # weekday() order
+RADTHERM_PROGRAM_MAX_AGE = 6 * 3600.0 # seconds before a day's program is read again
+RADTHERM_PROGRAM_TRIES = 3            # reads of a day's program before giving up
+RADTHERM_PROGRAM_BACKOFF = 0.5        # seconds, first backoff between tries
+RADTHERM_PROGRAM_BACKOFF_CAP = 4.0    # seconds, longest backoff
+
+g_program = {}       # weekday -> {'setpoints': [(minute, temp), ...], 'min':, 'max':, 'time':}
+g_program_mode = None
+g_program_lock = threading.Lock()
+
+def radtherm_parse_program(day, retval):
+    """Turn a /tstat/program/heat/<day> reply into the cache entry (None if it's bad)"""
+    values = retval.get(str(day))
+    if not isinstance(values, list) or len(values) < 2:
+        return None
+    # minute, temp, minute, temp, ...
+    setpoints = sorted(zip(values[0::2], values[1::2]))
+    temps = [temp for _, temp in setpoints]
+    return {'setpoints' : setpoints, 'min' : min(temps), 'max' : max(temps),
+            'time' : time.monotonic()}
+
+def radtherm_fetch_program(day, trace):
+    """Read one day's program from the thermostat (None if we can't)"""
+    for attempt in range(RADTHERM_PROGRAM_TRIES):
+        if attempt:
+            delay = wg_backoff_delay(attempt - 1, RADTHERM_PROGRAM_BACKOFF,
+                                     RADTHERM_PROGRAM_BACKOFF_CAP)
+            remaining = wg_deadline_remaining()
+            if remaining is not None and remaining <= delay:
+                break # out of time
+            time.sleep(delay)
+        try:
+            retval = radtherm_request('GET', '/program/heat/' + RADTHERM_DAYS[day])
+        except Exception as err: #pylint: disable=W0703
+            wg_error_print("radtherm_fetch_program", str(err))
+            continue
+        wg_trace_pprint(retval, trace)
+        entry = radtherm_parse_program(day, retval)
+        if entry is not None:
+            return entry
+    wg_error_print("radtherm_fetch_program", "Unable to read the program for " + RADTHERM_DAYS[day])
+    return None
+
+def radtherm_get_program(day, trace):
+    """Return the cached program entry for a weekday, reading it if needed (None on error)"""
+    with g_program_lock:
+        entry = g_program.get(day)
+        if entry is not None and time.monotonic() - entry['time'] <= RADTHERM_PROGRAM_MAX_AGE:
+            return entry
+    entry = radtherm_fetch_program(day, trace)
+    if entry is not None:
+        with g_program_lock:
+            g_program[day] = entry
+    return entry
+
+def radtherm_load_program(trace):
+    """Read the whole week's program into the cache.  Returns True if all 7 days were read"""
+    return all([radtherm_get_program(day, trace) is not None for day in range(7)])
+
+def radtherm_invalidate_program():
+    """Throw away the cached program (e.g., because it was changed)"""
+    with g_program_lock:
+        g_program.clear()
+
+###############################################################################
+#
+# The setpoint in effect at, and the one after, a given time.  day is a
+# weekday() (0 is Monday) and minute is minutes past midnight.  Each returns
+# (day, minute, temp), or None if we can't read the program.
+#
+def radtherm_now():
+    """(weekday, minute) for right now"""
+    now = datetime.datetime.now()
+    return now.weekday(), now.hour * 60 + now.minute
+
+def radtherm_get_current_setpoint(trace, day=None, minute=None):
+    """The program setpoint in effect (now, by default)"""
+    if day is None:
+        day, minute = radtherm_now()
+    for offset in range(7):
+        check = (day - offset) % 7
+        entry = radtherm_get_program(check, trace)
+        if entry is None:
+            return None
+        for start, temp in reversed(entry['setpoints']):
+            if offset or start <= minute:
+                return check, start, temp
+    return None
+
+def radtherm_get_next_setpoint(trace, day=None, minute=None):
+    """The next program setpoint (after now, by default)"""
+    if day is None:
+        day, minute = radtherm_now()
+    for offset in range(8):
+        check = (day + offset) % 7
+        entry = radtherm_get_program(check, trace)
+        if entry is None:
+            return None
+        for start, temp in entry['setpoints']:
+            if offset or start > minute:
+                return check, start, temp
+    return None
+
+###############################################################################
+#
+# Notice a changed program from a status read: the program mode changed, or
+# the thermostat is running its program (no hold or override) at a different
+# temperature than the cached program says it should be.
+#
+def radtherm_check_program(status):
+    """Throw away the cached program if status says it has changed"""
+    global g_program_mode
+    mode = status.get('program_mode')
+    with g_program_lock:
+        changed = g_program_mode is not None and mode != g_program_mode
+        g_program_mode = mode
+        if not changed and status.get('hold') == HOLD_DISABLED and not status.get('override') \
+                and status.get('tmode') == TMODE_HEAT and 't_heat' in status and 'time' in status:
+            day = status['time'].get('day')
+            minute = status['time'].get('hour', 0) * 60 + status['time'].get('minute', 0)
+            entry = g_program.get(day)
+            if entry is not None:
+                current = [temp for start, temp in entry['setpoints'] if start <= minute]
+                changed = bool(current) and current[-1] != status['t_heat']
+        if changed:
+            wg_trace_print("Thermostat program changed, reading it again", True)
+            g_program.clear()
+
 ###############################################################################
 #
 # Return the lowest temperature in today's program
@@ -266,29 +465,10 @@ def radtherm_set_str(what, value, trace):
 #
 def radtherm_get_todays_lowest_setting(trace):
     """Figure out the lowest temp setting in today's program."""
-    days = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-    num_tries = 1
-    retval = {}
-    prog = RADTHERM_FLOAT_ERROR
-    try:
-        pman = PoolManager()
-        wkdy = datetime.datetime.today().weekday()
-        url = 'http://' + TSTAT_IP +'/tstat/program/heat/' + days[wkdy]
-        while num_tries < 6 and retval.get(str(wkdy), 'error') == 'error':
-            ret = pman.request('GET', url)
-            retval = json.loads(ret.data.decode('utf-8'))
-            if trace:
-                pprt = pprint.PrettyPrinter(indent=4)
-                pprt.pprint(retval)
-            if retval.get(str(wkdy), 'error') != 'error':
-                prog = min((retval[str(wkdy)])[1::2]) # 1,3,5, etc. elements are temps
-            num_tries += 1
-        return prog
-    except Exception as err: #pylint: disable=W0703
-        wg_error_print("radtherm_get_todays_highest_setting",
-                       str(err))
-        wg_error_print(err.response.text)
-        return prog
+    entry = radtherm_get_program(datetime.datetime.today().weekday(), trace)
+    if entry is None:
+        return RADTHERM_FLOAT_ERROR
+    return entry['min']
 
 
 ###############################################################################
@@ -299,27 +479,7 @@ def radtherm_get_todays_lowest_setting(trace):
 #
 def radtherm_get_todays_highest_setting(trace):
     """Figure out the highest temp setting in today's program."""
-    days = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-    num_tries = 1
-    retval = {}
-    prog = RADTHERM_FLOAT_ERROR
-    try:
-        pman = PoolManager()
-        wkdy = datetime.datetime.today().weekday()
-        url = 'http://' + TSTAT_IP +'/tstat/program/heat/' + days[wkdy]
-        while num_tries < 6 and retval.get(str(wkdy), 'error') == 'error':
-            ret = pman.request('GET', url)
-            retval = json.loads(ret.data.decode('utf-8'))
-            if trace:
-                pprt = pprint.PrettyPrinter(indent=4)
-                pprt.pprint(retval)
-            if retval.get(str(wkdy), 'error') != 'error':
-                prog = max((retval[str(wkdy)])[1::2]) # 1,3,5, etc. elements are the temps
-            num_tries += 1
-        return prog
-    except Exception as err: #pylint: disable=W0703
-        wg_error_print("radtherm_get_todays_highest_setting",
-                       str(err))
-        if hasattr('err', 'response'):
-            wg_error_print(err.response.text)
-        return prog
+    entry = radtherm_get_program(datetime.datetime.today().weekday(), trace)
+    if entry is None:
+        return RADTHERM_FLOAT_ERROR
+    return entry['max']
@@ -0,0 +1,151 @@
+"""Retry failed calls with exponential backoff, without blocking the caller"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Helper functions and definitions for retrying calls to cloud services.
+#
+# Rather than sleeping between tries (which ties up whatever thread called us,
+# e.g. a gpiozero callback), each retry is scheduled on a timer.  Retries are
+# filed under a key; starting a new retry with the same key cancels the old one
+# so, for example, a disarm doesn't have to wait behind a stale arm retry.
+#
+# If the job is started under a deadline (see wg_deadline), the retries run
+# under it too and the job gives up (calling on_fail) when it's used up.
+import contextvars
+import random
+import threading
+import time
+from wg_helper import wg_error_print
+from wg_helper import wg_trace_print
+from wg_deadline import wg_deadline_get
+
+WG_RETRY_VERSION = "1.0"
+
+# What an attempt tells the retry engine
+WG_RETRY_DONE = 0     # It worked (or there's nothing more to do).  Stop.
+WG_RETRY_AGAIN = 1    # Temporary failure (server error, timeout).  Back off and try again.
+WG_RETRY_REFRESH = 2  # Credentials expired.  Refresh them and try again right away.
+WG_RETRY_FAIL = 3     # Permanent failure (bad request).  Don't bother trying again.
+
+WG_RETRY_BASE = 5.0          # seconds, first backoff is up to this long
+WG_RETRY_CAP = 60.0          # seconds, no backoff is longer than this
+WG_RETRY_MAX_ELAPSED = 270.0 # seconds, give up once we've been at it this long
+
+###############################################################################
+#
+# How long to wait before retry number attempt (0 based).  This is "full
+# jitter": a random time up to the exponential backoff so a number of
+# retries don't all hit the server at the same time.
+#
+def wg_backoff_delay(attempt, base=WG_RETRY_BASE, cap=WG_RETRY_CAP):
+    """Return the (randomized) delay before the given retry"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+###############################################################################
+#
+# A retry job.  attempt(job) is called (first time right away, in the caller's
+# thread) and returns one of the WG_RETRY_ values above.  A long running
+# attempt should check job.cancelled before doing anything it can't undo.
+#
+class WgRetry():
+    """Call attempt() until it works, backing off between tries"""
+    def __init__(self, name, attempt, on_fail=None, on_refresh=None,
+                 base=WG_RETRY_BASE, cap=WG_RETRY_CAP,
+                 max_elapsed=WG_RETRY_MAX_ELAPSED, max_attempts=None):
+        self.name = name
+        self.attempt = attempt
+        self.on_fail = on_fail         # called if we give up
+        self.on_refresh = on_refresh   # called when attempt returns WG_RETRY_REFRESH
+        self.base = base
+        self.cap = cap
+        self.max_elapsed = max_elapsed
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self.cancelled = False
+        self.start_time = 0.0
+        self.deadline = None
+        self._context = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Make the first attempt"""
+        self.start_time = time.monotonic()
+        self.deadline = wg_deadline_get()
+        self._context = contextvars.copy_context() # the retries run with our deadline, etc.
+        self._run()
+
+    def cancel(self):
+        """Stop retrying"""
+        with self._lock:
+            self.cancelled = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _run(self):
+        with self._lock:
+            self._timer = None
+            if self.cancelled:
+                return
+        try:
+            result = self.attempt(self)
+        except Exception as err: #pylint: disable=W0703
+            wg_error_print(self.name, str(err))
+            result = WG_RETRY_AGAIN
+        self.attempts += 1
+        if result == WG_RETRY_DONE or self.cancelled:
+            return
+        if result == WG_RETRY_FAIL:
+            self._give_up()
+            return
+        if result == WG_RETRY_REFRESH:
+            if self.on_refresh is not None:
+                self.on_refresh()
+            delay = 0.0
+        else:
+            delay = wg_backoff_delay(self.attempts - 1, self.base, self.cap)
+        now = time.monotonic()
+        if ((self.max_attempts is not None and self.attempts >= self.max_attempts) or
+                now - self.start_time + delay > self.max_elapsed or
+                (self.deadline is not None and now + delay >= self.deadline)):
+            self._give_up()
+            return
+        wg_trace_print("%s: trying again in %.1f seconds", True, self.name, delay)
+        with self._lock:
+            if self.cancelled:
+                return
+            self._timer = threading.Timer(delay, self._context.copy().run, args=(self._run,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _give_up(self):
+        wg_error_print(self.name, "Giving up after " + str(self.attempts) + " tries")
+        if self.on_fail is not None and not self.cancelled:
+            self.on_fail()
+
+###############################################################################
+#
+# Retries currently running, by key.
+#
+g_jobs = {}
+g_jobs_lock = threading.Lock()
+
+def wg_retry_start(key, attempt, **kwargs):
+    """Start a retry job under key, cancelling any job already running under it"""
+    job = WgRetry(key, attempt, **kwargs)
+    with g_jobs_lock:
+        old = g_jobs.get(key)
+        g_jobs[key] = job
+    if old is not None:
+        old.cancel()
+    job.start()
+    return job
+
+def wg_retry_cancel(key):
+    """Cancel the retry job running under key (if there is one)"""
+    with g_jobs_lock:
+        job = g_jobs.pop(key, None)
+    if job is not None:
+        job.cancel()
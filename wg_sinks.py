@@ -0,0 +1,374 @@
+"""The things that get told when the alarm is armed or disarmed"""
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023, Wayne Geiser (geiserw@gmail.com).  All Rights Reserved
+#
+# Each sink adapts one backend (Ecobee, Radio Thermostat, MQTT/Home Assistant)
+# to the alarm controller.  alarm_tstat.py calls arm() or disarm() on every
+# configured sink, each on its own thread, so a slow or broken backend doesn't
+# hold up (or break) the others.
+#
+# just_started is True for the event alarm_tstat sends itself at startup
+# (rather than one caused by a change to the alarm).
+import datetime
+import json
+import threading
+import time
+from wg_helper import wg_trace_print
+from wg_helper import wg_error_print
+from wg_notify import wg_notify_text
+from wg_retry import WG_RETRY_DONE
+from wg_retry import WG_RETRY_REFRESH
+from wg_retry import WG_RETRY_FAIL
+from wg_retry import wg_retry_start
+from wg_retry import wg_retry_cancel
+from wg_deadline import wg_deadline_expired
+import wg_ecobee
+import wg_radio_thermostat
+import wg_mqtt
+
+WG_SINKS_VERSION = "1.0"
+
+WG_SINK_TIMEOUT = 30.0 # seconds, default time a sink has to handle an event
+
+class WgSink():
+    """Base class: something that reacts to the alarm being armed/disarmed"""
+    name = "sink"
+
+    def __init__(self, trace=False, timeout=WG_SINK_TIMEOUT):
+        self.trace = trace
+        self.timeout = timeout
+
+    def start(self):
+        """Called once when the controller starts"""
+
+    def stop(self):
+        """Called once when the controller shuts down"""
+
+    def arm(self, button, just_started):
+        """The alarm was armed"""
+        raise NotImplementedError
+
+    def disarm(self, button, just_started):
+        """The alarm was disarmed"""
+        raise NotImplementedError
+
+###############################################################################
+#
+# Ecobee: set back to the lowest temperature in today's program when armed,
+# resume the program when disarmed.
+#
+ECOBEE_NUM_RETRIES = 10           # Number of times to retry a failed setback
+ECOBEE_RETRY_BASE = 5.0           # seconds, first retry delay
+ECOBEE_RETRY_MAX_SECONDS = 270.0  # Give up retrying after this long
+ECOBEE_RETRY_KEY = "ecobee"       # A new arm/disarm cancels any retry still pending
+
+class EcobeeSink(WgSink):
+    """Set an Ecobee thermostat back while the alarm is armed"""
+    name = "ecobee"
+
+    def __init__(self, app_name, cell_phone, trace=False, timeout=WG_SINK_TIMEOUT,
+                 arm_alert=None, disarm_alert=None):
+        WgSink.__init__(self, trace, timeout)
+        self.app_name = app_name
+        self.cell_phone = cell_phone     # who to text if we can't set back
+        self.arm_alert = arm_alert       # alert to show on the thermostat(s) when set back
+        self.disarm_alert = disarm_alert # alert to show when the program is resumed
+
+    def alert_functions(self, alert):
+        """The (0 or 1) extra functions to send an alert along with a change"""
+        if alert is None:
+            return []
+        return [wg_ecobee.ecobee_send_message_function(alert)]
+
+    def start(self):
+        # We only need to do this at startup because we reboot once a day
+        wg_ecobee.authorize_app_with_ecobee(self.trace)
+        # Keep the shadow of the thermostats up to date so arm/disarm can
+        # decide what to do without waiting on the Ecobee
+        wg_ecobee.ecobee_start_poller(self.trace)
+
+    def stop(self):
+        wg_retry_cancel(ECOBEE_RETRY_KEY)
+        wg_ecobee.ecobee_shutdown() # don't leave connections to the Ecobee hanging
+
+    def arm(self, button, just_started):
+        wg_retry_cancel(ECOBEE_RETRY_KEY) # a newer arm replaces any pending one
+        statuses = wg_ecobee.ecobee_get_shadow(self.trace)
+        if 'error' in statuses:
+            wg_error_print("setback_tstat",
+                           "Error getting thermostat status.  Skipping...")
+            if wg_deadline_expired():
+                self.setback_failed() # out of time, this alarm won't get another try
+            return  # try again the next time
+        targets = []
+        for ident, tstat_status in statuses.items():
+            if tstat_status['hold'] == wg_ecobee.HOLD_ENABLED:
+                wg_trace_print("%s: Hold enabled.  Don't do anything", self.trace, ident)
+                continue # don't mess with the settings, someone wants them this way
+            if tstat_status['tmode'] != wg_ecobee.TMODE_HEAT:
+                wg_trace_print("%s: We're not in heating mode.  Don't do anything.",
+                               self.trace, ident)
+                continue # don't mess with the settings, we're not heating
+            targets.append(ident)
+        if not targets:
+            return
+        # Retries are scheduled, so we don't tie up a thread waiting
+        wg_retry_start(ECOBEE_RETRY_KEY,
+                       lambda job: self.setback_attempt(job, targets),
+                       on_fail=self.setback_failed,
+                       on_refresh=lambda: wg_ecobee.authorize_app_with_ecobee(self.trace),
+                       base=ECOBEE_RETRY_BASE, max_elapsed=ECOBEE_RETRY_MAX_SECONDS,
+                       max_attempts=ECOBEE_NUM_RETRIES)
+
+    def setback_attempt(self, job, targets):
+        """One try at setting the target thermostats back"""
+        #
+        # Failures are classified (ecobee_classify): expired tokens are
+        # refreshed, server errors and timeouts are tried again after a
+        # backoff, and anything else gives up (and texts me) right away.
+        #
+        program = wg_ecobee.ecobee_get_snapshot(self.trace, wg_ecobee.ECOBEE_PROGRAM_SECTIONS)
+        retry = wg_ecobee.ecobee_classify(program)
+        if retry != WG_RETRY_DONE:
+            wg_trace_print("Error getting today's lowest setting", True)
+            return retry
+        settings = wg_ecobee.ecobee_get_todays_lowest_settings(self.trace) # from the cache
+        setback_temps = {}
+        for ident in targets:
+            setback_temp = settings.get(ident, wg_ecobee.TSTAT_ERROR)
+            if setback_temp == wg_ecobee.TSTAT_ERROR:
+                wg_error_print("setback_tstat", "%s: No usable program", ident)
+                return WG_RETRY_FAIL # it won't have one next time either
+            setback_temps[ident] = setback_temp
+        if job.cancelled:
+            return WG_RETRY_DONE # the alarm was disarmed while we were trying
+        wg_trace_print("Setting target temps to %s", self.trace, setback_temps)
+        # set the temporary temperatures to the values we found, above
+        replies = {}
+        results = wg_ecobee.ecobee_set_hold_temps(setback_temps, self.trace,
+                                                  self.alert_functions(self.arm_alert), replies)
+        if wg_ecobee.TSTAT_SUCCESS in results.values():
+            wg_trace_print("System armed", True)
+        failed = []
+        retry = WG_RETRY_DONE
+        for ident, ret in results.items():
+            if ret != wg_ecobee.TSTAT_ERROR:
+                continue
+            wg_error_print("setback_tstat", "%s: Error setting t_heat", ident)
+            classified = wg_ecobee.ecobee_classify(replies[ident])
+            if classified == WG_RETRY_FAIL:
+                continue # won't work next time either
+            failed.append(ident)
+            if retry != WG_RETRY_REFRESH:
+                retry = classified
+        if len(failed) < list(results.values()).count(wg_ecobee.TSTAT_ERROR):
+            if not failed:
+                return WG_RETRY_FAIL # nothing worth trying again, on_fail texts me
+            self.setback_failed() # tell me now about the ones we're giving up on
+        if failed:
+            targets[:] = failed # just try the ones that might work again
+        return retry
+
+    def setback_failed(self):
+        """We never did get the setback temperature"""
+        # Send me a text message to tell me it didn't work (queued, it's sent in the background)
+        wg_notify_text(self.cell_phone, self.app_name,
+                 "Unable to set thermostat back.  You'll have to do it via smartphone app.  Sorry.")
+
+    def resume_failed(self):
+        """We ran out of time resuming the program"""
+        wg_notify_text(self.cell_phone, self.app_name,
+                 "Unable to resume the thermostat program.  You'll have to do it via smartphone app.  Sorry.")
+
+    def disarm(self, button, just_started):
+        wg_retry_cancel(ECOBEE_RETRY_KEY) # don't let a pending setback undo this
+        statuses = wg_ecobee.ecobee_get_shadow(self.trace)
+        if 'error' in statuses:
+            wg_error_print("run_tstat",
+                           "Error getting thermostat status.  Skipping...")
+            if wg_deadline_expired():
+                self.resume_failed()
+            return  # try again the next time
+        targets = []
+        for ident, tstat_status in statuses.items():
+            if tstat_status['tmode'] != wg_ecobee.TMODE_HEAT:
+                wg_trace_print("%s: We're not in heating mode.  Don't do anything.",
+                               self.trace, ident)
+                continue # don't mess with the settings, we're not heating
+            if (tstat_status['hold'] == wg_ecobee.HOLD_ENABLED) and just_started:
+                # if hold & we just started up, don't mess with the settings
+                wg_trace_print("%s: Hold enabled and we just started, not changing t-stat settings",
+                               self.trace, ident)
+                continue
+            targets.append(ident)
+        if not targets:
+            return
+        # disable hold (on all of them at once)
+        results = wg_ecobee.ecobee_resume_programs(targets, self.trace,
+                                                   self.alert_functions(self.disarm_alert))
+        if wg_ecobee.TSTAT_ERROR in results.values():
+            wg_error_print("run_tstat", "Error disabling hold")
+            if wg_deadline_expired():
+                self.resume_failed()
+            return
+        # !!! Now should be running current program !!!
+        wg_trace_print("System disarmed", True)
+
+###############################################################################
+#
+# Radio Thermostat: hold at the lowest temperature in today's program when
+# armed, release the hold (which resumes the program) when disarmed.
+#
+class RadthermSink(WgSink):
+    """Set a Radio Thermostat back while the alarm is armed"""
+    name = "radtherm"
+
+    def start(self):
+        # read the week's program now so arming doesn't have to wait for it
+        wg_radio_thermostat.radtherm_load_program(self.trace)
+
+    def arm(self, button, just_started):
+        tstat_status = wg_radio_thermostat.radtherm_status()
+        if 'error' in tstat_status:
+            wg_error_print("RadthermSink.arm", "Error getting thermostat status.  Skipping...")
+            return
+        if tstat_status['hold'] == wg_radio_thermostat.HOLD_ENABLED:
+            wg_trace_print("Hold enabled.  Don't do anything", self.trace)
+            return # don't mess with the settings, someone wants them this way
+        if tstat_status['tmode'] != wg_radio_thermostat.TMODE_HEAT:
+            wg_trace_print("We're not in heating mode.  Don't do anything.", self.trace)
+            return # don't mess with the settings, we're not heating
+        setback_temp = wg_radio_thermostat.radtherm_get_todays_lowest_setting(self.trace)
+        if setback_temp == wg_radio_thermostat.RADTHERM_FLOAT_ERROR:
+            wg_error_print("RadthermSink.arm", "Error getting today's lowest setting")
+            return
+        ret = wg_radio_thermostat.radtherm_set_float("t_heat", setback_temp, self.trace)
+        if ret == wg_radio_thermostat.RADTHERM_FLOAT_ERROR:
+            wg_error_print("RadthermSink.arm", "Error setting t_heat")
+            return
+        ret = wg_radio_thermostat.radtherm_set_int("hold", wg_radio_thermostat.HOLD_ENABLED,
+                                                   self.trace)
+        if ret == wg_radio_thermostat.RADTHERM_INT_ERROR:
+            wg_error_print("RadthermSink.arm", "Error setting hold")
+            return
+        wg_trace_print("Radio Thermostat set back to %s", True, setback_temp)
+
+    def disarm(self, button, just_started):
+        tstat_status = wg_radio_thermostat.radtherm_status()
+        if 'error' in tstat_status:
+            wg_error_print("RadthermSink.disarm", "Error getting thermostat status.  Skipping...")
+            return
+        if tstat_status['tmode'] != wg_radio_thermostat.TMODE_HEAT:
+            wg_trace_print("We're not in heating mode.  Don't do anything.", self.trace)
+            return # don't mess with the settings, we're not heating
+        if tstat_status['hold'] == wg_radio_thermostat.HOLD_ENABLED and just_started:
+            wg_trace_print("Hold enabled and we just started, not changing t-stat settings",
+                           self.trace)
+            return
+        ret = wg_radio_thermostat.radtherm_set_int("hold", wg_radio_thermostat.HOLD_DISABLED,
+                                                   self.trace)
+        if ret == wg_radio_thermostat.RADTHERM_INT_ERROR:
+            wg_error_print("RadthermSink.disarm", "Error disabling hold")
+            return
+        wg_trace_print("Radio Thermostat running its program", True)
+
+###############################################################################
+#
+# MQTT: tell the Home Assistant the alarm state ("ON"/"OFF") and let it deal
+# with the thermostat.  The state is only published when it changes.  A
+# retained JSON attributes message (see publish_attributes) is sent with it,
+# at most once every MQTT_ATTRIBUTES_MIN_INTERVAL seconds.
+#
+MQTT_STATE_TOPIC = "homeassistant/alarm/state"
+MQTT_AVAILABILITY_TOPIC = "homeassistant/alarm/availability" # "online" / "offline"
+MQTT_ATTRIBUTES_TOPIC = "homeassistant/alarm/attributes"
+MQTT_ATTRIBUTES_MIN_INTERVAL = 30.0 # seconds
+MQTT_QOS = 1
+
+class MqttSink(WgSink):
+    """Publish the alarm state to the Home Assistant"""
+    name = "mqtt"
+
+    def __init__(self, hostname, username, password, version,
+                 coalesced=None, trace=False, timeout=WG_SINK_TIMEOUT):
+        WgSink.__init__(self, trace, timeout)
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.coalesced = coalesced # returns the number of events the controller skipped
+        self.last_state = None     # what we last told the Home Assistant
+        self.attributes = {
+            'last_transition' : None, # when the alarm state last changed
+            'hold_time'       : None, # how long the relay was held before that change
+            'flaps'           : 0,    # relay holds that didn't change the state
+            'version'         : version
+        }
+        self.lock = threading.Lock()
+        self.attr_timer = None
+        self.attr_last_sent = 0.0
+
+    def start(self):
+        wg_mqtt.wg_mqtt_start(self.hostname, self.username, self.password,
+                              MQTT_AVAILABILITY_TOPIC, qos=MQTT_QOS, client_id="AlarmPi")
+
+    def stop(self):
+        self.publish_attributes() # don't leave any changes unsent
+        wg_mqtt.wg_mqtt_stop()    # tell the Home Assistant we're going away
+
+    def arm(self, button, just_started):
+        if self.publish_state("ON", button):
+            wg_trace_print("System armed", True)
+
+    def disarm(self, button, just_started):
+        state = "OFF"
+        if just_started:
+            # alarm_tstat disarms at startup whatever the alarm is doing, so publish
+            # what the relay says (button is the disarmed switch: held means disarmed)
+            pressed = getattr(button, 'is_pressed', None)
+            if pressed is None:
+                return # can't tell, leave the Home Assistant's retained state alone
+            state = "OFF" if pressed else "ON"
+        if self.publish_state(state, button):
+            wg_trace_print("System " + ("disarmed" if state == "OFF" else "armed"), True)
+
+    def publish_state(self, state, button):
+        """Publish the alarm state if it changed.  Returns True if it did."""
+        with self.lock:
+            if state == self.last_state:
+                self.attributes['flaps'] += 1
+                changed = False
+            else:
+                self.last_state = state
+                self.attributes['last_transition'] = datetime.datetime.now().isoformat(
+                    timespec='seconds')
+                self.attributes['hold_time'] = getattr(button, 'active_time', None)
+                changed = True
+        if changed:
+            wg_mqtt.wg_mqtt_publish(MQTT_STATE_TOPIC, state, retain=True)
+        self.schedule_attributes()
+        return changed
+
+    def schedule_attributes(self):
+        """Publish the attributes, but no more than once every MQTT_ATTRIBUTES_MIN_INTERVAL"""
+        with self.lock:
+            if self.attr_timer is not None:
+                return # already scheduled, this change will go out with it
+            delay = max(0.0, self.attr_last_sent + MQTT_ATTRIBUTES_MIN_INTERVAL - time.monotonic())
+            self.attr_timer = threading.Timer(delay, self.publish_attributes)
+            self.attr_timer.daemon = True
+            self.attr_timer.start()
+
+    def publish_attributes(self):
+        """Publish the (retained) attributes JSON"""
+        with self.lock:
+            if self.attr_timer is not None:
+                self.attr_timer.cancel()
+            self.attr_timer = None
+            self.attr_last_sent = time.monotonic()
+            attributes = dict(self.attributes)
+        if self.coalesced is not None:
+            # flaps the controller swallowed never got to publish_state
+            attributes['flaps'] += self.coalesced()
+        wg_mqtt.wg_mqtt_publish(MQTT_ATTRIBUTES_TOPIC,
+                                json.dumps(attributes, separators=(',', ':')), retain=True)
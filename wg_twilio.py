@@ -6,6 +6,7 @@
 #
 # Helper functiona and definitions to interface with a Twilio account
 """Interface to a Twilio.com account"""
+import threading
 from twilio.rest import Client
 
 # SMS texting facility - requires a Twilio account
@@ -14,7 +15,23 @@ from twilio_account_settings import TWILIO_AUTH_TOKEN
 from twilio_account_settings import CELL_PHONE
 from twilio_account_settings import FROM_PHONE
 
-WG_TWILIO_VERSION = "2.0"
+WG_TWILIO_VERSION = "2.1"
+
+# One client (and its connections) for all the messages we send
+g_client = None
+g_client_lock = threading.Lock()
+
+####################################################################
+#
+# Get the (shared) Twilio client
+#
+def get_client():
+    """Return the Twilio client, creating it the first time"""
+    global g_client
+    with g_client_lock:
+        if g_client is None:
+            g_client = Client(TWILIO_ACT, TWILIO_AUTH_TOKEN)
+        return g_client
 
 ####################################################################
 #
@@ -22,7 +39,6 @@ WG_TWILIO_VERSION = "2.0"
 #
 def sendtext(text_message):
     """Send a text_message to the cell number in account settings file"""
-    client = Client(TWILIO_ACT, TWILIO_AUTH_TOKEN)
-    client.messages.create(to=CELL_PHONE,
-                           from_=FROM_PHONE,
-                           body=text_message)
+    get_client().messages.create(to=CELL_PHONE,
+                                 from_=FROM_PHONE,
+                                 body=text_message)